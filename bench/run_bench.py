@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2014-2015 Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+Benchmarks for passout.
+
+Each store size is benchmarked in a fresh process with a synthetic store
+in a temporary PASSOUT_HOME, using bench/fake_gpg in place of gpg so that
+the results reflect passout's own overhead. Results are written as JSON,
+and can be compared against an earlier run with --compare.
+
+E.g.:
+    python bench/run_bench.py --sizes 1000,100000 --output new.json
+    python bench/run_bench.py --sizes 1000,100000 --compare old.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(BENCH_DIR)
+FAKE_GPG = os.path.join(BENCH_DIR, "fake_gpg")
+PASSOUT_CLI = os.path.join(SOURCE_DIR, "passout", "passout_cli.py")
+BENCH_ID = "bench@localhost"
+
+DEFAULT_SIZES = "1000,10000,100000"
+DEFAULT_DEPTH = 2
+DEFAULT_SAMPLES = 5
+# How many sub-groups each group has in the synthetic store
+FANOUT = 10
+
+
+def synthetic_name(i, depth):
+    groups = ["g%d" % ((i // FANOUT ** k) % FANOUT) for k in range(depth)]
+    return "__".join(groups + ["pw%d" % i])
+
+
+def make_store(passout_home, size, depth):
+    """Make a store of fake_gpg 'encrypted' passwords. The files are written
+    directly, as running fake_gpg a million times would take a while."""
+
+    crypto_dir = os.path.join(passout_home, "crypto_store")
+    os.makedirs(crypto_dir)
+    with open(os.path.join(passout_home, "passout.json"), "w") as fh:
+        json.dump({"id": BENCH_ID, "gpg": FAKE_GPG}, fh)
+
+    header = b"FAKE-GPG " + BENCH_ID.encode("utf-8") + b"\n"
+    for i in range(size):
+        secret = ("secret%d" % i).encode("utf-8")
+        path = os.path.join(crypto_dir, synthetic_name(i, depth) + ".gpg")
+        with open(path, "wb") as fh:
+            fh.write(header + base64.b64encode(secret) + b"\n")
+
+
+def stats(times):
+    times = sorted(times)
+    n = len(times)
+    return {
+        "samples": n,
+        "min_ms": times[0] * 1000,
+        "median_ms": times[n // 2] * 1000,
+        "mean_ms": sum(times) / n * 1000,
+        "max_ms": times[-1] * 1000,
+    }
+
+
+def measure(func, samples, setup=None):
+    times = []
+    for i in range(samples):
+        if setup is not None:
+            setup(i)
+        start = time.time()
+        func(i)
+        times.append(time.time() - start)
+    return stats(times)
+
+
+def run_cli(*args):
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call((sys.executable, PASSOUT_CLI) + args,
+                              stdout=devnull)
+
+
+def bench_tray(passout, cfg, samples):
+    if not os.environ.get("DISPLAY"):
+        return {"skipped": "No X11"}
+    try:
+        from passout import tray
+    except (ImportError, NameError) as e:
+        return {"skipped": "No GTK: %s" % e}
+    return measure(lambda i: tray.PassoutSysTrayApp(cfg), samples)
+
+
+def run_worker(size, depth, samples):
+    """Benchmark one store. PASSOUT_HOME must already point at an empty
+    directory, as passout reads it on import."""
+
+    sys.path.insert(0, SOURCE_DIR)
+    import passout
+
+    make_store(passout.PASSOUT_HOME, size, depth)
+    cfg = passout.get_config()
+    names = [synthetic_name(i * size // samples, depth)
+             for i in range(samples)]
+
+    def drop_index(i):
+        if os.path.exists(passout.NAME_INDEX_FILE):
+            os.unlink(passout.NAME_INDEX_FILE)
+        passout.default_store()._listing = None
+
+    results = {}
+    results["get_password_names_cold"] = measure(
+        lambda i: passout.get_password_names(), samples, drop_index)
+    results["get_password_names"] = measure(
+        lambda i: passout.get_password_names(), samples)
+    results["get_password_names_grouped"] = measure(
+        lambda i: passout.get_password_names_grouped(), samples)
+    results["get_password"] = measure(
+        lambda i: passout.get_password(cfg, names[i], testing=True), samples)
+    results["add_password"] = measure(
+        lambda i: passout.add_password(cfg, "bench_add%d" % i, "x"), samples)
+    results["cli_version"] = measure(lambda i: run_cli("version"), samples)
+    results["cli_ls"] = measure(lambda i: run_cli("ls"), samples)
+    results["tray_menu"] = bench_tray(passout, cfg, samples)
+    return results
+
+
+def run_size(size, depth, samples):
+    passout_home = tempfile.mkdtemp(prefix="passout-bench-")
+    env = dict(os.environ, PASSOUT_HOME=passout_home)
+    try:
+        out = subprocess.check_output(
+            [sys.executable, __file__, "--worker", "--sizes", str(size),
+             "--depth", str(depth), "--samples", str(samples)], env=env)
+    finally:
+        shutil.rmtree(passout_home)
+    return json.loads(out.decode("utf-8"))
+
+
+def compare(old, new):
+    """Print how the median times of two runs compare"""
+
+    print("%-10s %-28s %12s %12s %8s" %
+          ("size", "benchmark", "old (ms)", "new (ms)", "ratio"))
+    for size in sorted(new["results"], key=int):
+        for name, res in sorted(new["results"][size].items()):
+            old_res = old["results"].get(size, {}).get(name, {})
+            if "median_ms" not in res or "median_ms" not in old_res:
+                continue
+            ratio = res["median_ms"] / max(old_res["median_ms"], 1e-9)
+            print("%-10s %-28s %12.3f %12.3f %8.2f" %
+                  (size, name, old_res["median_ms"], res["median_ms"],
+                   ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark passout")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="Comma separated store sizes "
+                        "(default: %s)" % DEFAULT_SIZES)
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH,
+                        help="Group depth of the password names "
+                        "(default: %d)" % DEFAULT_DEPTH)
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES,
+                        help="Times to run each benchmark "
+                        "(default: %d)" % DEFAULT_SAMPLES)
+    parser.add_argument("--output", help="Write the JSON results here "
+                        "instead of stdout")
+    parser.add_argument("--compare", help="Compare with the JSON results "
+                        "of an earlier run")
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    if args.worker:
+        results = run_worker(sizes[0], args.depth, args.samples)
+        print(json.dumps(results))
+        return
+
+    sys.path.insert(0, SOURCE_DIR)
+    from passout import VERSION
+
+    report = {
+        "meta": {
+            "passout_version": VERSION,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "depth": args.depth,
+            "samples": args.samples,
+        },
+        "results": {},
+    }
+    for size in sizes:
+        sys.stderr.write("Benchmarking a store of %d passwords...\n" % size)
+        report["results"][str(size)] = run_size(size, args.depth,
+                                                args.samples)
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    elif not args.compare:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare, "r") as fh:
+            compare(json.load(fh), report)
+
+
+if __name__ == "__main__":
+    main()
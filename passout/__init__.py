@@ -17,16 +17,15 @@
 PassOut as a library.
 """
 
+# Other modules are imported where they are used, as not every command needs
+# them and they add up to a good fraction of the CLI's start up time.
+import contextlib
+import functools
 import os
-import sys
-import stat
-import getpass
-import subprocess
-import collections
+import threading
 import logging
-import json
-import locale
 from logging import info, debug
+from passout import trace
 
 VERSION = "0.1"
 PASSOUT_HOME = os.environ.get("PASSOUT_HOME")
@@ -35,8 +34,19 @@ if not PASSOUT_HOME:
 
 CRYPTO_DIR = os.path.join(PASSOUT_HOME, "crypto_store")
 CONFIG_FILE = os.path.join(PASSOUT_HOME, "passout.json")
+NAME_INDEX_FILE = os.path.join(PASSOUT_HOME, "name_index")
+NAME_INDEX_MAGIC = "passout-name-index-1"
+SEARCH_INDEX_FILE = os.path.join(PASSOUT_HOME, "search_index")
+PACK_FILE = os.path.join(CRYPTO_DIR, "store.pack")
 
 GROUP_SEP = "__"
+# A sharded store keeps each password in CRYPTO_DIR/ab/cd/, where 'abcd' is
+# the start of the SHA-1 of its name, so no one directory gets too big. A
+# packed store keeps them all in PACK_FILE (see pack.py).
+LAYOUTS = ["flat", "sharded", "packed"]
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+BATCH_JOBS = 4
 XCLIP_CLIPBOARDS = ["primary", "secondary", "clipboard"]
 DEBUG_LEVEL = os.environ.get("PASSOUT_DEBUG", None)
 
@@ -55,210 +65,1141 @@ if DEBUG_LEVEL is not None:
 
 def notify_send(cfg, message):
     if cfg["notify_cmd"]:
-        subprocess.check_call([cfg["notify_cmd"], message])
+        import subprocess
+        with trace.span("notify"):
+            subprocess.check_call([cfg["notify_cmd"], message])
 
 
-def _check_dirs():
-    """ Check that the passout dot dir is there and looking right """
-    dirs = [PASSOUT_HOME, CRYPTO_DIR]
-    for d in dirs:
-        if not os.path.exists(d):
-            os.mkdir(d)
-            debug("Creating %s" % d)
-        if not os.path.isdir(d):
-            raise PassOutError("'%s' is not a directory" % d)
+def _is_shard_name(entry):
+    return len(entry) == SHARD_WIDTH and \
+        all(c in "0123456789abcdef" for c in entry)
 
 
-def _get_pass_file(passname):
-    _check_dirs()
-    return os.path.join(CRYPTO_DIR, passname) + ".gpg"
+def _dir_entries(path):
+    """Yield the name of each entry in a directory along with a function
+    saying if it is a directory. Where os.scandir() is available, this
+    usually doesn't need a stat."""
 
-
-def _sort_dict(dct):
-    new_dct = collections.OrderedDict()
-
-    for k, v in sorted(dct.items()):
-        if not v:  # i.e. empty dict
-            new_dct[k] = v
-        else:
-            new_dct[k] = _sort_dict(v)
-
-    return new_dct
+    scandir = getattr(os, "scandir", None)
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir
+    else:
+        for entry in os.listdir(path):
+            yield entry, functools.partial(os.path.isdir,
+                                           os.path.join(path, entry))
 
 
-def clear_clipboard(cfg):
-    """Overwrite all clipboards with the empty string"""
+def clear_clipboard(cfg, passwd=None):
+    """Overwrite all clipboards with the empty string. If a password is
+    given, clipboards which no longer hold it are left alone."""
 
     for clip in XCLIP_CLIPBOARDS:
+        if passwd is not None and _read_clipboard(clip) != passwd:
+            debug("'%s' clipboard has changed, not clearing" % clip)
+            continue
         _load_clipboard(clip, "")
 
     notify_send(cfg, "Clipboards cleared")
 
 
 def _load_clipboard(clip, val):
+    import locale
+    import subprocess
+
     info("Loading '%s' clipboard" % clip)
 
     xclip_args = ("xclip", "-i", "-selection", clip)
     debug("xclip args: %s" % " ".join(xclip_args))
-    try:
-        pipe = subprocess.Popen(xclip_args,  stdin=subprocess.PIPE)
-    except OSError:
-        raise PassOutError("call to xclip failed")
-
-    (out, err) = pipe.communicate(
-        val.encode(locale.getpreferredencoding()))
+    with trace.span("xclip", op="load", selection=clip) as sp:
+        try:
+            # xclip stays behind to hold the selection, and mustn't keep
+            # our other files (e.g. a pipe to a parent) open for as long
+            pipe = subprocess.Popen(xclip_args, stdin=subprocess.PIPE,
+                                    close_fds=True)
+        except OSError:
+            raise PassOutError("call to xclip failed")
+
+        (out, err) = pipe.communicate(
+            val.encode(locale.getpreferredencoding()))
+        sp.set(rc=pipe.returncode)
     if pipe.returncode != 0:
         raise PassOutError("xlcip returned non-zero")
 
 
+def _read_clipboard(clip):
+    import locale
+    import subprocess
+
+    xclip_args = ("xclip", "-o", "-selection", clip)
+    debug("xclip args: %s" % " ".join(xclip_args))
+    with trace.span("xclip", op="read", selection=clip) as sp:
+        try:
+            pipe = subprocess.Popen(xclip_args, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, close_fds=True)
+        except OSError:
+            raise PassOutError("call to xclip failed")
+
+        (out, err) = pipe.communicate()
+        sp.set(rc=pipe.returncode)
+    if pipe.returncode != 0:
+        return None  # e.g. nothing in the clipboard
+    return out.decode(locale.getpreferredencoding())
+
+
 # //////// Exposed API functions below //////////////
 
 
-def get_password(cfg, pwname, testing=False):
-    info("Getting password '%s'" % pwname)
+def _decrypt_file(cfg, pw_file, testing=False):
+    """Decrypt a file, returning the plaintext"""
 
-    pw_file = _get_pass_file(pwname)
+    from passout import crypto
+    return crypto.get_backend(cfg).decrypt_file(cfg, pw_file, testing)
 
-    if not os.path.exists(pw_file):
-        raise PassOutError("No password called '%s'" % pwname)
 
-    # Have not found a way for this to work with mutt+msmtp without using
-    # a GUI pinentry. /dev/tty not configured. Annoying XXX
-    gpg_args = (cfg["gpg"], "-u", cfg["id"], "--no-tty", "-d", pw_file)
-    debug("Calling GPG tool with args: %s" % (gpg_args, ))
+def _decrypt_data(cfg, data):
+    """Decrypt ciphertext held in memory (e.g. from a pack), returning the
+    plaintext"""
+
+    from passout import crypto
+    return crypto.get_backend(cfg).decrypt(cfg, data)
 
-    # When we are testing we cannot pass a stdin.
-    # (pytest capture upsets subprocess)
-    if testing:
-        stdin = None
-    else:
-        stdin = sys.stdin
 
+def _encrypt_data(cfg, passwd, recipient=None):
+    """Encrypt a password, returning the ciphertext"""
+
+    from passout import crypto
+    if recipient is None:
+        recipient = cfg["id"]
+    return crypto.get_backend(cfg).encrypt(cfg, passwd, recipient)
+
+
+def _encrypt_to_fd(cfg, fd, passwd, recipient=None):
+    """Encrypt a password, writing the result to a file descriptor. The
+    password is encrypted for our own key unless a recipient is given."""
+
+    from passout import crypto
+    if recipient is None:
+        recipient = cfg["id"]
+    crypto.get_backend(cfg).encrypt_to_fd(cfg, fd, passwd, recipient)
+
+
+def _encrypt_to_temp(cfg, out_dir, passwd, recipient=None):
+    """Encrypt a password into a new temporary file in out_dir, flushed to
+    disk. Returns the path of the file, which the caller must move into
+    place or remove."""
+
+    return _write_temp(
+        out_dir, lambda fd: _encrypt_to_fd(cfg, fd, passwd, recipient))
+
+
+def _write_temp(out_dir, write):
+    """Make a new temporary file in out_dir, fill it by calling write() with
+    its file descriptor, and flush it to disk. Returns its path."""
+
+    import tempfile
+
+    # mkstemp() gives us a file r/w for the owner only. This lets automated
+    # file synchronisers (e.g. syncthing) delete the password files if they
+    # so wish.
+    fd, tmp_file = tempfile.mkstemp(dir=out_dir, prefix=".", suffix=".tmp")
+    try:
+        try:
+            write(fd)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return tmp_file
+
+
+def _replace_file(path, data, mode="wb"):
+    """Atomically replace a file which can be rebuilt if lost (e.g. an
+    index), so is not flushed to disk. Each writer, even another thread,
+    gets a temporary file of its own."""
+
+    import tempfile
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".",
+                                    suffix=".tmp")
     try:
-        pipe = subprocess.Popen(
-            gpg_args, stdin=stdin, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, universal_newlines=True
-        )
+        with os.fdopen(fd, mode) as fh:
+            fh.write(data)
+        os.rename(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _link_into_place(tmp_file, out_file):
+    # Unlike rename(), link() won't clobber an existing file
+    try:
+        os.link(tmp_file, out_file)
     except OSError:
-        raise PassOutError("GPG utility '%s' not found" % cfg["gpg"])
+        if os.path.exists(out_file):
+            raise PassOutError("A password file already exists at '%s'" %
+                               out_file)
+        raise
 
-    (out, err) = pipe.communicate()
 
-    if pipe.returncode != 0:
-        raise PassOutError("gpg returned non-zero\nSTDOUT: %s\nSTDERR: %s" %
-                           (out, err))
+def _fsync_dir(path):
+    """Flush the entries of a directory (e.g. a new name) to disk"""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _encrypt_to_file(cfg, out_file, passwd, recipient=None, replace=False):
+    """Encrypt a password into a file, atomically.
+
+    The ciphertext goes to a temporary file next to out_file which is then
+    moved into place, so a failure never leaves a partial file behind.
+    Unless replace is set, an existing out_file is an error."""
 
-    return out
+    tmp_file = _encrypt_to_temp(cfg, os.path.dirname(out_file), passwd,
+                                recipient)
+    try:
+        if replace:
+            os.rename(tmp_file, out_file)
+        else:
+            _link_into_place(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+
+class Transaction(object):
+    """A batch of passwords to add and remove, see Store.transaction()"""
+
+    def __init__(self):
+        self.adds = []
+        self.removes = []
+
+    def add(self, pw_name, passwd, meta=None):
+        """Add a password, with optional metadata as for
+        Store.add_password()"""
+
+        self.adds.append((pw_name, passwd, meta))
+
+    def remove(self, pw_name):
+        self.removes.append(pw_name)
+
+
+class Store(object):
+    """A password store: the config file and passwords in a PASSOUT_HOME.
+
+    A Store holds on to its config and to what it has learned about the
+    store, e.g. that its directories exist and which passwords it has, so
+    that long running programs (like the tray) don't work it all out again
+    on every call. The listing is re-read whenever the crypto dir changes.
+
+    The module level functions below use a default Store for PASSOUT_HOME.
+    Other stores can be used side by side by making a Store for each."""
+
+    def __init__(self, home=None, cfg=None):
+        self.home = home or PASSOUT_HOME
+        self.crypto_dir = os.path.join(self.home, "crypto_store")
+        self.config_file = os.path.join(self.home, "passout.json")
+        self.name_index_file = os.path.join(self.home, "name_index")
+        self.search_index_file = os.path.join(self.home, "search_index")
+        self.pack_file = os.path.join(self.crypto_dir, "store.pack")
+        self.sock_file = os.path.join(self.home, "passout.sock")
+        self.meta_file = os.path.join(self.home, "metadata.sqlite")
+        self.lock_file = os.path.join(self.home, "store.lock")
+        self.journal_file = os.path.join(self.home, "change_journal")
+        self.rekey_journal_file = os.path.join(self.home, "rekey_journal")
+        self._lock = threading.Lock()
+        self._cfg = cfg
+        self._dirs_checked = False
+        self._pack = None
+        self._meta = None
+        self._keycache = None
+        self._listing = None  # (signature, names)
+
+    @property
+    def cfg(self):
+        """The config, read from the config file on first use"""
+
+        if self._cfg is None:
+            self.load_config()
+        return self._cfg
+
+    @cfg.setter
+    def cfg(self, cfg):
+        self._cfg = cfg
+
+    def _check_dirs(self, force=False):
+        """ Check that the passout dot dir is there and looking right """
+
+        # Once checked, one stat is enough to see they are still there
+        if self._dirs_checked and not force and \
+                os.path.isdir(self.crypto_dir):
+            return
+        for d in [self.home, self.crypto_dir]:
+            if not os.path.exists(d):
+                os.mkdir(d)
+                debug("Creating %s" % d)
+            if not os.path.isdir(d):
+                raise PassOutError("'%s' is not a directory" % d)
+        self._dirs_checked = True
+
+    def load_config(self):
+        """(Re)read the config file, returning the config"""
+
+        import json
+
+        info("Reading config from '%s'" % self.config_file)
+
+        # Start afresh, the store may have been changed under our feet
+        self._pack = None
+        self._meta = None
+        self._keycache = None
+        self._listing = None
+        self._check_dirs(force=True)
+
+        # default config
+        # JSON library loads in unicode, so we too use unicode here
+        cfg = {
+            u"gpg":             u"gpg2",
+            u"id":              None,
+            u"clip_clear_time": 5,
+            u"notify_cmd":      u"",
+            u"daemon_ttl":      300,
+            u"daemon_cache_size": 100,
+            u"trace":           u"",
+            u"layout":          u"flat",
+            u"crypto_backend":  u"subprocess",
+            u"keyring_ttl":     0,
+        }
+
+        if not os.path.exists(self.config_file):
+            raise PassOutError("Please create the config file '%s'" %
+                               self.config_file)
+
+        with open(self.config_file, "r") as fh:
+            new_cfg = json.load(fh)
+
+        cfg.update(new_cfg)
+
+        # The environment takes precedence, and will already be enabled
+        if trace.TRACE_ENV not in os.environ:
+            trace.enable(cfg["trace"])
+
+        if not cfg["id"]:
+            raise PassOutError("No 'id' in %s" % self.config_file)
+
+        self._cfg = cfg
+        return cfg
+
+    def _shard_dir(self, passname):
+        import hashlib
+
+        if not isinstance(passname, bytes):
+            passname = passname.encode("utf-8")
+        digest = hashlib.sha1(passname).hexdigest()
+        return os.path.join(self.crypto_dir, *[
+            digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH]
+            for i in range(SHARD_LEVELS)])
+
+    def _get_pass_file(self, passname, layout="flat"):
+        """Where a password is kept in the given store layout"""
+
+        self._check_dirs()
+        if layout == "flat":
+            return os.path.join(self.crypto_dir, passname) + ".gpg"
+        elif layout == "sharded":
+            return os.path.join(self._shard_dir(passname), passname) + ".gpg"
+        raise PassOutError("Unknown store layout '%s'" % layout)
+
+    def _find_pass_file(self, passname):
+        """Find the file of an existing password in either layout. Returns
+        None if there is no such password.
+
+        When a store is migrated, each file is linked into its new place
+        before being unlinked from the old one. Looking in the first place
+        again after the second means a password being moved is never
+        missed."""
+
+        flat = self._get_pass_file(passname, "flat")
+        sharded = self._get_pass_file(passname, "sharded")
+        for pw_file in (flat, sharded, flat):
+            if os.path.exists(pw_file):
+                return pw_file
+        return None
+
+    def _new_pass_file(self, passname):
+        """Where a new password goes, making its shard dirs if need be"""
+
+        pw_file = self._get_pass_file(passname, self.cfg["layout"])
+        pw_dir = os.path.dirname(pw_file)
+        if not os.path.isdir(pw_dir):
+            try:
+                os.makedirs(pw_dir)
+            except OSError:
+                if not os.path.isdir(pw_dir):  # may have lost a race
+                    raise
+        return pw_file
+
+    def _get_pack(self, create=False):
+        """The PackStore of the store, or None if there is no pack (and we
+        aren't about to create one)"""
+
+        if not create and not os.path.exists(self.pack_file):
+            return None
+        if self._pack is None:
+            from passout.pack import PackStore
+            self._pack = PackStore(
+                self.pack_file, os.path.join(self.home, "pack_index"),
+                os.path.join(self.home, "pack.lock"))
+        return self._pack
+
+    def _read_packed(self, passname):
+        """The ciphertext of a password in the pack, or None"""
+
+        pack = self._get_pack()
+        if pack is None:
+            return None
+        return pack.get(passname)
+
+    def _get_meta(self, create=False):
+        """The MetaIndex of the store, or None if there is no metadata (and
+        we aren't about to add some)"""
+
+        if not create and not os.path.exists(self.meta_file):
+            return None
+        if self._meta is None:
+            from passout.meta import MetaIndex
+            self._check_dirs()
+            self._meta = MetaIndex(self.meta_file)
+        return self._meta
+
+    def _get_journal(self):
+        from passout.journal import Journal
+        return Journal(self.journal_file)
+
+    def _record_changes(self, added=(), removed=()):
+        """Note changes to the passwords in the change journal. Call both
+        before and after making the changes: a sync between the two may
+        see a name before it has changed, and a crash between the two
+        would otherwise lose it. A name journalled twice does no harm, as
+        a sync looks at the password as it is now."""
+
+        from passout import journal
+        self._get_journal().record([(journal.REMOVED, x) for x in removed] +
+                                   [(journal.ADDED, x) for x in added])
+
+    def _password_exists(self, passname):
+        if self._find_pass_file(passname) is not None:
+            return True
+        pack = self._get_pack()
+        return pack is not None and passname in pack
+
+    def _note_store_change(self, pw_file):
+        """Adding or removing a file in a shard doesn't change the mtime of
+        the crypto dir, which the indexes and the tray rely on. So change
+        it."""
+
+        if os.path.dirname(pw_file) != self.crypto_dir:
+            os.utime(self.crypto_dir, None)
+
+    def _crypto_dir_signature(self):
+        """Identifies the current state of the crypto dir. Any password
+        being added or removed changes the mtime."""
+
+        st = os.stat(self.crypto_dir)
+        mtime_ns = getattr(st, "st_mtime_ns", None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1e9)
+        sig = "%s %d %d" % (NAME_INDEX_MAGIC, st.st_ino, mtime_ns)
+
+        # The pack is only ever appended to or replaced
+        try:
+            pst = os.stat(self.pack_file)
+        except OSError:
+            return sig
+        return "%s %d %d" % (sig, pst.st_ino, pst.st_size)
+
+    def _iter_scan(self):
+        """Yield the passwords in the crypto dir, any shards and any pack as
+        they are found. A password in the middle of being migrated may be in
+        two places, but is yielded once."""
+
+        seen = set()
+        dirs = [(self.crypto_dir, 0)]
+        while dirs:
+            path, level = dirs.pop()
+            for entry, is_dir in _dir_entries(path):
+                if entry.endswith(".gpg"):
+                    name = entry[:-4]
+                    if name not in seen:
+                        seen.add(name)
+                        yield name
+                elif level < SHARD_LEVELS and _is_shard_name(entry) and \
+                        is_dir():
+                    dirs.append((os.path.join(path, entry), level + 1))
+        pack = self._get_pack()
+        if pack is not None:
+            for name in pack.names():
+                if name not in seen:
+                    seen.add(name)
+                    yield name
+
+    def _scan_password_names(self):
+        """List the passwords in the crypto dir, any shards and any pack"""
+
+        with trace.span("scan", path=self.crypto_dir) as sp:
+            names = list(self._iter_scan())
+            sp.set(entries=len(names))
+        return names
+
+    def _read_name_index(self, sig=None):
+        """Read the cached list of password names.
+
+        Returns None if there is no index or it is stale, i.e. the crypto
+        dir has changed since it was written."""
+
+        try:
+            with open(self.name_index_file, "r") as fh:
+                lines = fh.read().split("\n")
+        except (IOError, OSError):
+            return None
+
+        if sig is None:
+            sig = self._crypto_dir_signature()
+        if lines[0] != sig:
+            debug("Name index is stale")
+            return None
+        return lines[1:-1]
+
+    def _iter_name_index(self, sig):
+        """As _read_name_index(), but yields the names as they are read.
+        Returns None if there is no fresh index."""
+
+        try:
+            fh = open(self.name_index_file, "r")
+        except (IOError, OSError):
+            return None
+        if fh.readline().rstrip("\n") != sig:
+            fh.close()
+            debug("Name index is stale")
+            return None
+
+        def read():
+            with fh:
+                for line in fh:
+                    yield line.rstrip("\n")
+        return read()
+
+    def _write_name_index(self, names, sig=None):
+        """Atomically (re)write the name index. The signature should be
+        taken before the names were listed, and defaults to now."""
+
+        if any("\n" in x for x in names):
+            debug("Password name with a newline, not writing name index")
+            return
+
+        if sig is None:
+            sig = self._crypto_dir_signature()
+        lines = [sig] + sorted(names)
+        _replace_file(self.name_index_file, "\n".join(lines) + "\n", "w")
+
+    def get_password(self, pwname, testing=False):
+        info("Getting password '%s'" % pwname)
+
+        keycache = self._get_keycache()
+        if keycache is not None:
+            passwd = keycache.get(pwname)
+            if passwd is not None:
+                return passwd
+
+        pw_file = self._find_pass_file(pwname)
+        if pw_file is None:
+            data = self._read_packed(pwname)
+            if data is not None:
+                passwd = _decrypt_data(self.cfg, data)
+            else:
+                # Look again, in case it was just migrated out of the pack
+                pw_file = self._find_pass_file(pwname)
+                if pw_file is None:
+                    raise PassOutError("No password called '%s'" % pwname)
+        if pw_file is not None:
+            passwd = _decrypt_file(self.cfg, pw_file, testing)
+
+        if keycache is not None:
+            keycache.put(pwname, passwd)
+        return passwd
+
+    def _get_keycache(self):
+        """The KeyringCache, or None if the cache is off"""
+
+        if self.cfg["keyring_ttl"] <= 0:
+            return None
+        if self._keycache is None:
+            from passout.keycache import KeyringCache
+            self._keycache = KeyringCache(self.home, self.cfg["keyring_ttl"])
+        return self._keycache
+
+    def flush_cache(self):
+        """Forget every decrypted password in the keyring cache, whether or
+        not it is on, and in a running daemon"""
+
+        from passout import daemon
+        from passout.keycache import KeyringCache
+
+        info("Flushing password caches")
+        daemon.flush(self.sock_file)
+        try:
+            keycache = KeyringCache(self.home, 0)
+        except PassOutError as e:
+            debug("No keyring cache to flush: %s" % e)
+            return
+        keycache.flush()
+
+    def get_passwords(self, pwnames, testing=False, jobs=BATCH_JOBS):
+        """Get many passwords in one call.
+
+        Each password still needs its own gpg, but up to `jobs` of them are
+        run at once on a pool of worker threads. A failure for one name does
+        not stop the others.
+
+        Returns a pair of dicts: name -> password for the successful lookups
+        and name -> PassOutError for the failed ones."""
+
+        pwnames = sorted(set(pwnames))
+        info("Getting %d passwords using %d jobs" % (len(pwnames), jobs))
+
+        def get_one(pwname):
+            try:
+                return pwname, self.get_password(pwname, testing), None
+            except PassOutError as e:
+                return pwname, None, e
+
+        passwds, errors = {}, {}
+        if not pwnames:
+            return passwds, errors
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(jobs, len(pwnames))))
+        try:
+            for pwname, passwd, err in pool.imap_unordered(get_one, pwnames):
+                if err is None:
+                    passwds[pwname] = passwd
+                else:
+                    errors[pwname] = err
+        finally:
+            pool.close()
+            pool.join()
+
+        return passwds, errors
+
+    def grep_passwords(self, pattern, first=False, jobs=BATCH_JOBS,
+                       group=None, testing=False):
+        """Find the passwords whose decrypted contents match a compiled
+        regular expression, decrypting up to `jobs` at once.
+
+        Yields (name, None) for each match as soon as it is found, and
+        (name, PassOutError) for each password that couldn't be decrypted.
+        With `first`, stops after the first match. Plaintexts are only ever
+        held in memory, and are dropped as soon as they have been checked."""
+
+        info("Searching the contents of passwords using %d jobs" % jobs)
+
+        def check(pwname):
+            try:
+                passwd = self.get_password(pwname, testing)
+            except PassOutError as e:
+                return pwname, False, e
+            return pwname, pattern.search(passwd) is not None, None
+
+        pwnames = list(self.iter_password_names(group))
+        if not pwnames:
+            return
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(jobs, len(pwnames))))
+        try:
+            for pwname, matched, err in pool.imap_unordered(check, pwnames):
+                if err is not None:
+                    yield pwname, err
+                elif matched:
+                    yield pwname, None
+                    if first:
+                        break
+        finally:
+            # Drops the passwords not yet started. Those being decrypted
+            # are finished, but nobody looks at them.
+            pool.terminate()
+            pool.join()
+
+    def load_clipboard(self, pw_name, testing=False, passwd=None):
+        """Load all of the clipboards with a password. If the password has
+        already been decrypted, it can be passed in."""
+
+        info("loading clipboards")
+        if passwd is None:
+            passwd = self.get_password(pw_name, testing)
+        for clip in XCLIP_CLIPBOARDS:
+            _load_clipboard(clip, passwd)
+
+        notify_send(self.cfg, "Loaded password '%s' into clipboard" %
+                    pw_name)
+
+    def get_password_names(self):
+        info("Getting list of passwords")
+
+        self._check_dirs()
+        sig = self._crypto_dir_signature()
+        if self._listing is not None and self._listing[0] == sig:
+            return list(self._listing[1])
+
+        names = self._read_name_index(sig)
+        if names is None:
+            info("Rebuilding name index")
+            names = self._scan_password_names()
+            self._write_name_index(names, sig)
+        self._listing = (sig, names)
+        return list(names)
+
+    def iter_password_names(self, group=None, sort=True):
+        """Yield the names of the passwords, or of those in a group.
+
+        Names come straight from the in-memory listing or the name index if
+        either is fresh. Otherwise the store is scanned: sorted names can
+        only be yielded once the scan is done, but unsorted ones are yielded
+        as they are found, so that e.g. a menu can start showing them."""
+
+        info("Streaming list of passwords")
+
+        prefix = group + GROUP_SEP if group else ""
+        self._check_dirs()
+        sig = self._crypto_dir_signature()
+
+        if self._listing is not None and self._listing[0] == sig:
+            names = self._listing[1]
+            if sort:
+                names = sorted(names)
+        else:
+            names = self._iter_name_index(sig)  # which is sorted
+            if names is None and sort:
+                names = sorted(self.get_password_names())
+            elif names is None:
+                names = self._iter_scan_and_index(sig)
+
+        for name in names:
+            if name.startswith(prefix):
+                yield name
+
+    def _iter_scan_and_index(self, sig):
+        """Scan the store, yielding the names as they are found and then
+        saving them in the name index"""
+
+        names = []
+        for name in self._iter_scan():
+            names.append(name)
+            yield name
+        self._write_name_index(names, sig)
+        self._listing = (sig, names)
+
+    def get_password_trie(self):
+        """Returns a NameTrie of the passwords in their groupings"""
+
+        from passout.trie import NameTrie
+
+        info("Getting trie of passwords")
+        return NameTrie(sorted(self.get_password_names()), GROUP_SEP)
+
+    def get_search_index(self):
+        """Returns a NameSearchIndex of the password names, rebuilding the
+        one saved next to the store if it is out of date"""
+
+        from passout.search import NameSearchIndex
+
+        self._check_dirs()
+        sig = self._crypto_dir_signature()
+        index = NameSearchIndex.load(self.search_index_file, sig)
+        if index is None:
+            info("Rebuilding search index")
+            index = NameSearchIndex(self.get_password_names(), GROUP_SEP)
+            index.save(self.search_index_file, sig)
+        return index
+
+    def find_password_names(self, query, limit=None):
+        """Search for passwords whose names match all of the whitespace
+        separated terms of a query. Returns the matching names, best
+        first."""
+
+        info("Searching for passwords matching '%s'" % query)
+        return [name for score, name
+                in self.get_search_index().search(query, limit)]
+
+    def get_password_names_grouped(self, sort=True):
+        """Builds a tree of passwords in their groupings.
+        Returns a dict of the form: Name -> SubItems"""
+
+        info("Getting list of passwords (grouped)")
+        return self.get_password_trie().to_dict(ordered=sort)
+
+    def add_password(self, pw_name, passwd=None, meta=None):
+        """Add a password. Non-secret metadata may be given as a dict of
+        fields, see get_metadata()."""
+
+        import getpass
+
+        info("Adding password '%s'" % pw_name)
+
+        if self._password_exists(pw_name):
+            raise PassOutError("A password called '%s' already exists" %
+                               pw_name)
+
+        if passwd is None:
+            passwd = getpass.getpass()
+
+        with self.transaction() as txn:
+            txn.add(pw_name, passwd, meta)
+
+    def remove_password(self, pw_name):
+        info("Removing password '%s'" % pw_name)
+
+        with self.transaction() as txn:
+            txn.remove(pw_name)
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        """Serialise changes to the store, between threads and processes"""
+
+        import fcntl
+
+        with self._lock:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    @contextlib.contextmanager
+    def transaction(self, jobs=BATCH_JOBS):
+        """Group many adds and removes into one batch:
+
+            with store.transaction() as txn:
+                txn.add("mail__gmail", passwd)
+                txn.remove("mail__old")
+
+        Nothing happens until the block ends (and nothing at all if it
+        raises). The new passwords are then encrypted, up to `jobs` at once,
+        each into a temporary file which is flushed to disk. Then, with the
+        store locked, the batch is checked (new names must not exist, and
+        removed ones must) and applied, and each directory changed is
+        flushed to disk once. A crash part way through applying a batch
+        may leave some of it done, but never a partial password file."""
+
+        txn = Transaction()
+        yield txn
+        if txn.adds or txn.removes:
+            self._commit(txn, jobs)
+
+    def _commit(self, txn, jobs, ciphertexts=None, record=True):
+        """Apply a transaction. Passwords named in the ciphertexts dict
+        were already encrypted by the caller and are used as is. Unless
+        record is set, the caller journals the changes itself."""
+
+        ciphertexts = ciphertexts or {}
+        adding = [x[0] for x in txn.adds]
+        if len(set(adding)) != len(adding) or \
+                len(set(txn.removes)) != len(txn.removes) or \
+                set(adding) & set(txn.removes):
+            raise PassOutError("A password can only be added or removed "
+                               "once in a transaction")
+        for pw_name in adding:
+            if self._password_exists(pw_name):
+                raise PassOutError("A password called '%s' already exists" %
+                                   pw_name)
+
+        cfg = self.cfg
+        packed = cfg["layout"] == "packed"
+        temps = {}  # name -> temporary file or, if packed, ciphertext
+
+        def encrypt_one(add):
+            # Failures are returned, not raised, so that every result is
+            # collected and no temporary file is left behind
+            pw_name, passwd = add[:2]
+            data = ciphertexts.get(pw_name)
+            try:
+                if packed:
+                    if data is None:
+                        data = _encrypt_data(cfg, passwd)
+                    return pw_name, data, None
+                out_dir = os.path.dirname(self._new_pass_file(pw_name))
+                if data is None:
+                    tmp_file = _encrypt_to_temp(cfg, out_dir, passwd)
+                else:
+                    tmp_file = _write_temp(
+                        out_dir, lambda fd: _write_all(fd, data))
+                return pw_name, tmp_file, None
+            except (PassOutError, IOError, OSError) as e:
+                return pw_name, None, e
+
+        try:
+            errors = []
+            if len(txn.adds) <= 1:
+                results = [encrypt_one(x) for x in txn.adds]
+            else:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(max(1, min(jobs, len(txn.adds))))
+                try:
+                    results = pool.imap_unordered(encrypt_one, txn.adds)
+                    results = list(results)
+                finally:
+                    pool.close()
+                    pool.join()
+            for pw_name, temp, err in results:
+                if err is None:
+                    temps[pw_name] = temp
+                else:
+                    errors.append(err)
+            if errors:
+                raise errors[0]
+
+            with self._write_lock():
+                self._apply(txn, temps, record)
+        finally:
+            if not packed:
+                for tmp_file in temps.values():
+                    if os.path.exists(tmp_file):
+                        os.unlink(tmp_file)
+
+        # Don't let a running daemon carry on serving removed passwords
+        if txn.removes:
+            from passout import daemon
+            for pw_name in txn.removes:
+                daemon.evict(pw_name, self.sock_file)
+            pack = self._get_pack()
+            if pack is not None and pack.needs_compaction():
+                pack.compact_in_background()
+
+    def _apply(self, txn, temps, record=True):
+        """Apply a transaction. Call with the write lock held."""
+
+        pack = self._get_pack()
+        removing = []
+        for pw_name in txn.removes:
+            pw_file = self._find_pass_file(pw_name)
+            # Part way through a migration, it may be in the pack too
+            if pw_file is None and (pack is None or pw_name not in pack):
+                raise PassOutError("No password named '%s'" % pw_name)
+            removing.append(pw_file)
+        for pw_name, passwd, meta in txn.adds:
+            if self._password_exists(pw_name):
+                raise PassOutError("A password called '%s' already exists" %
+                                   pw_name)
+
+        added = [x[0] for x in txn.adds]
+        if record:
+            self._record_changes(added, txn.removes)
+
+        names = self._read_name_index()
+        changed_dirs = set()
+
+        for pw_file in removing:
+            if pw_file is not None:
+                os.unlink(pw_file)
+                self._note_store_change(pw_file)
+                changed_dirs.add(os.path.dirname(pw_file))
+
+        puts = []
+        for pw_name, passwd, meta in txn.adds:
+            if self.cfg["layout"] == "packed":
+                puts.append((pw_name, temps[pw_name]))
+            else:
+                out_file = self._get_pass_file(pw_name, self.cfg["layout"])
+                _link_into_place(temps[pw_name], out_file)
+                self._note_store_change(out_file)
+                changed_dirs.add(os.path.dirname(out_file))
+
+        if puts or (pack is not None and txn.removes):
+            self._get_pack(create=True).write_batch(puts, txn.removes)
+
+        # A change in a shard also touched the crypto dir
+        if changed_dirs - set([self.crypto_dir]):
+            changed_dirs.add(self.crypto_dir)
+        for path in changed_dirs:
+            _fsync_dir(path)
+        if record:
+            self._record_changes(added, txn.removes)
+
+        keycache = self._get_keycache()
+        if keycache is not None:
+            for pw_name in txn.removes + [x[0] for x in txn.adds]:
+                keycache.evict(pw_name)
+
+        # If the index was fresh before we started, bring it up to date
+        # rather than have the next listing rescan the whole store.
+        if names is not None:
+            removed = set(txn.removes)
+            self._write_name_index(
+                [x for x in names if x not in removed] +
+                [x[0] for x in txn.adds])
+
+        # Once there is metadata, record when every password was created
+        meta_index = self._get_meta(
+            create=any(meta for pw_name, passwd, meta in txn.adds))
+        if meta_index is not None:
+            for pw_name in txn.removes:
+                meta_index.remove(pw_name)
+            for pw_name, passwd, meta in txn.adds:
+                meta_index.set(pw_name, **(meta or {}))
+
+    def sync_to(self, dest):
+        """Bring a mirror of the store up to date. See journal.sync()."""
+
+        from passout import journal
+        return journal.sync(self, dest)
+
+    def get_metadata(self, pw_name):
+        """The non-secret fields of a password: username, url, tags (a
+        list), created and rotated (seconds since the epoch). Unknown fields
+        are None."""
+
+        if not self._password_exists(pw_name):
+            raise PassOutError("No password named '%s'" % pw_name)
+        meta_index = self._get_meta()
+        fields = meta_index.get(pw_name) if meta_index is not None else None
+        if fields is None:
+            from passout.meta import FIELDS
+            fields = dict((x, None) for x in FIELDS)
+            fields["tags"] = []
+        return fields
+
+    def set_metadata(self, pw_name, **fields):
+        """Set some of the non-secret fields of a password"""
+
+        info("Setting metadata of '%s'" % pw_name)
+        if not self._password_exists(pw_name):
+            raise PassOutError("No password named '%s'" % pw_name)
+        self._get_meta(create=True).set(pw_name, **fields)
+
+    def query_passwords(self, username=None, url=None, tags=(), group=None):
+        """Names of the passwords whose metadata matches all of the given
+        filters, without decrypting anything. See MetaIndex.query()."""
+
+        info("Querying password metadata")
+        meta_index = self._get_meta()
+        if meta_index is None:
+            return []
+        found = meta_index.query(username, url, tags, group, GROUP_SEP)
+        # Leave out any removed behind our back
+        names = set(self.get_password_names())
+        return [x for x in found if x in names]
+
+
+_default_store = None
+
+
+def default_store(cfg=None):
+    """The Store for PASSOUT_HOME, as used by the functions below.
+
+    The store keeps the config it was first given (or the one it read). A
+    call with another config gets a Store of its own using that config, so
+    that one caller can never change the config from under another."""
+
+    global _default_store
+
+    if _default_store is None:
+        _default_store = Store(cfg=cfg)
+    if cfg is None or cfg is _default_store._cfg:
+        return _default_store
+    if _default_store._cfg is None:
+        _default_store.cfg = cfg
+        return _default_store
+    return Store(_default_store.home, cfg)
 
 
 def get_config():
     """ return a configuration (using config file if exists) """
 
-    info("Reading config from '%s'" % CONFIG_FILE)
+    return default_store().load_config()
 
-    _check_dirs()
 
-    # default config
-    # JSON library loads in unicode, so we too use unicode here
-    cfg = {
-        u"gpg":             u"gpg2",
-        u"id":              None,
-        u"clip_clear_time": 5,
-        u"notify_cmd":      u"",
-    }
-
-    if not os.path.exists(CONFIG_FILE):
-        raise PassOutError("Please create the config file '%s'" % CONFIG_FILE)
+def get_password(cfg, pwname, testing=False):
+    return default_store(cfg).get_password(pwname, testing)
 
-    with open(CONFIG_FILE, "r") as fh:
-        new_cfg = json.load(fh)
 
-    cfg.update(new_cfg)
+def get_passwords(cfg, pwnames, testing=False, jobs=BATCH_JOBS):
+    """See Store.get_passwords()"""
 
-    if not cfg["id"]:
-        raise PassOutError("No 'id' in %s" % CONFIG_FILE)
+    return default_store(cfg).get_passwords(pwnames, testing, jobs)
 
-    return cfg
 
+def grep_passwords(cfg, pattern, first=False, jobs=BATCH_JOBS, group=None,
+                   testing=False):
+    """See Store.grep_passwords()"""
 
-def load_clipboard(cfg, pw_name, testing=False):
-    """Load all of the clipboards with a password"""
+    return default_store(cfg).grep_passwords(pattern, first, jobs, group,
+                                             testing)
 
-    info("loading clipboards")
-    passwd = get_password(cfg, pw_name, testing)
-    for clip in XCLIP_CLIPBOARDS:
-        _load_clipboard(clip, passwd)
 
-    notify_send(cfg, "Loaded password '%s' into clipboard" % pw_name)
+def load_clipboard(cfg, pw_name, testing=False, passwd=None):
+    return default_store(cfg).load_clipboard(pw_name, testing, passwd)
 
 
 def get_password_names():
-    info("Getting list of passwords")
+    return default_store().get_password_names()
 
-    _check_dirs()
-    return [x[:-4] for x in os.listdir(CRYPTO_DIR) if x.endswith(".gpg")]
 
+def iter_password_names(group=None, sort=True):
+    return default_store().iter_password_names(group, sort)
 
-def get_password_names_grouped(sort=True):
-    """Builds a tree of passwords in their groupings.
-    Returns a dict of the form: Name -> SubItems"""
-
-    info("Getting list of passwords (grouped)")
-
-    dct = {}
-    for pwname in sorted(get_password_names()):
-        sub = dct
-        elems = pwname.split(GROUP_SEP)
-        for e in elems:
-            if e not in sub:
-                sub[e] = {}
-            sub = sub[e]
-    if not sort:
-        return dct
-    else:
-        return _sort_dict(dct)
 
+def get_password_trie():
+    return default_store().get_password_trie()
 
-def add_password(cfg, pw_name, passwd=None):
-    info("Adding password '%s'" % pw_name)
 
-    out_file = _get_pass_file(pw_name)
-    if os.path.exists(out_file):
-        raise PassOutError("A password called '%s' already exists" % pw_name)
+def get_search_index():
+    return default_store().get_search_index()
 
-    if passwd is None:
-        passwd = getpass.getpass()
 
-    gpg_args = (cfg["gpg"], "-u", cfg["id"], "-e", "-r", cfg["id"])
-    debug("Calling GPG tool with args: %s" % (gpg_args, ))
+def find_password_names(query, limit=None):
+    return default_store().find_password_names(query, limit)
 
-    # We create the file r/w so that automated file synchronisers (e.g.
-    # syncthing) can delete the password files if they so wish.
-    fd = os.open(out_file, os.O_WRONLY | os.O_CREAT,
-                 stat.S_IRUSR | stat.S_IWUSR)
-    try:
-        pipe = subprocess.Popen(
-            gpg_args,  stdin=subprocess.PIPE, stdout=fd,
-            universal_newlines=True
-        )
-    except OSError:
-        os.close(fd)
-        os.unlink(out_file)
-        raise PassOutError("GPG utility '%s' not found" % cfg["gpg"])
 
-    (out, err) = pipe.communicate(passwd)
-    os.close(fd)
+def get_password_names_grouped(sort=True):
+    return default_store().get_password_names_grouped(sort)
 
-    if pipe.returncode != 0:
-        raise PassOutError("gpg returned non-zero")
+
+def add_password(cfg, pw_name, passwd=None, meta=None):
+    return default_store(cfg).add_password(pw_name, passwd, meta)
 
 
 def remove_password(pw_name):
-    info("Removing password '%s'" % pw_name)
+    return default_store().remove_password(pw_name)
+
+
+def get_metadata(pw_name):
+    return default_store().get_metadata(pw_name)
+
+
+def set_metadata(pw_name, **fields):
+    return default_store().set_metadata(pw_name, **fields)
+
+
+def query_passwords(username=None, url=None, tags=(), group=None):
+    return default_store().query_passwords(username, url, tags, group)
+
 
-    pw_file = _get_pass_file(pw_name)
+def sync_to(cfg, dest):
+    return default_store(cfg).sync_to(dest)
 
-    if not os.path.exists(pw_file):
-        raise PassOutError("No password named '%s'" % pw_name)
 
-    os.unlink(pw_file)
+def flush_cache():
+    return default_store().flush_cache()
@@ -0,0 +1,142 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+PassOut for asyncio programs (Python 3.5+ only).
+
+gpg runs as child processes of the event loop, so many lookups can be in
+flight at once without threads or blocking the loop. E.g.:
+
+    store = AsyncPassOut(passout.get_config())
+    passwd = await store.get_password("mail__gmail")
+
+Finding a password's file and reading the pack are a handful of small
+syscalls and are done inline. Adding and removing passwords has to wait
+for the store lock and flush files to disk, so is done in a thread.
+"""
+
+import asyncio
+import locale
+from logging import info, debug
+
+import passout
+from passout import PassOutError, trace
+
+# Most gpg processes to run at once
+DEFAULT_MAX_PROCS = 16
+
+
+class AsyncPassOut(object):
+    """The password functions of the passout module, as coroutines.
+
+    At most max_procs gpg processes are run at once, the rest wait their
+    turn. Cancelling a call kills its gpg."""
+
+    def __init__(self, cfg, max_procs=DEFAULT_MAX_PROCS):
+        self.cfg = cfg
+        self.store = passout.default_store(cfg)
+        self.max_procs = max_procs
+        self._limiter = None
+
+    @property
+    def limiter(self):
+        # Made on first use, so that it belongs to the running loop
+        if self._limiter is None:
+            self._limiter = asyncio.Semaphore(self.max_procs)
+        return self._limiter
+
+    async def _gpg(self, op, args, data=None):
+        """Run gpg, returning its stdout"""
+
+        gpg_args = (self.cfg["gpg"], ) + args
+        debug("Calling GPG tool with args: %s" % (gpg_args, ))
+
+        async with self.limiter:
+            with trace.span("gpg", op=op) as sp:
+                try:
+                    proc = await asyncio.create_subprocess_exec(
+                        *gpg_args, stdin=asyncio.subprocess.PIPE,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE)
+                except OSError:
+                    raise PassOutError("GPG utility '%s' not found" %
+                                       self.cfg["gpg"])
+
+                try:
+                    (out, err) = await proc.communicate(data)
+                except asyncio.CancelledError:
+                    debug("Cancelled, killing gpg")
+                    proc.kill()
+                    await proc.wait()
+                    raise
+                sp.set(rc=proc.returncode)
+
+        if proc.returncode != 0:
+            encoding = locale.getpreferredencoding()
+            raise PassOutError("gpg returned non-zero\nSTDOUT: %s\nSTDERR: %s"
+                               % (out.decode(encoding, "replace"),
+                                  err.decode(encoding, "replace")))
+        return out
+
+    async def get_password(self, pwname):
+        info("Getting password '%s'" % pwname)
+
+        args = ("-u", self.cfg["id"], "--no-tty", "-d")
+        pw_file = self.store._find_pass_file(pwname)
+        if pw_file is not None:
+            out = await self._gpg("decrypt", args + (pw_file, ))
+        else:
+            data = self.store._read_packed(pwname)
+            if data is None:
+                raise PassOutError("No password called '%s'" % pwname)
+            out = await self._gpg("decrypt", args, data)
+        return out.decode(locale.getpreferredencoding())
+
+    async def get_passwords(self, pwnames):
+        """Get many passwords at once. As passout.get_passwords(), returns
+        a dict of the passwords and a dict of the errors, by name."""
+
+        pwnames = sorted(set(pwnames))
+        results = await asyncio.gather(
+            *[self.get_password(x) for x in pwnames], return_exceptions=True)
+
+        passwds, errors = {}, {}
+        for pwname, res in zip(pwnames, results):
+            if isinstance(res, PassOutError):
+                errors[pwname] = res
+            elif isinstance(res, BaseException):
+                raise res
+            else:
+                passwds[pwname] = res
+        return passwds, errors
+
+    async def add_password(self, pw_name, passwd):
+        info("Adding password '%s'" % pw_name)
+
+        if self.store._password_exists(pw_name):
+            raise PassOutError("A password called '%s' already exists" %
+                               pw_name)
+
+        data = await self._gpg(
+            "encrypt", ("-u", self.cfg["id"], "-e", "-r", self.cfg["id"]),
+            passwd.encode(locale.getpreferredencoding()))
+
+        # Written and moved into place as any other transaction
+        txn = passout.Transaction()
+        txn.add(pw_name, passwd)
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.store._commit, txn, 1, {pw_name: data})
+
+    async def remove_password(self, pw_name):
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.store.remove_password, pw_name)
@@ -0,0 +1,523 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+Operations over many passwords at once.
+"""
+
+import collections
+import contextlib
+import csv
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from logging import info, debug
+from multiprocessing.pool import ThreadPool
+
+import passout
+from passout import PassOutError, GROUP_SEP, BATCH_JOBS
+
+IMPORT_FORMATS = ["csv", "jsonl", "pass"]
+REKEY_JOURNAL_MAGIC = "passout-rekey-journal-1"
+# How many entries an import reads and applies at once
+IMPORT_CHUNK = 256
+
+# An entry to import. Either the password is known, or it is a gpg encrypted
+# src_file (as in a 'pass' store). Entries which could not be read have an
+# error instead.
+ImportEntry = collections.namedtuple(
+    "ImportEntry", ["name", "passwd", "src_file", "error"])
+
+
+class BulkResult(object):
+    """The outcome of a bulk operation: the names which were done, those
+    which failed (mapped to a PassOutError) and how long it all took."""
+
+    def __init__(self):
+        self.done = []
+        self.failed = {}
+        self.start_time = time.time()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.time() - self.start_time
+
+    @property
+    def rate(self):
+        """Passwords done per second"""
+        if self.elapsed <= 0:
+            return 0.0
+        return len(self.done) / self.elapsed
+
+    def summary(self, verb):
+        total = len(self.done) + len(self.failed)
+        return "%s %d of %d passwords in %.2fs (%.1f/s)" % \
+            (verb, len(self.done), total, self.elapsed, self.rate)
+
+
+@contextlib.contextmanager
+def _open_source(source):
+    if source == "-":
+        yield sys.stdin
+        return
+    try:
+        fh = open(source, "r")
+    except (IOError, OSError) as e:
+        raise PassOutError("Can't open '%s': %s" % (source, e))
+    with fh:
+        yield fh
+
+
+def read_csv_entries(source, header=False):
+    """Read 'name,password' rows from a CSV file ('-' for stdin). If header
+    is set, the first row holds column names and is skipped."""
+
+    with _open_source(source) as fh:
+        for entry in _csv_entries(fh, header):
+            yield entry
+
+
+def _csv_entries(fh, header):
+    for lineno, row in enumerate(csv.reader(fh), 1):
+        if header and lineno == 1:
+            continue
+        if not row:
+            continue
+        if len(row) != 2:
+            yield ImportEntry("line %d" % lineno, None, None, PassOutError(
+                "Expected 2 CSV fields on line %d" % lineno))
+        else:
+            yield ImportEntry(row[0], row[1], None, None)
+
+
+def read_jsonl_entries(source):
+    """Read {"name": ..., "password": ...} objects, one per line, from a
+    file ('-' for stdin)"""
+
+    with _open_source(source) as fh:
+        for lineno, line in enumerate(fh, 1):
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+                yield ImportEntry(obj["name"], obj["password"], None, None)
+            except (ValueError, KeyError, TypeError):
+                yield ImportEntry(
+                    "line %d" % lineno, None, None, PassOutError(
+                        "Expected a JSON object with a name and password "
+                        "on line %d" % lineno))
+
+
+def read_pass_entries(store_dir):
+    """Find the passwords in a 'pass' store. Sub-directories become groups,
+    so 'mail/gmail.gpg' is imported as 'mail__gmail'. The whole of each
+    file is imported, including any lines after the password."""
+
+    if not os.path.isdir(store_dir):
+        raise PassOutError("'%s' is not a directory" % store_dir)
+
+    for dirpath, dirnames, filenames in os.walk(store_dir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for fname in sorted(filenames):
+            if not fname.endswith(".gpg"):
+                continue
+            src_file = os.path.join(dirpath, fname)
+            rel = os.path.relpath(src_file, store_dir)[:-4]
+            yield ImportEntry(GROUP_SEP.join(rel.split(os.sep)), None,
+                              src_file, None)
+
+
+def read_entries(source, fmt, header=False):
+    if fmt == "csv":
+        return read_csv_entries(source, header)
+    elif fmt == "jsonl":
+        return read_jsonl_entries(source)
+    elif fmt == "pass":
+        return read_pass_entries(source)
+    raise PassOutError("Unknown import format '%s'" % fmt)
+
+
+def _check_name(name):
+    if not name or name.startswith(".") or "/" in name or \
+            (os.altsep and os.altsep in name):
+        raise PassOutError("Invalid password name '%s'" % name)
+
+
+def _run_pool(func, items, jobs, result, on_done=None):
+    """Run func over items on a pool of worker threads, recording each
+    outcome in result. The work is mostly waiting on gpg, so threads are
+    enough to keep many gpg processes busy.
+
+    If given, on_done is called (in the calling thread) with the name of
+    each item as it succeeds."""
+
+    def wrapper(item):
+        name = getattr(item, "name", item)
+        try:
+            return func(item), None
+        except PassOutError as e:
+            return name, e
+        except (IOError, OSError) as e:
+            return name, PassOutError(str(e))
+
+    pool = ThreadPool(max(1, jobs))
+    try:
+        for name, err in pool.imap_unordered(wrapper, items):
+            if err is None:
+                result.done.append(name)
+                if on_done is not None:
+                    on_done(name)
+            else:
+                debug("'%s' failed: %s" % (name, err))
+                result.failed[name] = err
+    finally:
+        pool.close()
+        pool.join()
+    result.finish()
+    return result
+
+
+def _chunks(items, size):
+    """Yield lists of up to size items, reading only one list at a time"""
+
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_passwords(cfg, entries, jobs=BATCH_JOBS, testing=False,
+                     chunk_size=IMPORT_CHUNK):
+    """Encrypt many ImportEntries into the store, up to `jobs` at once.
+
+    The entries are read and applied chunk_size at a time, each chunk as
+    one transaction, so a source of any size can be streamed. Each
+    password file is written atomically, and existing passwords are never
+    overwritten. Returns a BulkResult."""
+
+    info("Importing passwords using %d jobs" % jobs)
+    store = passout.default_store(cfg)
+    store._check_dirs()
+
+    result = BulkResult()
+    for chunk in _chunks(entries, chunk_size):
+        _import_chunk(store, chunk, jobs, testing, result)
+    result.finish()
+    return result
+
+
+def _import_chunk(store, chunk, jobs, testing, result):
+    cfg = store.cfg
+    ciphertexts = {}
+    claimed = set()
+    claim_lock = threading.Lock()
+
+    def encrypt_one(entry):
+        if entry.error is not None:
+            raise entry.error
+        _check_name(entry.name)
+        with claim_lock:
+            if entry.name in claimed or \
+                    store._password_exists(entry.name):
+                raise PassOutError("A password called '%s' already exists" %
+                                   entry.name)
+            claimed.add(entry.name)
+
+        passwd = entry.passwd
+        if passwd is None:
+            passwd = passout._decrypt_file(cfg, entry.src_file, testing)
+        ciphertexts[entry.name] = passout._encrypt_data(cfg, passwd)
+        return entry.name
+
+    encrypted = _run_pool(encrypt_one, chunk, jobs, BulkResult())
+    result.failed.update(encrypted.failed)
+    names = encrypted.done
+    if not names:
+        return
+
+    # Journalled once for the whole chunk, rather than for each password
+    store._record_changes(names)
+    txn = passout.Transaction()
+    for name in names:
+        txn.add(name, None)
+    try:
+        store._commit(txn, jobs, ciphertexts, record=False)
+        result.done.extend(names)
+    except PassOutError:
+        # Something else added one of the names meanwhile. Find out which.
+        for name in names:
+            txn = passout.Transaction()
+            txn.add(name, None)
+            try:
+                store._commit(txn, 1, ciphertexts, record=False)
+                result.done.append(name)
+            except PassOutError as e:
+                result.failed[name] = e
+    store._record_changes(names)
+
+
+def _read_rekey_journal(store, new_id):
+    """Returns the names already re-keyed by an earlier, interrupted run"""
+
+    try:
+        with open(store.rekey_journal_file, "r") as fh:
+            lines = fh.read().split("\n")
+    except (IOError, OSError):
+        return set()
+
+    header = lines[0].split(" ", 1)
+    if header[0] != REKEY_JOURNAL_MAGIC or len(header) != 2:
+        raise PassOutError("Corrupt re-key journal '%s'" %
+                           store.rekey_journal_file)
+    if header[1] != new_id:
+        raise PassOutError(
+            "An unfinished re-key to '%s' exists. Finish it, or remove '%s'"
+            % (header[1], store.rekey_journal_file))
+
+    # A crash mid-write may leave a partial last line, which we ignore
+    return set(lines[1:-1])
+
+
+def _set_config_key(store, key, value):
+    """Change one setting in the config file, keeping everything else"""
+
+    with open(store.config_file, "r") as fh:
+        cfg_json = json.load(fh)
+    cfg_json[key] = value
+
+    tmp_file = "%s.%d" % (store.config_file, os.getpid())
+    with open(tmp_file, "w") as fh:
+        json.dump(cfg_json, fh, indent=4, sort_keys=True)
+    os.rename(tmp_file, store.config_file)
+
+
+def _read_ciphertext(store, name):
+    """Returns the file of a password (None if it is packed) and its
+    ciphertext, or None if there is no such password"""
+
+    pw_file = store._find_pass_file(name)
+    if pw_file is not None:
+        try:
+            with open(pw_file, "rb") as fh:
+                return pw_file, fh.read()
+        except (IOError, OSError):
+            if os.path.exists(pw_file):
+                raise
+    data = store._read_packed(name)
+    return None if data is None else (None, data)
+
+
+def _replace_rekeyed(store, name, current, new_id, testing):
+    """Re-encrypt the ciphertext of a password, as _read_ciphertext()
+    returned it, for new_id. Returns False, leaving the store be, if the
+    password has changed since."""
+
+    cfg = store.cfg
+    pw_file, data = current
+    if pw_file is None:
+        passwd = passout._decrypt_data(cfg, data)
+        data = passout._encrypt_data(cfg, passwd, new_id)
+        with store._write_lock():
+            if _read_ciphertext(store, name) != current:
+                return False
+            store._get_pack().put(name, data, replace=True, sync=True)
+        return True
+
+    passwd = passout._decrypt_file(cfg, pw_file, testing)
+    pw_dir = os.path.dirname(pw_file)
+    tmp_file = passout._encrypt_to_temp(cfg, pw_dir, passwd, new_id)
+    try:
+        with store._write_lock():
+            if _read_ciphertext(store, name) != current:
+                return False
+            os.rename(tmp_file, pw_file)
+            passout._fsync_dir(pw_dir)
+        return True
+    finally:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+
+def rekey_store(cfg, new_id, jobs=BATCH_JOBS, testing=False):
+    """Re-encrypt every password for a new key, up to `jobs` at once.
+
+    Each password is replaced atomically and then recorded in a journal, so
+    an interrupted run can be started again and will skip the passwords
+    already done. A password changed while it was being re-encrypted is
+    done again, and one removed meanwhile is skipped. Once every password
+    is done, the config file is switched to the new key and the journal
+    removed. Returns a BulkResult."""
+
+    info("Re-keying store to '%s' using %d jobs" % (new_id, jobs))
+    store = passout.default_store(cfg)
+    done = _read_rekey_journal(store, new_id)
+    todo = [x for x in store.get_password_names() if x not in done]
+    if done:
+        info("Resuming, %d passwords already done" % len(done))
+
+    if not os.path.exists(store.rekey_journal_file):
+        with open(store.rekey_journal_file, "w") as fh:
+            fh.write("%s %s\n" % (REKEY_JOURNAL_MAGIC, new_id))
+
+    def rekey_one(name):
+        # Encrypt with the store unlocked, then, with it locked, replace the
+        # password only if it is still the one we decrypted.
+        while True:
+            current = _read_ciphertext(store, name)
+            if current is None:
+                info("'%s' was removed, skipping" % name)
+                return name
+            if _replace_rekeyed(store, name, current, new_id, testing):
+                return name
+            debug("'%s' changed while re-keying it, again" % name)
+
+    store._record_changes(todo)
+    with open(store.rekey_journal_file, "a") as journal:
+        def record(name):
+            journal.write(name + "\n")
+            journal.flush()
+
+        result = _run_pool(rekey_one, todo, jobs, BulkResult(), record)
+    store._record_changes(result.done)
+
+    # Every re-keyed password left a dead record behind
+    pack = store._get_pack()
+    if pack is not None and pack.needs_compaction():
+        pack.compact()
+
+    if not result.failed:
+        _set_config_key(store, "id", new_id)
+        cfg["id"] = new_id
+        os.unlink(store.rekey_journal_file)
+    return result
+
+
+def _pack_pass_file(store, name):
+    src_file = store._find_pass_file(name)
+    if src_file is None:
+        return name  # already packed
+    with open(src_file, "rb") as fh:
+        data = fh.read()
+    # If an earlier run died after packing it, this just packs it again. It
+    # must be on disk before the file goes.
+    store._get_pack(create=True).put(name, data, replace=True, sync=True)
+    os.unlink(src_file)
+    store._note_store_change(src_file)
+    return name
+
+
+def _unpack_pass_file(store, name, dst_file):
+    pack = store._get_pack()
+    data = pack.get(name) if pack is not None else None
+    if data is None:
+        raise PassOutError("No password called '%s'" % name)
+
+    # The file must be on disk before the record goes
+    dst_dir = os.path.dirname(dst_file)
+    tmp_file = passout._write_temp(
+        dst_dir, lambda fd: passout._write_all(fd, data))
+    try:
+        os.rename(tmp_file, dst_file)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    passout._fsync_dir(dst_dir)
+    store._note_store_change(dst_file)
+    pack.delete(name)
+    return name
+
+
+def _move_pass_file(store, name, layout):
+    if layout == "packed":
+        return _pack_pass_file(store, name)
+
+    dst_file = store._get_pass_file(name, layout)
+    dst_dir = os.path.dirname(dst_file)
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+
+    src_file = store._find_pass_file(name)
+    if src_file is None:
+        return _unpack_pass_file(store, name, dst_file)
+    if src_file == dst_file:
+        # If an earlier run died after unpacking it, it is still packed
+        pack = store._get_pack()
+        if pack is not None:
+            pack.delete(name)
+        return name
+
+    # Link then unlink, so the password is always somewhere. If an earlier
+    # run died in between, the link is already there.
+    if not os.path.exists(dst_file):
+        os.link(src_file, dst_file)
+    os.unlink(src_file)
+    store._note_store_change(src_file)
+    store._note_store_change(dst_file)
+    return name
+
+
+def _remove_empty_shards(store):
+    for dirpath, dirnames, filenames in os.walk(store.crypto_dir,
+                                                topdown=False):
+        if dirpath != store.crypto_dir and \
+                passout._is_shard_name(os.path.basename(dirpath)):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass  # not empty
+
+
+def migrate_layout(cfg, layout):
+    """Move every password into a new store layout, in place.
+
+    The config file is switched first, so that passwords added meanwhile
+    go straight into the new layout. Each password is then put in its new
+    place before being removed from the old one, with the store locked, so
+    the store can be used throughout and an interrupted run can simply be
+    started again. Returns a BulkResult."""
+
+    if layout not in passout.LAYOUTS:
+        raise PassOutError("Unknown store layout '%s'" % layout)
+    info("Migrating store to the %s layout" % layout)
+
+    store = passout.default_store(cfg)
+    _set_config_key(store, "layout", layout)
+    cfg["layout"] = layout
+
+    result = BulkResult()
+    for name in store._scan_password_names():
+        try:
+            with store._write_lock():
+                # It may have been removed since we looked
+                if store._password_exists(name):
+                    result.done.append(_move_pass_file(store, name, layout))
+        except (IOError, OSError) as e:
+            debug("'%s' failed: %s" % (name, e))
+            result.failed[name] = PassOutError(
+                "Can't move '%s': %s" % (name, e))
+        except PassOutError as e:
+            result.failed[name] = e
+
+    if layout != "sharded":
+        with store._write_lock():
+            _remove_empty_shards(store)
+    pack = store._get_pack()
+    if pack is not None and layout != "packed":
+        pack.compact()  # removes it, if it is now empty
+    result.finish()
+    return result
@@ -0,0 +1,164 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+Owning the X clipboards from within passout, rather than via xclip.
+"""
+
+import os
+import time
+from logging import info, debug
+
+import passout
+from passout import PassOutError, XCLIP_CLIPBOARDS, notify_send
+
+
+class GtkClipboards(object):
+    """Holds a password in all of the X selections from this process.
+
+    Paste requests are answered by GTK itself, so a GTK main loop must be
+    running for as long as the password should be available."""
+
+    def __init__(self, cfg):
+        from gi.repository import Gdk, Gtk
+
+        self.cfg = cfg
+        self.clipboards = [
+            Gtk.Clipboard.get(Gdk.atom_intern(clip.upper(), False))
+            for clip in XCLIP_CLIPBOARDS]
+
+    def load(self, pw_name, passwd):
+        info("Loading clipboards")
+        for clipboard in self.clipboards:
+            clipboard.set_text(passwd, -1)
+        notify_send(self.cfg, "Loaded password '%s' into clipboard" %
+                    pw_name)
+
+    def clear(self, passwd):
+        """Clear the selections still holding a password. Those which have
+        since been taken by something else are left alone."""
+
+        for clipboard in self.clipboards:
+            # While we still own the selection, this doesn't go to X
+            if clipboard.wait_for_text() == passwd:
+                clipboard.clear()
+            else:
+                debug("Clipboard has changed, not clearing")
+        notify_send(self.cfg, "Clipboards cleared")
+
+    def clear_later(self, passwd, secs, then=None):
+        """Clear the selections after a delay without blocking the main
+        loop. The optional callback is run afterwards."""
+
+        from gi.repository import GObject
+
+        def do_clear():
+            self.clear(passwd)
+            if then is not None:
+                then()
+            return False  # don't repeat
+
+        debug("Clearing clipboards in %s second(s)" % secs)
+        GObject.timeout_add_seconds(secs, do_clear)
+
+
+def _gtk_available():
+    if not os.environ.get("DISPLAY"):
+        return False
+    try:
+        import gi
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk
+    except (ImportError, ValueError):
+        return False
+    return Gtk.init_check(None)[0]
+
+
+def _detach_stdio():
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+
+def _own_clipboards(cfg, pw_name, passwd, secs, ready):
+    """Run in the child process. Loads the clipboards, calls ready(), and
+    then keeps hold of the password until it is time to clear it."""
+
+    if _gtk_available():
+        from gi.repository import Gtk
+
+        clipboards = GtkClipboards(cfg)
+        clipboards.load(pw_name, passwd)
+        ready()
+        clipboards.clear_later(passwd, secs, Gtk.main_quit)
+        Gtk.main()
+    else:
+        # xclip forks off its own processes to hold the selections
+        passout.load_clipboard(cfg, pw_name, passwd=passwd)
+        ready()
+        time.sleep(secs)
+        passout.clear_clipboard(cfg, passwd)
+
+
+def clip_in_background(cfg, pw_name, passwd):
+    """Put a password in the clipboards and return once they are loaded.
+    A background process then clears them after 'clip_clear_time' seconds.
+
+    Where possible, the background process owns the selections itself
+    using GTK instead of running xclip for each one."""
+
+    secs = cfg["clip_clear_time"]
+    if secs <= 0:
+        # Nothing to clear, so nothing needs to stick around
+        passout.load_clipboard(cfg, pw_name, passwd=passwd)
+        return
+
+    rd, wr = os.pipe()
+    pid = os.fork()
+    if pid != 0:
+        os.close(wr)
+        with os.fdopen(rd, "rb") as fh:
+            msg = fh.read().decode("utf-8")
+        if msg != "ok":
+            os.waitpid(pid, 0)
+            raise PassOutError(msg or "Clipboard process died")
+        info("Clipboard loaded. Destroying in %s second(s)..." % secs)
+        return
+
+    # Child. Tell the parent how loading went over the pipe, then carry on
+    # in the background, detached from the terminal.
+    os.close(rd)
+    status = 0
+    wr_fh = os.fdopen(wr, "wb")
+
+    def ready():
+        wr_fh.write(b"ok")
+        wr_fh.close()
+        _detach_stdio()
+
+    try:
+        os.setsid()
+        _own_clipboards(cfg, pw_name, passwd, secs, ready)
+    except PassOutError as e:
+        status = 1
+        if not wr_fh.closed:
+            wr_fh.write(e.args[0].encode("utf-8"))
+    except Exception as e:
+        status = 1
+        if not wr_fh.closed:
+            wr_fh.write(("Clipboard process failed: %s" % e).encode("utf-8"))
+    finally:
+        if not wr_fh.closed:
+            wr_fh.close()
+        os._exit(status)
@@ -0,0 +1,252 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+The crypto backends: the ways that passout can have GnuPG encrypt and
+decrypt passwords. The "crypto_backend" config key chooses one.
+
+"subprocess" runs a gpg process for each operation. "gpgme" does the work
+in-process through the GPGME Python bindings (the 'gpg' module), which talk
+to the same gpg-agent, saving a fork/exec and a gpg start up per password.
+"""
+
+import locale
+import os
+import sys
+import threading
+from logging import debug
+
+from passout import PassOutError, trace
+
+
+class SubprocessBackend(object):
+    """Runs gpg (as named by the "gpg" config key) for each operation"""
+
+    def _popen(self, cfg, args, **kwargs):
+        import subprocess
+
+        gpg_args = (cfg["gpg"], ) + tuple(args)
+        debug("Calling GPG tool with args: %s" % (gpg_args, ))
+        try:
+            return subprocess.Popen(gpg_args, **kwargs)
+        except OSError:
+            raise PassOutError("GPG utility '%s' not found" % cfg["gpg"])
+
+    def decrypt_file(self, cfg, pw_file, testing=False):
+        import subprocess
+
+        # Have not found a way for this to work with mutt+msmtp without
+        # using a GUI pinentry. /dev/tty not configured. Annoying XXX
+        #
+        # When we are testing we cannot pass a stdin.
+        # (pytest capture upsets subprocess)
+        if testing:
+            stdin = None
+        else:
+            stdin = sys.stdin
+
+        with trace.span("gpg", op="decrypt") as sp:
+            pipe = self._popen(
+                cfg, ("-u", cfg["id"], "--no-tty", "-d", pw_file),
+                stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+            (out, err) = pipe.communicate()
+            sp.set(rc=pipe.returncode)
+
+        if pipe.returncode != 0:
+            raise PassOutError("gpg returned non-zero\nSTDOUT: %s\nSTDERR: %s"
+                               % (out, err))
+        return out
+
+    def decrypt(self, cfg, data):
+        import subprocess
+
+        with trace.span("gpg", op="decrypt") as sp:
+            pipe = self._popen(
+                cfg, ("-u", cfg["id"], "--no-tty", "-d"),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            (out, err) = pipe.communicate(data)
+            sp.set(rc=pipe.returncode)
+
+        encoding = locale.getpreferredencoding()
+        if pipe.returncode != 0:
+            raise PassOutError("gpg returned non-zero\nSTDOUT: %s\nSTDERR: %s"
+                               % (out.decode(encoding, "replace"),
+                                  err.decode(encoding, "replace")))
+        return out.decode(encoding)
+
+    def encrypt(self, cfg, passwd, recipient):
+        import subprocess
+
+        with trace.span("gpg", op="encrypt") as sp:
+            pipe = self._popen(
+                cfg, ("-u", cfg["id"], "-e", "-r", recipient),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            (out, err) = pipe.communicate(
+                passwd.encode(locale.getpreferredencoding()))
+            sp.set(rc=pipe.returncode)
+
+        if pipe.returncode != 0 or not out:
+            raise PassOutError("gpg returned non-zero")
+        return out
+
+    def encrypt_to_fd(self, cfg, fd, passwd, recipient):
+        import subprocess
+
+        with trace.span("gpg", op="encrypt") as sp:
+            pipe = self._popen(
+                cfg, ("-u", cfg["id"], "-e", "-r", recipient),
+                stdin=subprocess.PIPE, stdout=fd, universal_newlines=True)
+            pipe.communicate(passwd)
+            sp.set(rc=pipe.returncode)
+
+        if pipe.returncode != 0:
+            raise PassOutError("gpg returned non-zero")
+
+
+def _find_executable(name):
+    if os.path.dirname(name):
+        return name
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        full = os.path.join(path, name)
+        if os.access(full, os.X_OK):
+            return full
+    raise PassOutError("GPG utility '%s' not found" % name)
+
+
+def _key_matches(key, recipient):
+    """Does a key's fingerprint, key id or one of its user ids (or their
+    email address) match the recipient exactly?"""
+
+    hex_id = recipient.upper()
+    if hex_id.startswith("0X"):
+        hex_id = hex_id[2:]
+    for subkey in key.subkeys:
+        if hex_id in (subkey.fpr.upper(), subkey.keyid.upper(),
+                      subkey.keyid.upper()[-8:]):
+            return True
+
+    email = recipient.strip("<>").lower()
+    for uid in key.uids:
+        if uid.revoked or uid.invalid:
+            continue
+        if uid.uid == recipient or (uid.email or "").lower() == email:
+            return True
+    return False
+
+
+def _find_key(keys, recipient):
+    """Choose the key to encrypt to from those GPGME listed for the
+    recipient. GPGME matches names by substring, so e.g. 'bob@x.org' also
+    lists 'jimbob@x.org'. Only a usable key matching exactly will do, and
+    there must be only one."""
+
+    found = [x for x in keys
+             if x.can_encrypt and not (x.expired or x.revoked or
+                                       x.disabled or x.invalid) and
+             _key_matches(x, recipient)]
+    if not found:
+        raise PassOutError("No usable GPG key found for '%s'" % recipient)
+    if len(found) > 1:
+        raise PassOutError("More than one GPG key found for '%s': %s" %
+                           (recipient, ", ".join(x.fpr for x in found)))
+    return found[0]
+
+
+class GpgmeBackend(object):
+    """Encrypts and decrypts in-process using the GPGME Python bindings.
+
+    GPGME contexts can't be shared between threads, so each thread gets its
+    own for each gpg binary, along with the recipient keys it looked up."""
+
+    def __init__(self):
+        try:
+            import gpg
+        except ImportError:
+            raise PassOutError("The gpgme crypto backend needs the GPGME "
+                               "Python bindings (the 'gpg' module)")
+        self.gpg = gpg
+        self.local = threading.local()
+
+    def _context(self, cfg):
+        contexts = getattr(self.local, "contexts", None)
+        if contexts is None:
+            contexts = self.local.contexts = {}
+        ctx_keys = contexts.get(cfg["gpg"])
+        if ctx_keys is None:
+            ctx = self.gpg.Context(armor=False)
+            # GPGME would otherwise use whichever gpg it was built against
+            ctx.set_engine_info(self.gpg.constants.protocol.OpenPGP,
+                                file_name=_find_executable(cfg["gpg"]))
+            ctx_keys = contexts[cfg["gpg"]] = (ctx, {})
+        return ctx_keys
+
+    def decrypt_file(self, cfg, pw_file, testing=False):
+        with open(pw_file, "rb") as fh:
+            return self.decrypt(cfg, fh.read())
+
+    def decrypt(self, cfg, data):
+        with trace.span("gpg", op="decrypt") as sp:
+            try:
+                out = self._context(cfg)[0].decrypt(data)[0]
+            except self.gpg.errors.GpgError as e:
+                sp.set(rc=1)
+                raise PassOutError("gpgme failed to decrypt: %s" % e)
+            sp.set(rc=0)
+        return out.decode(locale.getpreferredencoding())
+
+    def encrypt(self, cfg, passwd, recipient):
+        with trace.span("gpg", op="encrypt") as sp:
+            try:
+                ctx, keys = self._context(cfg)
+                if recipient not in keys:
+                    keys[recipient] = [
+                        _find_key(ctx.keylist(recipient), recipient)]
+                out = ctx.encrypt(
+                    passwd.encode(locale.getpreferredencoding()),
+                    recipients=keys[recipient], sign=False)[0]
+            except self.gpg.errors.GpgError as e:
+                sp.set(rc=1)
+                raise PassOutError("gpgme failed to encrypt: %s" % e)
+            sp.set(rc=0)
+        return out
+
+    def encrypt_to_fd(self, cfg, fd, passwd, recipient):
+        data = self.encrypt(cfg, passwd, recipient)
+        while data:
+            data = data[os.write(fd, data):]
+
+
+BACKENDS = {
+    "subprocess": SubprocessBackend,
+    "gpgme": GpgmeBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(cfg):
+    """The crypto backend chosen by a config. Each backend is made once and
+    then shared, so that e.g. GPGME contexts are reused."""
+
+    name = cfg["crypto_backend"]
+    if name not in BACKENDS:
+        raise PassOutError("Unknown crypto backend '%s'" % name)
+
+    with _backends_lock:
+        backend = _backends.get(name)
+        if backend is None:
+            backend = _backends[name] = BACKENDS[name]()
+    return backend
@@ -0,0 +1,270 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+A long running passout process which caches decrypted passwords and serves
+them to other passout processes over a UNIX domain socket.
+
+The protocol is one JSON request line and one JSON response line per
+connection. Requests look like {"op": "get", "name": "..."}, responses like
+{"ok": true, "password": "..."} or {"ok": false, "error": "..."}.
+"""
+
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from logging import info, debug
+
+import passout
+from passout import PassOutError
+
+SOCKET_FILE = os.path.join(passout.PASSOUT_HOME, "passout.sock")
+# How often the server wakes up to expire old passwords (s)
+EXPIRE_INTERVAL = 1
+CLIENT_TIMEOUT = 30
+# How long a client waits on the daemon (s) before acting as if there were
+# none. A get may have to wait for gpg, and so for a pinentry, on a miss.
+REQUEST_TIMEOUT = 2
+GET_TIMEOUT = 60
+
+
+class PasswordCache(object):
+    """A size capped cache of passwords which expire after a TTL.
+
+    When full, the least recently used password is evicted."""
+
+    def __init__(self, ttl, max_size, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # name -> (expiry, passwd)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.pop(name, None)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                return None
+            self.entries[name] = entry  # now most recently used
+            return entry[1]
+
+    def put(self, name, passwd):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(name, None)
+            self.entries[name] = (self.clock() + self.ttl, passwd)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def evict(self, name):
+        with self.lock:
+            return self.entries.pop(name, None) is not None
+
+    def expire(self):
+        now = self.clock()
+        with self.lock:
+            for name, (expiry, passwd) in list(self.entries.items()):
+                if expiry <= now:
+                    del self.entries[name]
+
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def _peer_uid(conn):
+    """The uid of the process at the other end of a UNIX socket, or None if
+    the platform can't tell us"""
+
+    peercred = getattr(socket, "SO_PEERCRED", None)
+    if peercred is None:
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, peercred,
+                            struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+class PassOutDaemon(object):
+    def __init__(self, cfg, sock_file=None, testing=False):
+        self.cfg = cfg
+        self.testing = testing
+        self.sock_file = sock_file or SOCKET_FILE
+        self.cache = PasswordCache(cfg["daemon_ttl"],
+                                   cfg["daemon_cache_size"])
+        self.sock = None
+        self.running = False
+
+    def _bind(self):
+        if os.path.exists(self.sock_file):
+            if ping(self.sock_file):
+                raise PassOutError("A daemon is already listening on '%s'" %
+                                   self.sock_file)
+            debug("Removing stale socket '%s'" % self.sock_file)
+            os.unlink(self.sock_file)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            sock.bind(self.sock_file)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.sock_file, 0o600)
+        sock.listen(16)
+        sock.settimeout(EXPIRE_INTERVAL)
+        self.sock = sock
+
+    def _handle_request(self, req):
+        op = req.get("op")
+        if op == "ping":
+            return {"ok": True}
+        elif op == "get":
+            name = req["name"]
+            passwd = self.cache.get(name)
+            if passwd is None:
+                passwd = passout.get_password(self.cfg, name, self.testing)
+                self.cache.put(name, passwd)
+            else:
+                debug("Cache hit for '%s'" % name)
+            return {"ok": True, "password": passwd}
+        elif op == "evict":
+            self.cache.evict(req["name"])
+            return {"ok": True}
+        elif op == "flush":
+            self.cache.flush()
+            return {"ok": True}
+        raise PassOutError("Unknown daemon request '%s'" % op)
+
+    def _handle_conn(self, conn):
+        try:
+            uid = _peer_uid(conn)
+            if uid is not None and uid != os.getuid():
+                info("Rejecting connection from uid %d" % uid)
+                return
+
+            conn.settimeout(CLIENT_TIMEOUT)
+            fh = conn.makefile("rwb")
+            try:
+                req = json.loads(fh.readline().decode("utf-8"))
+                resp = self._handle_request(req)
+            except PassOutError as e:
+                resp = {"ok": False, "error": e.args[0]}
+            except (ValueError, KeyError, AttributeError):
+                resp = {"ok": False, "error": "Malformed daemon request"}
+            fh.write(json.dumps(resp).encode("utf-8") + b"\n")
+            fh.close()
+        except socket.error as e:
+            debug("Daemon connection error: %s" % e)
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        self._bind()
+        info("Daemon listening on '%s'" % self.sock_file)
+        self.running = True
+        try:
+            while self.running:
+                self.cache.expire()
+                try:
+                    conn, addr = self.sock.accept()
+                except socket.timeout:
+                    continue
+                conn.setblocking(True)
+                thr = threading.Thread(target=self._handle_conn,
+                                       args=(conn, ))
+                thr.daemon = True
+                thr.start()
+        finally:
+            self.cache.flush()
+            self.sock.close()
+            if os.path.exists(self.sock_file):
+                os.unlink(self.sock_file)
+
+    def shutdown(self):
+        self.running = False
+
+
+def _request(req, sock_file=None, timeout=None):
+    """Send a request to the daemon. Returns None if no daemon is running
+    (or it doesn't answer in time), otherwise the response."""
+
+    sock_file = sock_file or SOCKET_FILE
+    if not os.path.exists(sock_file):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout or REQUEST_TIMEOUT)
+    try:
+        sock.connect(sock_file)
+        fh = sock.makefile("rwb")
+        fh.write(json.dumps(req).encode("utf-8") + b"\n")
+        fh.flush()
+        line = fh.readline()
+        fh.close()
+    except socket.error as e:
+        debug("Can't talk to daemon: %s" % e)
+        return None
+    finally:
+        sock.close()
+
+    if not line:
+        return None  # e.g. rejected
+    resp = json.loads(line.decode("utf-8"))
+    if not resp["ok"]:
+        raise PassOutError(resp["error"])
+    return resp
+
+
+def ping(sock_file=None):
+    """Is a daemon running?"""
+
+    return _request({"op": "ping"}, sock_file) is not None
+
+
+def get_password(cfg, pwname, testing=False, sock_file=None):
+    """Get a password from the daemon if one is running, otherwise decrypt
+    it directly."""
+
+    resp = _request({"op": "get", "name": pwname}, sock_file, GET_TIMEOUT)
+    if resp is None:
+        return passout.get_password(cfg, pwname, testing)
+    return resp["password"]
+
+
+def evict(pwname, sock_file=None):
+    """Make a running daemon forget a password"""
+
+    _request({"op": "evict", "name": pwname}, sock_file)
+
+
+def flush(sock_file=None):
+    """Make a running daemon forget all passwords"""
+
+    _request({"op": "flush"}, sock_file)
+
+
+def serve(cfg):
+    d = PassOutDaemon(cfg)
+    try:
+        d.serve_forever()
+    except KeyboardInterrupt:
+        pass
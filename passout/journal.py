@@ -0,0 +1,267 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+The change journal, and syncing a store to a mirror with it.
+
+Every change to the passwords of a store is appended to the journal with a
+sequence number, both before and after it is made. A mirror remembers the
+last change it has seen, so syncing it only has to look at the passwords
+changed since, rather than the whole store.
+
+A mirror is a PassOut home of its own, in the flat layout whatever the
+layout of the store, so that it can be used (or synced on) as it is.
+"""
+
+import contextlib
+import json
+import os
+import uuid
+from logging import info, debug
+
+from passout import PassOutError
+
+JOURNAL_MAGIC = "passout-change-journal-1"
+SYNC_STATE_FILE = "sync_state"
+ADDED = "+"
+REMOVED = "-"
+_TAIL_READ = 4096
+
+
+class Journal(object):
+    """An append-only file of numbered changes. Appends from any process
+    are serialised with a lock on the file itself.
+
+    The first line identifies this journal, so that a mirror synced from a
+    journal which has since been removed (or from another store) can be
+    told apart. Each change is a line of its sequence number, ADDED or
+    REMOVED, and the password name in JSON."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def _locked(self):
+        import fcntl
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+    def _tail(self, fd, size):
+        """The last complete line of the file and the length of the file
+        up to the end of it"""
+
+        at = size
+        chunk = b""
+        while at > 0:
+            step = min(_TAIL_READ, at)
+            at -= step
+            os.lseek(fd, at, os.SEEK_SET)
+            chunk = os.read(fd, step) + chunk
+            end = chunk.rfind(b"\n")
+            if end < 0:
+                continue
+            start = chunk.rfind(b"\n", 0, end) + 1
+            if start > 0 or at == 0:
+                return chunk[start:end].decode("utf-8"), at + end + 1
+        return None, 0
+
+    def record(self, changes):
+        """Append (ADDED or REMOVED, name) pairs"""
+
+        if not changes:
+            return
+        with self._locked() as fd:
+            size = os.fstat(fd).st_size
+            last, end = self._tail(fd, size)
+            if end != size:
+                debug("Removing partial line from change journal")
+                os.ftruncate(fd, end)
+
+            lines = []
+            if last is None:
+                lines.append("%s %s\n" % (JOURNAL_MAGIC, uuid.uuid4().hex))
+                seq = 0
+            elif last.startswith(JOURNAL_MAGIC):
+                seq = 0
+            else:
+                seq = int(last.split(" ", 1)[0])
+            for op, name in changes:
+                seq += 1
+                lines.append("%d %s %s\n" % (seq, op, json.dumps(name)))
+            os.write(fd, "".join(lines).encode("utf-8"))
+            os.fsync(fd)
+
+    def read(self, offset=0):
+        """Returns the id of the journal, and a list of (seq, op, name,
+        offset after) for the changes from offset on. Returns (None, [])
+        if there is no journal."""
+
+        try:
+            fh = open(self.path, "rb")
+        except (IOError, OSError):
+            return None, []
+        with fh:
+            header = fh.readline().decode("utf-8")
+            if not header.startswith(JOURNAL_MAGIC + " "):
+                raise PassOutError("Corrupt change journal '%s'" % self.path)
+            journal_id = header.split(" ", 1)[1].strip()
+
+            changes = []
+            if offset:
+                fh.seek(offset)
+            else:
+                offset = fh.tell()
+            for line in fh:
+                if not line.endswith(b"\n"):
+                    break  # being written, or a crash left it partial
+                offset += len(line)
+                seq, op, name = line.decode("utf-8").rstrip("\n").split(
+                    " ", 2)
+                changes.append((int(seq), op, json.loads(name), offset))
+        return journal_id, changes
+
+
+class SyncResult(object):
+    """What a sync did: the passwords copied and removed, the last change
+    synced and whether it had to compare the whole store"""
+
+    def __init__(self, seq, full):
+        self.seq = seq
+        self.full = full
+        self.copied = []
+        self.removed = []
+
+    def summary(self, dest):
+        how = "Fully synced" if self.full else "Synced"
+        return "%s '%s': %d copied, %d removed, up to change %d" % \
+            (how, dest, len(self.copied), len(self.removed), self.seq)
+
+
+def _write_file(path, data):
+    """Atomically (re)write a file, flushed to disk, unless it already
+    holds the data. Leaving it alone keeps its mtime, so that e.g. rsync
+    doesn't look at it again. Returns True if the file was written."""
+
+    try:
+        with open(path, "rb") as fh:
+            if fh.read() == data:
+                return False
+    except (IOError, OSError):
+        pass
+
+    tmp_file = "%s.%d.tmp" % (path, os.getpid())
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+    return True
+
+
+def _read_sync_state(dest):
+    try:
+        with open(os.path.join(dest, SYNC_STATE_FILE), "r") as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _sync_name(store, mirror, name, result):
+    """Make the mirror's copy of a password match the store"""
+
+    mirror_file = mirror._get_pass_file(name)
+    pw_file = store._find_pass_file(name)
+    if pw_file is not None:
+        with open(pw_file, "rb") as fh:
+            data = fh.read()
+    else:
+        data = store._read_packed(name)
+
+    if data is None:
+        if os.path.exists(mirror_file):
+            os.unlink(mirror_file)
+            result.removed.append(name)
+        return
+
+    if _write_file(mirror_file, data):
+        result.copied.append(name)
+
+
+def sync(store, dest):
+    """Bring the mirror at dest up to date with a Store. Returns a
+    SyncResult.
+
+    Only the passwords named in the changes since the mirror was last
+    synced are looked at. If the mirror has not been synced from this
+    journal before, every password is compared."""
+
+    from passout import Store
+
+    info("Syncing to '%s'" % dest)
+    if os.path.abspath(dest) == os.path.abspath(store.home):
+        raise PassOutError("Can't sync a store to itself")
+    if not os.path.isdir(dest):
+        os.mkdir(dest)
+
+    # Changes made while we are reading will be synced next time
+    journal = store._get_journal()
+    state = _read_sync_state(dest)
+    full = True
+    if state is not None:
+        journal_id, changes = journal.read(state["offset"])
+        full = journal_id != state["journal"]
+        seq, offset = state["seq"], state["offset"]
+    if full:
+        journal_id, changes = journal.read()
+        seq, offset = 0, 0
+    if changes:
+        seq, offset = changes[-1][0], changes[-1][3]
+
+    mirror = Store(dest, store.cfg)
+    mirror._check_dirs()
+    result = SyncResult(seq, full)
+    if full:
+        names = set(store._scan_password_names())
+        for entry in os.listdir(mirror.crypto_dir):
+            if entry.endswith(".gpg"):
+                names.add(entry[:-4])
+    else:
+        names = set(x[2] for x in changes)
+    for name in sorted(names):
+        _sync_name(store, mirror, name, result)
+
+    # The mirror is a flat store with the same config otherwise
+    cfg = dict(store.cfg)
+    cfg["layout"] = "flat"
+    _write_file(mirror.config_file,
+                json.dumps(cfg, indent=4, sort_keys=True).encode("utf-8"))
+
+    from passout import _fsync_dir
+    _fsync_dir(mirror.crypto_dir)
+    if journal_id is not None:
+        _write_file(os.path.join(dest, SYNC_STATE_FILE), json.dumps(
+            {"journal": journal_id, "seq": seq, "offset": offset}).encode(
+                "utf-8"))
+    return result
@@ -0,0 +1,155 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+Caching decrypted passwords in the Linux kernel keyring (via libkeyutils).
+
+Each store gets a keyring of its own, linked into the session keyring (or,
+if there is no session, the user's default session keyring). Each password
+is a "user" key in it, which the kernel destroys once its timeout passes.
+The keys can only be read by processes which possess the keyring, i.e. the
+processes of your session.
+"""
+
+import ctypes
+import ctypes.util
+import os
+from logging import debug
+
+from passout import PassOutError
+
+KEY_SPEC_SESSION_KEYRING = -3
+# The most a "user" key can hold
+MAX_PAYLOAD = 32767
+
+_libkeyutils = None
+
+
+def _lib():
+    global _libkeyutils
+
+    if _libkeyutils is not None:
+        return _libkeyutils
+
+    path = ctypes.util.find_library("keyutils")
+    if path is None:
+        raise PassOutError("The keyring cache needs libkeyutils")
+    lib = ctypes.CDLL(path, use_errno=True)
+
+    serial, c_str = ctypes.c_int32, ctypes.c_char_p
+    for func, restype, argtypes in [
+            ("add_key", serial,
+             [c_str, c_str, ctypes.c_void_p, ctypes.c_size_t, serial]),
+            ("keyctl_get_keyring_ID", serial, [serial, ctypes.c_int]),
+            ("keyctl_search", ctypes.c_long, [serial, c_str, c_str, serial]),
+            ("keyctl_read", ctypes.c_long,
+             [serial, ctypes.c_void_p, ctypes.c_size_t]),
+            ("keyctl_set_timeout", ctypes.c_long, [serial, ctypes.c_uint]),
+            ("keyctl_invalidate", ctypes.c_long, [serial])]:
+        getattr(lib, func).restype = restype
+        getattr(lib, func).argtypes = argtypes
+    _libkeyutils = lib
+    return lib
+
+
+def _check(ret, what):
+    if ret < 0:
+        errno = ctypes.get_errno()
+        raise PassOutError("Can't %s: %s" % (what, os.strerror(errno)))
+    return ret
+
+
+def _bytes(s):
+    return s if isinstance(s, bytes) else s.encode("utf-8")
+
+
+class KeyringCache(object):
+    """The decrypted passwords of the store in `home`, each kept for `ttl`
+    seconds"""
+
+    def __init__(self, home, ttl):
+        self.lib = _lib()
+        self.ring_desc = _bytes("passout:%s" % os.path.abspath(home))
+        self.ttl = ttl
+
+    def _ring(self, create=False):
+        """Our keyring, or None if there isn't one (and create is False)"""
+
+        # Without a session, this is the user's session keyring. Asking for
+        # the session keyring itself would give this process a new, empty
+        # one.
+        session = self.lib.keyctl_get_keyring_ID(KEY_SPEC_SESSION_KEYRING, 0)
+        _check(session, "find the session keyring")
+        ring = self.lib.keyctl_search(session, b"keyring", self.ring_desc, 0)
+        if ring >= 0 or not create:
+            return ring if ring >= 0 else None
+        return _check(self.lib.add_key(b"keyring", self.ring_desc, None, 0,
+                                       session), "make a keyring")
+
+    def _find(self, name):
+        ring = self._ring()
+        if ring is None:
+            return None
+        key = self.lib.keyctl_search(ring, b"user", _bytes(name), 0)
+        return key if key >= 0 else None
+
+    def get(self, name):
+        """The cached password, or None"""
+
+        key = self._find(name)
+        if key is None:
+            return None
+        buf = ctypes.create_string_buffer(MAX_PAYLOAD)
+        try:
+            size = self.lib.keyctl_read(key, buf, MAX_PAYLOAD)
+            if size < 0:
+                return None  # e.g. it expired since we found it
+            debug("Keyring cache hit for '%s'" % name)
+            return buf.raw[:size].decode("utf-8")
+        finally:
+            ctypes.memset(buf, 0, MAX_PAYLOAD)
+
+    def put(self, name, passwd):
+        """Cache a password, if we can. A full keyring (the kernel's quota
+        is small) just means the password isn't cached."""
+
+        payload = _bytes(passwd)
+        if len(payload) > MAX_PAYLOAD:
+            return
+        try:
+            key = _check(self.lib.add_key(b"user", _bytes(name), payload,
+                                          len(payload),
+                                          self._ring(create=True)),
+                         "add a key")
+        except PassOutError as e:
+            debug("Not caching '%s': %s" % (name, e))
+            return
+        try:
+            _check(self.lib.keyctl_set_timeout(key, self.ttl),
+                   "set a key timeout")
+        except PassOutError as e:
+            # A key which never expires is worse than no key
+            debug("Not caching '%s': %s" % (name, e))
+            self.lib.keyctl_invalidate(key)
+
+    def evict(self, name):
+        key = self._find(name)
+        if key is not None:
+            self.lib.keyctl_invalidate(key)
+
+    def flush(self):
+        """Forget every password of the store"""
+
+        ring = self._ring()
+        if ring is not None:
+            _check(self.lib.keyctl_invalidate(ring), "remove the keyring")
@@ -0,0 +1,152 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+The metadata index: non-secret fields of passwords (user name, URL, tags and
+when the password was created and last rotated), kept unencrypted in an
+SQLite database next to the crypto store.
+
+This lets passwords be found by what they are for without decrypting any of
+them. Nothing secret may go in here.
+"""
+
+import contextlib
+import sqlite3
+import threading
+import time
+from logging import debug
+
+from passout import PassOutError
+
+FIELDS = ["username", "url", "tags", "created", "rotated"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    username TEXT,
+    url TEXT,
+    created INTEGER,
+    rotated INTEGER
+);
+CREATE TABLE IF NOT EXISTS tags (
+    name TEXT NOT NULL REFERENCES meta(name) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (name, tag)
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag);
+"""
+
+
+class MetaIndex(object):
+    """The metadata of the passwords in a store, by name.
+
+    Fields are None when not set, except tags, which is a (maybe empty)
+    sorted list. Times are seconds since the epoch. The one connection is
+    shared between threads, with a lock around its use."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA foreign_keys = ON")
+            self.db.executescript(_SCHEMA)
+        except sqlite3.Error as e:
+            raise PassOutError("Can't open metadata index '%s': %s" %
+                               (path, e))
+
+    def close(self):
+        self.db.close()
+
+    @contextlib.contextmanager
+    def _locked(self, what):
+        """Hold the lock, turning SQLite errors into PassOutErrors"""
+
+        with self.lock:
+            try:
+                yield
+            except sqlite3.Error as e:
+                raise PassOutError("Can't %s in metadata index '%s': %s" %
+                                   (what, self.path, e))
+
+    def get(self, name):
+        """The fields of a password, or None if it has no metadata"""
+
+        with self._locked("read metadata"):
+            row = self.db.execute(
+                "SELECT username, url, created, rotated FROM meta "
+                "WHERE name = ?", (name, )).fetchone()
+            if row is None:
+                return None
+            tags = [x[0] for x in self.db.execute(
+                "SELECT tag FROM tags WHERE name = ? ORDER BY tag", (name, ))]
+        return dict(username=row[0], url=row[1], tags=tags, created=row[2],
+                    rotated=row[3])
+
+    def set(self, name, **fields):
+        """Set some of the fields of a password, leaving the others be. A
+        password new to the index is taken to have been created now."""
+
+        for field in fields:
+            if field not in FIELDS:
+                raise PassOutError("Unknown metadata field '%s'" % field)
+        debug("Setting metadata of '%s': %s" % (name, sorted(fields)))
+
+        with self._locked("set metadata"), self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO meta (name, created) VALUES (?, ?)",
+                (name, int(time.time())))
+            for field in ("username", "url", "created", "rotated"):
+                if field in fields:
+                    self.db.execute(
+                        "UPDATE meta SET %s = ? WHERE name = ?" % field,
+                        (fields[field], name))
+            if "tags" in fields:
+                self.db.execute("DELETE FROM tags WHERE name = ?", (name, ))
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO tags (name, tag) VALUES (?, ?)",
+                    [(name, tag) for tag in fields["tags"]])
+
+    def remove(self, name):
+        with self._locked("remove metadata"), self.db:
+            self.db.execute("DELETE FROM meta WHERE name = ?", (name, ))
+
+    def query(self, username=None, url=None, tags=(), group=None,
+              group_sep="__"):
+        """Names of the passwords whose metadata matches all of the given
+        filters, sorted. username and url are shell style patterns (e.g.
+        "*.example.com"), matched case insensitively. A password must have
+        every one of the tags."""
+
+        where, args = [], []
+        if username is not None:
+            where.append("lower(username) GLOB lower(?)")
+            args.append(username)
+        if url is not None:
+            where.append("lower(url) GLOB lower(?)")
+            args.append(url)
+        for tag in tags:
+            where.append("name IN (SELECT name FROM tags WHERE tag = ?)")
+            args.append(tag)
+        if group:
+            # Not GLOB or LIKE, as a group name may hold their wildcards
+            prefix = group + group_sep
+            where.append("substr(name, 1, ?) = ?")
+            args.extend([len(prefix), prefix])
+
+        sql = "SELECT name FROM meta"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY name"
+        with self._locked("query metadata"):
+            return [x[0] for x in self.db.execute(sql, args)]
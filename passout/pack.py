@@ -0,0 +1,501 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+The packed store: every password in one file, rather than a file each.
+
+The pack is a header followed by records, each of which either sets the
+ciphertext of a password or removes it. Records are only ever appended, so
+nothing a reader has seen changes under it. The index maps each name to its
+latest record as of some length of the pack, so that only the records added
+since need to be read. Both are memory-mapped.
+
+Once enough of the pack is dead records, it is compacted by writing a new
+pack of just the live records and renaming it into place.
+"""
+
+import contextlib
+import mmap
+import os
+import struct
+import sys
+import threading
+from logging import info, debug
+
+import passout
+from passout import PassOutError
+
+PACK_MAGIC = b"passout-pack-1\n"
+PACK_INDEX_MAGIC = b"POPKIX01"
+PACK_INDEX_FILE = os.path.join(passout.PASSOUT_HOME, "pack_index")
+PACK_LOCK_FILE = os.path.join(passout.PASSOUT_HOME, "pack.lock")
+# The index is rewritten once more than this many records, or one in this
+# many of the live passwords, have been added since it was written.
+INDEX_TAIL_MIN = 1000
+INDEX_TAIL_RATIO = 16
+# Compact once at least this many bytes, and half of the pack, are dead
+COMPACT_MIN_DEAD = 64 * 1024
+
+_PUT = b"+"
+_DEL = b"-"
+# Kind, name length, ciphertext length. Then the name and the ciphertext.
+_RECORD = struct.Struct("<cHI")
+# Magic, pack inode, pack length indexed, dead bytes, names, names length.
+# Then arrays of the name starts, record offsets and lengths, and the names.
+_INDEX_HEADER = struct.Struct("<8sQQQQQ")
+_WORD = struct.Struct("<q")
+
+
+def _name_bytes(name):
+    if not isinstance(name, bytes):
+        name = name.encode("utf-8")
+    if not name or b"\n" in name:
+        raise PassOutError("Invalid password name '%s'" % name)
+    return name
+
+
+def _words(values):
+    return struct.pack("<%dq" % len(values), *values)
+
+
+def _write_index(path, pack_ino, indexed, dead, entries):
+    """Atomically write an index of sorted (name, offset, length) entries"""
+
+    starts = [0]
+    for name, offset, length in entries:
+        starts.append(starts[-1] + len(name) + 1)
+    blob = b"".join(name + b"\n" for name, offset, length in entries)
+
+    tmp_file = "%s.%d" % (path, os.getpid())
+    with open(tmp_file, "wb") as fh:
+        fh.write(_INDEX_HEADER.pack(PACK_INDEX_MAGIC, pack_ino, indexed,
+                                    dead, len(entries), len(blob)))
+        fh.write(_words(starts))
+        fh.write(_words([x[1] for x in entries]))
+        fh.write(_words([x[2] for x in entries]))
+        fh.write(blob)
+    os.rename(tmp_file, path)
+
+
+class _Index(object):
+    """A memory-mapped index, searched in place"""
+
+    def __init__(self, mm):
+        self.mm = mm
+        (magic, self.pack_ino, self.indexed, self.dead, self.count,
+         self.blob_len) = _INDEX_HEADER.unpack_from(mm, 0)
+        self.starts_at = _INDEX_HEADER.size
+        self.offsets_at = self.starts_at + (self.count + 1) * _WORD.size
+        self.lengths_at = self.offsets_at + self.count * _WORD.size
+        self.blob_at = self.lengths_at + self.count * _WORD.size
+
+    @classmethod
+    def load(cls, path, pack_ino):
+        """Returns None if the index is missing, corrupt or for another
+        pack (e.g. one since compacted)"""
+
+        try:
+            with open(path, "rb") as fh:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if len(mm) < _INDEX_HEADER.size or \
+                mm[:len(PACK_INDEX_MAGIC)] != PACK_INDEX_MAGIC:
+            mm.close()
+            return None
+        index = cls(mm)
+        if index.pack_ino != pack_ino or \
+                len(mm) != index.blob_at + index.blob_len:
+            mm.close()
+            return None
+        return index
+
+    def close(self):
+        self.mm.close()
+
+    def _word(self, at, i):
+        return _WORD.unpack_from(self.mm, at + i * _WORD.size)[0]
+
+    def _name(self, i):
+        start = self.blob_at + self._word(self.starts_at, i)
+        end = self.blob_at + self._word(self.starts_at, i + 1) - 1
+        return self.mm[start:end]
+
+    def find(self, name):
+        """Binary search for a name. Returns (offset, length) or None."""
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._name(lo) == name:
+            return (self._word(self.offsets_at, lo),
+                    self._word(self.lengths_at, lo))
+        return None
+
+    def names(self):
+        return self.mm[self.blob_at:self.blob_at + self.blob_len] \
+            .split(b"\n")[:-1]
+
+    def items(self):
+        """Returns (name, offset, length) for every entry"""
+
+        unpack = struct.Struct("<%dq" % self.count).unpack_from
+        return zip(self.names(), unpack(self.mm, self.offsets_at),
+                   unpack(self.mm, self.lengths_at))
+
+
+class _View(object):
+    """The pack as it was when we last looked: the index, plus the records
+    after it (the tail)"""
+
+    def __init__(self, pack_file, index_file):
+        self.fh = open(pack_file, "rb")
+        self.ino = os.fstat(self.fh.fileno()).st_ino
+        self.map = None
+        self.size = 0  # how much of the pack we have mapped
+        self.tail = {}  # name -> (offset, length), or None if removed
+
+        self.index = _Index.load(index_file, self.ino)
+        if self.index is not None:
+            self.end = self.index.indexed  # end of the last whole record
+            self.dead = self.index.dead
+            self.live = self.index.count
+        else:
+            self.end = len(PACK_MAGIC)
+            self.dead = 0
+            self.live = 0
+        self.extend()
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+        if self.map is not None:
+            self.map.close()
+        self.fh.close()
+
+    def extend(self):
+        """Read the records appended since we last looked"""
+
+        size = os.fstat(self.fh.fileno()).st_size
+        if size == self.size:
+            return
+        if size < self.end:
+            raise PassOutError("Pack '%s' has been truncated" % self.fh.name)
+
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fh.fileno(), size, access=mmap.ACCESS_READ)
+        if self.size == 0 and self.map[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise PassOutError("'%s' is not a passout pack" % self.fh.name)
+        self.size = size
+
+        pos = self.end
+        while pos + _RECORD.size <= size:
+            kind, name_len, data_len = _RECORD.unpack_from(self.map, pos)
+            name_at = pos + _RECORD.size
+            rec_end = name_at + name_len + data_len
+            if rec_end > size:
+                break  # still being written, or the writer died
+            self._apply(kind, self.map[name_at:name_at + name_len],
+                        name_at + name_len, data_len)
+            pos = rec_end
+        self.end = pos
+
+    def _apply(self, kind, name, offset, length):
+        old = self.lookup(name)
+        if old is not None:
+            self.dead += _RECORD.size + len(name) + old[1]
+            self.live -= 1
+        if kind == _PUT:
+            self.tail[name] = (offset, length)
+            self.live += 1
+        elif kind == _DEL:
+            self.dead += _RECORD.size + len(name)
+            self.tail[name] = None
+        else:
+            raise PassOutError("Corrupt record in pack '%s'" % self.fh.name)
+
+    def lookup(self, name):
+        if name in self.tail:
+            return self.tail[name]
+        if self.index is not None:
+            return self.index.find(name)
+        return None
+
+    def read(self, name):
+        loc = self.lookup(name)
+        if loc is None:
+            return None
+        return self.map[loc[0]:loc[0] + loc[1]]
+
+    def names(self):
+        names = set(self.index.names()) if self.index is not None else set()
+        for name, loc in self.tail.items():
+            if loc is None:
+                names.discard(name)
+            else:
+                names.add(name)
+        return names
+
+    def items(self):
+        """Returns (name, offset, length) for every live password, sorted
+        by name"""
+
+        locs = dict((name, (offset, length)) for name, offset, length
+                    in (self.index.items() if self.index else []))
+        locs.update(self.tail)
+        return sorted((name, loc[0], loc[1]) for name, loc in locs.items()
+                      if loc is not None)
+
+
+class PackStore(object):
+    """Passwords in a pack file.
+
+    Reads take no locks. Writes from any process are serialised by a lock
+    file, and within this process by a mutex which also guards the view."""
+
+    def __init__(self, pack_file=None, index_file=None, lock_file=None):
+        self.pack_file = pack_file or passout.PACK_FILE
+        self.index_file = index_file or PACK_INDEX_FILE
+        self.lock_file = lock_file or PACK_LOCK_FILE
+        self.lock = threading.Lock()
+        self.view = None
+
+    def _get_view(self):
+        """Bring the view up to date. Call with self.lock held. Returns
+        None if there is no pack."""
+
+        try:
+            ino = os.stat(self.pack_file).st_ino
+        except OSError:
+            ino = None
+        if self.view is not None and self.view.ino != ino:
+            self.view.close()
+            self.view = None
+
+        if ino is None:
+            return None
+        elif self.view is None:
+            self.view = _View(self.pack_file, self.index_file)
+        else:
+            self.view.extend()
+        return self.view
+
+    def __contains__(self, name):
+        name = _name_bytes(name)
+        with self.lock:
+            view = self._get_view()
+            return view is not None and view.lookup(name) is not None
+
+    def __len__(self):
+        with self.lock:
+            view = self._get_view()
+            return 0 if view is None else view.live
+
+    def get(self, name):
+        """The ciphertext of a password, or None if there is no such
+        password"""
+
+        name = _name_bytes(name)
+        with self.lock:
+            view = self._get_view()
+            return None if view is None else view.read(name)
+
+    def names(self):
+        with self.lock:
+            view = self._get_view()
+            if view is None:
+                return []
+            return [x.decode("utf-8") for x in view.names()]
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        import fcntl
+
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with self.lock:
+                yield
+        finally:
+            os.close(fd)
+
+    def _create(self):
+        tmp_file = "%s.%d" % (self.pack_file, os.getpid())
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, PACK_MAGIC)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_file, self.pack_file)
+        passout._fsync_dir(os.path.dirname(self.pack_file))
+
+    def _append(self, view, record, sync=False):
+        """Append one or more records. Call with the write lock held."""
+
+        fd = os.open(self.pack_file, os.O_WRONLY | os.O_APPEND)
+        try:
+            if view.size != view.end:
+                debug("Removing partial record from pack")
+                os.ftruncate(fd, view.end)
+            if os.write(fd, record) != len(record):
+                raise PassOutError("Short write to pack '%s'" %
+                                   self.pack_file)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        view.extend()
+
+        if len(view.tail) > max(INDEX_TAIL_MIN,
+                                view.live // INDEX_TAIL_RATIO):
+            debug("Rewriting pack index")
+            _write_index(self.index_file, view.ino, view.end, view.dead,
+                         view.items())
+            # Start again from the new index, with an empty tail
+            view.close()
+            self.view = None
+
+    def put(self, name, data, replace=False, sync=False):
+        """Store the ciphertext of a password. Unless replace is set, an
+        existing password of the same name is an error. If sync is set, it
+        is flushed to disk before returning."""
+
+        bname = _name_bytes(name)
+        with self._write_lock():
+            if not os.path.exists(self.pack_file):
+                self._create()
+            view = self._get_view()
+            if not replace and view.lookup(bname) is not None:
+                raise PassOutError("A password called '%s' already exists" %
+                                   name)
+            self._append(view, _RECORD.pack(_PUT, len(bname), len(data)) +
+                         bname + data, sync)
+
+    def delete(self, name):
+        """Remove a password. Returns False if there was no such password."""
+
+        bname = _name_bytes(name)
+        with self._write_lock():
+            view = self._get_view()
+            if view is None or view.lookup(bname) is None:
+                return False
+            self._append(view, _RECORD.pack(_DEL, len(bname), 0) + bname)
+        return True
+
+    def write_batch(self, puts, deletes):
+        """Add (name, ciphertext) pairs and remove names in one append,
+        flushed to disk before returning. An existing password of the same
+        name as one being put is an error, unless it is also being
+        removed."""
+
+        puts = [(_name_bytes(name), data) for name, data in puts]
+        deletes = set(_name_bytes(name) for name in deletes)
+        with self._write_lock():
+            if puts and not os.path.exists(self.pack_file):
+                self._create()
+            view = self._get_view()
+            if view is None:
+                return
+            records = []
+            for bname in deletes:
+                if view.lookup(bname) is not None:
+                    records.append(_RECORD.pack(_DEL, len(bname), 0) + bname)
+            for bname, data in puts:
+                if bname not in deletes and view.lookup(bname) is not None:
+                    raise PassOutError(
+                        "A password called '%s' already exists" %
+                        bname.decode("utf-8"))
+                records.append(_RECORD.pack(_PUT, len(bname), len(data)) +
+                               bname + data)
+            if records:
+                self._append(view, b"".join(records), sync=True)
+
+    def needs_compaction(self):
+        with self.lock:
+            view = self._get_view()
+            return view is not None and view.dead >= COMPACT_MIN_DEAD and \
+                view.dead * 2 >= view.size
+
+    def compact(self):
+        """Rewrite the pack with only the live records. An empty pack is
+        removed altogether."""
+
+        with self._write_lock():
+            view = self._get_view()
+            if view is None:
+                return
+            items = view.items()
+            info("Compacting pack of %d passwords" % len(items))
+
+            if not items:
+                for path in (self.pack_file, self.index_file):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                return
+
+            tmp_file = "%s.%d" % (self.pack_file, os.getpid())
+            entries = []
+            with open(tmp_file, "wb") as fh:
+                fh.write(PACK_MAGIC)
+                for name, offset, length in items:
+                    fh.write(_RECORD.pack(_PUT, len(name), length) + name)
+                    entries.append((name, fh.tell(), length))
+                    fh.write(view.map[offset:offset + length])
+                size = fh.tell()
+                ino = os.fstat(fh.fileno()).st_ino
+                fh.flush()
+                os.fsync(fh.fileno())
+
+            # Readers notice the new inode, and ignore the old index until
+            # the new one is in place.
+            os.rename(tmp_file, self.pack_file)
+            passout._fsync_dir(os.path.dirname(self.pack_file))
+            _write_index(self.index_file, ino, size, 0, entries)
+
+    def compact_in_background(self):
+        """Compact in a detached process, so that nobody waits for it.
+
+        The process is a fresh Python running this module rather than a
+        fork() of us: we may have threads, and a forked child could deadlock
+        on a lock one of them held."""
+
+        import subprocess
+
+        pkg_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(passout.__file__)))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [pkg_dir] + [x for x in [env.get("PYTHONPATH")] if x])
+        kwargs = {}
+        if sys.version_info >= (3, 2):
+            kwargs["start_new_session"] = True
+
+        debug("Starting background compaction of '%s'" % self.pack_file)
+        with open(os.devnull, "r+b") as devnull:
+            subprocess.Popen(
+                [sys.executable, "-m", "passout.pack", self.pack_file,
+                 self.index_file, self.lock_file],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, env=env, **kwargs)
+
+
+if __name__ == "__main__":
+    # Used by PackStore.compact_in_background()
+    PackStore(*sys.argv[1:4]).compact()
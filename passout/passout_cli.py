@@ -14,23 +14,147 @@
 # OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
 # CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-import __init__ as passout
+# Keep imports to a minimum here, they cost every command start up time.
+# Anything only needed by one command is imported by that command.
 import argparse
 import argspander
-import json
-import time
-from logging import info
+import os
+import sys
+
+if __name__ == "__main__":
+    # Run from the source tree (e.g. by the tests). Make sure that the
+    # passout package next to us is the one that gets imported.
+    sys.path.insert(
+        0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if True:
+    import passout  # work around PEP8, sigh
+
+
+@argspander.expand
+def cmd_ls(null, group, unsorted):
+    end = "\0" if null else "\n"
+    for p in passout.iter_password_names(group, sort=not unsorted):
+        sys.stdout.write(p + end)
 
 
 @argspander.expand
-def cmd_ls(*args, **kwargs):
-    for p in sorted(passout.get_password_names()):
+def cmd_find(query, limit):
+    for p in passout.find_password_names(" ".join(query), limit):
         print(p)
 
 
 @argspander.expand
-def cmd_add(cfg, pass_name):
-    passout.add_password(cfg, pass_name)
+def cmd_grep(cfg, pattern, fixed, ignore_case, first, jobs, group):
+    """ Lists the passwords whose contents match a pattern """
+    import re
+
+    if fixed:
+        pattern = re.escape(pattern)
+    try:
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        raise passout.PassOutError("Invalid pattern '%s': %s" % (pattern, e))
+
+    found = False
+    for name, err in passout.grep_passwords(cfg, regex, first, jobs, group):
+        if err is None:
+            found = True
+            print(name)
+            sys.stdout.flush()
+        else:
+            sys.stderr.write("Failed to decrypt '%s': %s\n" %
+                             (name, err.args[0]))
+    if not found:
+        sys.exit(1)
+
+
+@argspander.expand
+def cmd_add(cfg, pass_name, username, url, tags):
+    meta = _meta_fields(username, url, tags)
+    passout.add_password(cfg, pass_name, meta=meta or None)
+
+
+def _meta_fields(username, url, tags):
+    meta = {}
+    if username is not None:
+        meta["username"] = username
+    if url is not None:
+        meta["url"] = url
+    if tags is not None:
+        meta["tags"] = tags
+    return meta
+
+
+@argspander.expand
+def cmd_meta(pass_name, username, url, tags, rotated):
+    import json
+    import time
+
+    meta = _meta_fields(username, url, tags)
+    if rotated:
+        meta["rotated"] = int(time.time())
+    if meta:
+        passout.set_metadata(pass_name, **meta)
+    print(json.dumps(passout.get_metadata(pass_name), sort_keys=True))
+
+
+@argspander.expand
+def cmd_query(username, url, tags, group, long_fmt):
+    for p in passout.query_passwords(username, url, tags or (), group):
+        if long_fmt:
+            meta = passout.get_metadata(p)
+            print("\t".join([p, meta["username"] or "", meta["url"] or "",
+                             ",".join(meta["tags"])]))
+        else:
+            print(p)
+
+
+@argspander.expand
+def cmd_import(cfg, source, fmt, jobs, header):
+    """ Adds many passwords from a file or a 'pass' store """
+    from passout import bulk
+    entries = bulk.read_entries(source, fmt, header)
+    result = bulk.import_passwords(cfg, entries, jobs)
+
+    for name, err in sorted(result.failed.items()):
+        print("Failed to import '%s': %s" % (name, err.args[0]))
+    print(result.summary("Imported"))
+
+
+@argspander.expand
+def cmd_rekey(cfg, to, jobs):
+    """ Re-encrypts all passwords for a new key """
+    from passout import bulk
+    result = bulk.rekey_store(cfg, to, jobs)
+
+    for name, err in sorted(result.failed.items()):
+        print("Failed to re-key '%s': %s" % (name, err.args[0]))
+    print(result.summary("Re-keyed"))
+    if result.failed:
+        print("Run rekey again to retry the failed passwords")
+    else:
+        print("Now using key '%s'" % to)
+
+
+@argspander.expand
+def cmd_sync(cfg, dest):
+    """ Brings a mirror of the store up to date """
+    result = passout.sync_to(cfg, dest)
+    print(result.summary(dest))
+
+
+@argspander.expand
+def cmd_migrate_layout(cfg, to):
+    """ Moves the password files into a new store layout """
+    from passout import bulk
+    result = bulk.migrate_layout(cfg, to)
+
+    for name, err in sorted(result.failed.items()):
+        print("Failed to move '%s': %s" % (name, err.args[0]))
+    print(result.summary("Moved"))
+    if result.failed:
+        print("Run migrate-layout again to retry the failed passwords")
 
 
 @argspander.expand
@@ -41,23 +165,29 @@ def cmd_rm(pass_name):
 @argspander.expand
 def cmd_stdout(cfg, pass_name):
     """ Prints a password out of stdout (for use with, e.g. mutt) """
-    print(passout.get_password(cfg, pass_name))
+    from passout import daemon
+    print(daemon.get_password(cfg, pass_name))
 
 
 @argspander.expand
 def cmd_clip(cfg, pass_name):
     """ Puts a password in the GUI clipboard """
-    passout.load_clipboard(cfg, pass_name)
+    from passout import clipboard, daemon
+    passwd = daemon.get_password(cfg, pass_name)
+    clipboard.clip_in_background(cfg, pass_name, passwd)
 
-    secs = cfg["clip_clear_time"]
-    if secs > 0:
-        info("Clipboard loaded. Destroying in %s second(s)..." % secs)
-        time.sleep(secs)
-        passout.clear_clipboard(cfg)
+
+@argspander.expand
+def cmd_cache(action):
+    """ Manages the caches of decrypted passwords """
+    if action == "flush":
+        passout.flush_cache()
 
 
 @argspander.expand
 def cmd_printconfig(cfg):
+    import json
+
     # The json.dumps with sorted keys is a way to work around
     # Python 3's non-deterministic dictionary ordering.
     # We need an order for tests.
@@ -71,61 +201,189 @@ def cmd_tray(cfg):
 
 
 @argspander.expand
-def cmd_version(cfg):
+def cmd_serve(cfg):
+    """ Caches passwords for other passout processes """
+    from passout import daemon
+    daemon.serve(cfg)
+
+
+@argspander.expand
+def cmd_version(*args, **kwargs):
     print("Passout-%s" % passout.VERSION)
 
 
+def _add_meta_arguments(parser):
+    parser.add_argument("--user", dest="username",
+                        help="User name to record with the password")
+    parser.add_argument("--url", help="URL to record with the password")
+    parser.add_argument("--tag", dest="tags", action="append",
+                        help="Tag to record with the password (repeatable)")
+
+
 def entrypoint():
     """ Execution begins here """
 
-    cfg = passout.get_config()
     pass_name_str = "pass_name"
 
     parser = argparse.ArgumentParser(
         description="Simple password manager built on gpg")
+    parser.set_defaults(needs_cfg=False)
     subparsers = parser.add_subparsers(title="command")
 
     # ls
     ls = subparsers.add_parser("ls", help="List passwords stored")
     ls.set_defaults(func=cmd_ls)
+    ls.add_argument("-0", "--null", action="store_true",
+                    help="End each name with a NUL, rather than a newline")
+    ls.add_argument("-p", "--prefix", dest="group", metavar="GROUP",
+                    help="Only list the passwords in this group")
+    ls.add_argument("-u", "--unsorted", action="store_true",
+                    help="Don't sort the names. On a large store with no "
+                    "up to date index, names are listed as they are found")
+
+    # find
+    find = subparsers.add_parser("find", help="Search for passwords by name")
+    find.set_defaults(func=cmd_find)
+    find.add_argument("query", nargs="+", help="Terms to search for")
+    find.add_argument("-n", "--limit", type=int, default=None,
+                      help="Show at most this many matches")
+
+    # grep
+    grep = subparsers.add_parser("grep",
+                                 help="List the passwords whose contents "
+                                 "match a pattern")
+    grep.set_defaults(func=cmd_grep, needs_cfg=True)
+    grep.add_argument("pattern", help="Regular expression to search for")
+    grep.add_argument("-F", "--fixed-strings", dest="fixed",
+                      action="store_true",
+                      help="Treat the pattern as a plain string")
+    grep.add_argument("-i", "--ignore-case", action="store_true",
+                      help="Ignore case when matching")
+    grep.add_argument("--first", action="store_true",
+                      help="Stop at the first match")
+    grep.add_argument("-j", "--jobs", type=int, default=passout.BATCH_JOBS,
+                      help="How many passwords to decrypt at once")
+    grep.add_argument("-p", "--prefix", dest="group", metavar="GROUP",
+                      help="Only search the passwords in this group")
 
     # add
     add = subparsers.add_parser("add", help="Add a new password")
-    add.set_defaults(func=cmd_add, cfg=cfg)
+    add.set_defaults(func=cmd_add, needs_cfg=True)
     add.add_argument(pass_name_str, help="Name of the password to add")
+    _add_meta_arguments(add)
+
+    # meta
+    meta = subparsers.add_parser("meta",
+                                 help="Show or set the non-secret fields of "
+                                 "a password")
+    meta.set_defaults(func=cmd_meta)
+    meta.add_argument(pass_name_str, help="Name of the password")
+    _add_meta_arguments(meta)
+    meta.add_argument("--rotated", action="store_true",
+                      help="Record that the password was changed just now")
+
+    # query
+    query = subparsers.add_parser("query",
+                                  help="Find passwords by their non-secret "
+                                  "fields")
+    query.set_defaults(func=cmd_query)
+    query.add_argument("--user", dest="username", metavar="PATTERN",
+                       help="User name, shell style wildcards allowed")
+    query.add_argument("--url", metavar="PATTERN",
+                       help="URL, shell style wildcards allowed")
+    query.add_argument("--tag", dest="tags", action="append",
+                       help="A tag the password must have (repeatable)")
+    query.add_argument("-p", "--prefix", dest="group", metavar="GROUP",
+                       help="Only passwords in this group")
+    query.add_argument("-l", "--long", dest="long_fmt", action="store_true",
+                       help="Also show the user name, URL and tags")
+
+    # import
+    imp = subparsers.add_parser("import", help="Add passwords in bulk")
+    imp.set_defaults(func=cmd_import, needs_cfg=True)
+    imp.add_argument("source",
+                     help="File to import from ('-' for stdin), or the "
+                     "directory of a 'pass' store")
+    imp.add_argument("-f", "--format", dest="fmt", default="csv",
+                     choices=["csv", "jsonl", "pass"],
+                     help="Format of the source (default: csv)")
+    imp.add_argument("--header", action="store_true",
+                     help="Skip the first row of a CSV file")
+    imp.add_argument("-j", "--jobs", type=int, default=passout.BATCH_JOBS,
+                     help="How many passwords to encrypt at once")
+
+    # rekey
+    rekey = subparsers.add_parser("rekey",
+                                  help="Re-encrypt all passwords for a "
+                                  "new key")
+    rekey.set_defaults(func=cmd_rekey, needs_cfg=True)
+    rekey.add_argument("--to", required=True, help="The new GnuPG key id")
+    rekey.add_argument("-j", "--jobs", type=int, default=passout.BATCH_JOBS,
+                       help="How many passwords to re-encrypt at once")
+
+    # migrate-layout
+    migrate = subparsers.add_parser("migrate-layout",
+                                    help="Move the passwords into a new "
+                                    "store layout")
+    migrate.set_defaults(func=cmd_migrate_layout, needs_cfg=True)
+    migrate.add_argument("--to", required=True, choices=passout.LAYOUTS,
+                         help="The new layout")
+
+    # sync
+    sync = subparsers.add_parser("sync",
+                                 help="Copy the changes since the last sync "
+                                 "to a mirror directory")
+    sync.set_defaults(func=cmd_sync, needs_cfg=True)
+    sync.add_argument("dest", help="The mirror directory")
 
     # rm
     rm = subparsers.add_parser("rm", help="Remove a stored password")
-    rm.set_defaults(func=cmd_rm, cfg=cfg)
+    rm.set_defaults(func=cmd_rm)
     rm.add_argument(pass_name_str, help="Name of the password to remove")
 
     # stdout
     stdout = subparsers.add_parser("stdout", help="Print password to stdout")
-    stdout.set_defaults(func=cmd_stdout, cfg=cfg)
+    stdout.set_defaults(func=cmd_stdout, needs_cfg=True)
     stdout.add_argument(pass_name_str, help="Name of the password to print")
 
     # clip
     clip = subparsers.add_parser("clip",
                                  help="Put the password in the X clipboard")
-    clip.set_defaults(func=cmd_clip, cfg=cfg)
+    clip.set_defaults(func=cmd_clip, needs_cfg=True)
     clip.add_argument(pass_name_str,
                       help="Name of the password to place in the X clipboard")
 
+    # cache
+    cache = subparsers.add_parser("cache",
+                                  help="Manage the caches of decrypted "
+                                  "passwords")
+    cache.set_defaults(func=cmd_cache)
+    cache.add_argument("action", choices=["flush"],
+                       help="'flush' forgets every cached password, in the "
+                       "keyring and in a running daemon")
+
     # config
     config = subparsers.add_parser("config",
                                    help="Print the current "
                                    "passout configuration")
-    config.set_defaults(func=cmd_printconfig, cfg=cfg)
+    config.set_defaults(func=cmd_printconfig, needs_cfg=True)
 
     # tray
     tray = subparsers.add_parser("tray", help="Start the GTK tray icon")
-    tray.set_defaults(func=cmd_tray, cfg=cfg)
+    tray.set_defaults(func=cmd_tray, needs_cfg=True)
+
+    # serve
+    serve = subparsers.add_parser("serve",
+                                  help="Run a daemon which caches passwords")
+    serve.set_defaults(func=cmd_serve, needs_cfg=True)
 
     # version
     version = subparsers.add_parser("version", help="Show version and exit")
-    version.set_defaults(func=cmd_version, cfg=cfg)
+    version.set_defaults(func=cmd_version)
 
     args = parser.parse_args()
+    if args.needs_cfg:
+        args.cfg = passout.get_config()
     args.func(args, expand=True)
 
 
@@ -0,0 +1,186 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+Ranked searching of password names.
+"""
+
+import bisect
+import marshal
+from array import array
+
+SEARCH_INDEX_MAGIC = "passout-search-index-1"
+
+# Scores for a query term matching a group segment of a name
+SCORE_FULL_NAME = 10
+SCORE_SEGMENT = 8
+SCORE_SEGMENT_PREFIX = 6
+SCORE_SEGMENT_SUBSTR = 4
+SCORE_ACROSS_SEGMENTS = 2
+SCORE_LAST_SEGMENT_BONUS = 1
+
+
+def _array_to_bytes(arr):
+    if hasattr(arr, "tobytes"):
+        return arr.tobytes()
+    return arr.tostring()  # Python 2
+
+
+def _array_from_bytes(data):
+    arr = array("l")
+    if hasattr(arr, "frombytes"):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)  # Python 2
+    return arr
+
+
+def _blob_and_starts(lines):
+    """Join lines into one newline delimited string, also returning the
+    offset at which each line starts"""
+
+    starts = array("l")
+    pos = 1
+    for line in lines:
+        starts.append(pos)
+        pos += len(line) + 1
+    return "\n" + "\n".join(lines) + "\n", starts
+
+
+def score_name(name, terms, sep="__"):
+    """Score how well a password name matches some (lower case) query terms.
+    A term matching a whole group segment scores higher than one matching
+    the start of a segment, which in turn beats a match elsewhere. Matches
+    in the last segment (the password itself) get a small bonus.
+
+    Returns 0 if any term does not match at all."""
+
+    lname = name.lower()
+    segs = lname.split(sep)
+    total = 0
+    for term in terms:
+        if lname == term:
+            total += SCORE_FULL_NAME
+            continue
+
+        best = 0
+        for i, seg in enumerate(segs):
+            if seg == term:
+                score = SCORE_SEGMENT
+            elif seg.startswith(term):
+                score = SCORE_SEGMENT_PREFIX
+            elif term in seg:
+                score = SCORE_SEGMENT_SUBSTR
+            else:
+                continue
+            if i == len(segs) - 1:
+                score += SCORE_LAST_SEGMENT_BONUS
+            best = max(best, score)
+
+        if best == 0:
+            if term not in lname:
+                return 0
+            best = SCORE_ACROSS_SEGMENTS
+        total += best
+    return total
+
+
+class NameSearchIndex(object):
+    """An index for searching password names.
+
+    The (lower cased) names are kept in one big newline delimited string
+    alongside an array of line offsets. Finding the candidates for a query
+    term is then a matter of repeated str.find() calls, which run at C speed,
+    and the whole thing can be saved and loaded without rebuilding any
+    Python objects per name."""
+
+    def __init__(self, names, sep="__"):
+        names = sorted(names)
+        self.sep = sep
+        self.size = len(names)
+        self.names_blob, self.names_starts = _blob_and_starts(names)
+        self.lower_blob, self.lower_starts = \
+            _blob_and_starts([x.lower() for x in names])
+
+    def __len__(self):
+        return self.size
+
+    def _line(self, blob, starts, i):
+        return blob[starts[i]:blob.index("\n", starts[i])]
+
+    def _candidates(self, term):
+        """Yield the number of each line containing a term"""
+
+        blob, starts = self.lower_blob, self.lower_starts
+        pos = blob.find(term)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            yield i
+            # Skip to the next line, we already have this one
+            pos = blob.find(term, blob.index("\n", pos) + 1)
+
+    def search(self, query, limit=None):
+        """Find the names matching all of the whitespace separated terms in
+        the query. Returns a list of (score, name) pairs, best first."""
+
+        terms = query.lower().split()
+        if not terms or self.size == 0:
+            return []
+
+        # Scan for the term with the fewest occurrences. Counting them is
+        # cheap compared to scoring all of the hits for a common term.
+        rarest = min(terms, key=self.lower_blob.count)
+        hits = []
+        for i in self._candidates(rarest):
+            name = self._line(self.names_blob, self.names_starts, i)
+            score = score_name(name, terms, self.sep)
+            if score:
+                hits.append((score, name))
+
+        hits.sort(key=lambda x: (-x[0], len(x[1]), x[1]))
+        if limit is not None:
+            hits = hits[:limit]
+        return hits
+
+    def save(self, path, signature):
+        """Atomically write the index to a file. The signature identifies
+        the state of the store that the index describes."""
+
+        data = marshal.dumps((
+            SEARCH_INDEX_MAGIC, signature, self.sep, self.size,
+            self.names_blob, _array_to_bytes(self.names_starts),
+            self.lower_blob, _array_to_bytes(self.lower_starts)))
+        from passout import _replace_file
+        _replace_file(path, data)
+
+    @classmethod
+    def load(cls, path, signature):
+        """Load an index from a file. Returns None if the file is missing,
+        corrupt or was written for a different signature."""
+
+        try:
+            with open(path, "rb") as fh:
+                data = marshal.loads(fh.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if not isinstance(data, tuple) or len(data) != 8 or \
+                data[0] != SEARCH_INDEX_MAGIC or data[1] != signature:
+            return None
+
+        index = cls.__new__(cls)
+        index.sep, index.size, index.names_blob = data[2:5]
+        index.names_starts = _array_from_bytes(data[5])
+        index.lower_blob = data[6]
+        index.lower_starts = _array_from_bytes(data[7])
+        return index
@@ -0,0 +1,188 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+Timing of the expensive things passout does: running gpg, xclip and the
+notify command, and scanning directories.
+
+Each is wrapped in a span. Spans cost next to nothing unless tracing is on,
+which it is if PASSOUT_TRACE (or the 'trace' config key) is set to:
+
+ * 'summary': print counts and latency percentiles for each kind of span
+   to stderr on exit.
+ * A file name ('-' for stderr): append a JSON line per span.
+
+Other consumers can add their own hook with add_hook(). A hook is called
+with a dict for each span, e.g.:
+    {"kind": "gpg", "op": "decrypt", "start": 1445426023.2, "ms": 41.2,
+     "ok": True, "rc": 0}
+"""
+
+import os
+import sys
+import time
+
+TRACE_ENV = "PASSOUT_TRACE"
+PERCENTILES = [50, 90, 99]
+
+_clock = getattr(time, "perf_counter", time.time)
+_hooks = []
+_enabled_specs = set()
+
+
+class _Span(object):
+    __slots__ = ("kind", "fields", "start", "start_clock")
+
+    def __init__(self, kind, fields):
+        self.kind = kind
+        self.fields = fields
+
+    def set(self, **fields):
+        """Add fields to the span, e.g. a return code"""
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_clock = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        record = {
+            "kind": self.kind,
+            "start": self.start,
+            "ms": (_clock() - self.start_clock) * 1000,
+            "ok": exc_type is None,
+        }
+        record.update(self.fields)
+        for hook in list(_hooks):
+            hook(record)
+        return False
+
+
+class _NullSpan(object):
+    """What span() gives when nobody is listening"""
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(kind, **fields):
+    """Time a block of code:
+
+        with trace.span("gpg", op="decrypt") as sp:
+            ...
+            sp.set(rc=pipe.returncode)
+    """
+
+    if not _hooks:
+        return _NULL_SPAN
+    return _Span(kind, fields)
+
+
+def add_hook(hook):
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a sorted list"""
+
+    rank = max(1, int(round(pct / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+class SummaryHook(object):
+    """Collects span timings and summarises them by kind"""
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def __call__(self, record):
+        with self.lock:
+            self.times.setdefault(record["kind"], []).append(record["ms"])
+
+    def summary(self):
+        """Returns {kind: {"count": n, "total_ms": ..., "p50_ms": ...}}"""
+
+        summ = {}
+        with self.lock:
+            for kind, times in self.times.items():
+                times = sorted(times)
+                summ[kind] = {"count": len(times), "total_ms": sum(times),
+                              "max_ms": times[-1]}
+                for pct in PERCENTILES:
+                    summ[kind]["p%d_ms" % pct] = percentile(times, pct)
+        return summ
+
+    def report(self):
+        cols = ["p%d_ms" % x for x in PERCENTILES] + ["max_ms", "total_ms"]
+        lines = ["%-10s %7s" % ("kind", "count") +
+                 "".join("%11s" % x for x in cols)]
+        for kind, summ in sorted(self.summary().items()):
+            lines.append("%-10s %7d" % (kind, summ["count"]) +
+                         "".join("%11.2f" % summ[x] for x in cols))
+        return "\n".join(lines) + "\n"
+
+
+class JsonLinesHook(object):
+    """Writes a JSON line for each span to a file"""
+
+    def __init__(self, path):
+        import threading
+        self.lock = threading.Lock()
+        if path == "-":
+            self.fh = sys.stderr
+        else:
+            self.fh = open(path, "a")
+
+    def __call__(self, record):
+        import json
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            self.fh.write(line + "\n")
+            self.fh.flush()
+
+
+def enable(spec):
+    """Turn on tracing as described by a PASSOUT_TRACE value. Returns the
+    hook added (or None if this was already enabled)."""
+
+    if not spec or spec in _enabled_specs:
+        return None
+    _enabled_specs.add(spec)
+
+    import atexit
+    if spec == "summary":
+        hook = SummaryHook()
+        atexit.register(lambda: sys.stderr.write(hook.report()))
+    else:
+        hook = JsonLinesHook(spec)
+    add_hook(hook)
+    return hook
+
+
+enable(os.environ.get(TRACE_ENV))
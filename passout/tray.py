@@ -15,13 +15,18 @@
 try:
     import gi
     gi.require_version('Gtk', '3.0')
-    from gi.repository import Gtk
+    from gi.repository import Gtk, Gio, GLib, GObject
 except ImportError:
     print("No GTK support for Python found, cannot run tray")
 
-from logging import debug
-from passout import (get_password_names_grouped, clear_clipboard,
-                     load_clipboard)
+from logging import debug, info
+from passout import default_store, GROUP_SEP
+from passout.clipboard import GtkClipboards
+
+# How long to wait for a burst of changes to the store to settle (ms)
+REFRESH_DELAY = 250
+# How often to check the store for changes if we can't monitor it (s)
+POLL_INTERVAL = 2
 
 
 class PasswordMenuItem(Gtk.MenuItem):
@@ -37,6 +42,20 @@ class PasswordMenuItem(Gtk.MenuItem):
 class PassoutSysTrayApp(object):
     def __init__(self, cfg):
         self.cfg = cfg
+        self.store = default_store(cfg)
+        self.clipboards = GtkClipboards(cfg)
+
+        # The menu is built once and then kept in step with the store.
+        # menus maps a group name ("" for the top level) to its Gtk.Menu,
+        # levels maps a group name to {name: menu item} for its children.
+        # Groups which have not been opened yet appear in neither.
+        self.trie = self.store.get_password_trie()
+        self.names = set(self.trie.names())
+        self.menus = {}
+        self.levels = {}
+        self.refresh_pending = False
+        self.menu = self._build_menu()
+        self._watch_store()
 
         # Tray Icon itself
         self.tray = Gtk.StatusIcon()
@@ -47,49 +66,145 @@ class PassoutSysTrayApp(object):
 
     def clip_password(self, item):
         pwname = item.password_name
-        load_clipboard(self.cfg, pwname)
-
-        debug("clearing clipboard after %s seconds" %
-              self.cfg["clip_clear_time"])
-        from gi.repository import GObject
-
-        GObject.timeout_add_seconds(
-            self.cfg["clip_clear_time"], lambda: clear_clipboard(self.cfg))
-
-    def _add_items_to_menu(self, menu, item_dct, cur_path=tuple()):
-        """Recursively add items to the menu"""
-
-        for item, sub_items in item_dct.iteritems():
-            sub_path = cur_path + (item, )
+        passwd = self.store.get_password(pwname)
+        self.clipboards.load(pwname, passwd)
 
-            if sub_items:  # i.e. non-empty dict
-                menu_item = Gtk.MenuItem(item)
-                sub_menu = Gtk.Menu()
-                menu_item.set_submenu(sub_menu)
-                self._add_items_to_menu(sub_menu, sub_items, sub_path)
-            else:  # sub_items is an empty dict
-                menu_item = PasswordMenuItem("__".join(sub_path), item)
-                menu_item.connect('activate', self.clip_password)
+        secs = self.cfg["clip_clear_time"]
+        if secs > 0:
+            self.clipboards.clear_later(passwd, secs)
 
-            menu_item.show()
-            menu.append(menu_item)
-
-    def show_menu(self, icon, button, time):
-        self.menu = Gtk.Menu()
-
-        menu_dct = get_password_names_grouped()
-        self._add_items_to_menu(self.menu, menu_dct)
+    def _build_menu(self):
+        menu = Gtk.Menu()
+        self.menus[""] = menu
+        self.levels[""] = {}
+        self._sync_level("")
 
         sep = Gtk.SeparatorMenuItem()
         sep.show()
-        self.menu.append(sep)
+        menu.append(sep)
 
         # Exit
         exit = Gtk.MenuItem("Exit")
         exit.show()
-        self.menu.append(exit)
+        menu.append(exit)
         exit.connect('activate', Gtk.main_quit)
 
+        return menu
+
+    def _make_item(self, entry):
+        if entry.is_group:
+            # The submenu is left empty until the user first opens it
+            menu_item = Gtk.MenuItem(entry.label)
+            menu_item.set_submenu(Gtk.Menu())
+            menu_item.connect('select', self._populate_group, entry.name)
+        else:
+            menu_item = PasswordMenuItem(entry.name, entry.label)
+            menu_item.connect('activate', self.clip_password)
+
+        menu_item.show()
+        return menu_item
+
+    def _populate_group(self, menu_item, group):
+        if group in self.menus:
+            return  # already done
+        debug("Populating group '%s'" % group)
+        self.menus[group] = menu_item.get_submenu()
+        self.levels[group] = {}
+        self._sync_level(group)
+
+    def _forget_group(self, group):
+        """Drop our references to a group's (now destroyed) menus"""
+
+        prefix = group + GROUP_SEP
+        for name in list(self.menus):
+            if name == group or name.startswith(prefix):
+                del self.menus[name]
+                del self.levels[name]
+
+    def _sync_level(self, group):
+        """Make the menu for a group match the trie, only touching the
+        items which differ"""
+
+        menu = self.menus.get(group)
+        if menu is None:
+            return  # group not opened yet, or gone
+        items = self.levels[group]
+
+        want = list(self.trie.level(group))
+        want_kinds = dict((e.name, e.is_group) for e in want)
+        for name, menu_item in list(items.items()):
+            is_group = not isinstance(menu_item, PasswordMenuItem)
+            if want_kinds.get(name) != is_group:
+                del items[name]
+                if is_group:
+                    self._forget_group(name)
+                menu.remove(menu_item)
+                menu_item.destroy()
+
+        for pos, entry in enumerate(want):
+            if entry.name not in items:
+                menu_item = self._make_item(entry)
+                items[entry.name] = menu_item
+                menu.insert(menu_item, pos)
+
+    def refresh(self):
+        """Bring the menu up to date with the store"""
+
+        self.refresh_pending = False
+        names = set(self.store.get_password_names())
+        added = names - self.names
+        removed = self.names - names
+        if not added and not removed:
+            return False
+        info("Updating tray menu: %d added, %d removed" %
+             (len(added), len(removed)))
+
+        groups = set()
+        for name in removed:
+            self.trie.remove(name)
+        for name in added:
+            self.trie.insert(name)
+        for name in added | removed:
+            path = name.split(GROUP_SEP)
+            for i in range(len(path)):
+                groups.add(GROUP_SEP.join(path[:i]))
+        self.names = names
+
+        # Outer groups first, syncing them may create or destroy inner ones
+        for group in sorted(groups, key=lambda g: (g.count(GROUP_SEP), g)):
+            self._sync_level(group)
+        return False
+
+    def _store_changed(self, *args):
+        # Changes tend to come in bursts, so wait for things to settle
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            GObject.timeout_add(REFRESH_DELAY, self.refresh)
+
+    def _poll_store(self):
+        sig = self.store._crypto_dir_signature()
+        if sig != self.store_sig:
+            self.store_sig = sig
+            self.refresh()
+        return True  # keep polling
+
+    def _watch_store(self):
+        """Watch the store for changes using inotify (via Gio), falling
+        back on polling if that isn't possible"""
+
+        try:
+            store = Gio.File.new_for_path(self.store.crypto_dir)
+            self.monitor = store.monitor_directory(
+                Gio.FileMonitorFlags.NONE, None)
+            self.monitor.connect("changed", self._store_changed)
+        except GLib.Error as e:
+            info("Can't monitor '%s' (%s), polling instead" %
+                 (self.store.crypto_dir, e))
+            self.monitor = None
+            self.store_sig = self.store._crypto_dir_signature()
+            GObject.timeout_add_seconds(POLL_INTERVAL, self._poll_store)
+
+    def show_menu(self, icon, button, time):
         self.menu.popup(None, None, None, None, button, time)
 
 
@@ -0,0 +1,173 @@
+# Copyright (c) 2014-2015, Edd Barrett <vext01@gmail.com>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN ACTION
+# OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
+# CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""
+A trie of password names, split into groups.
+"""
+
+import bisect
+import collections
+
+TrieEntry = collections.namedtuple(
+    "TrieEntry", ["label", "name", "is_group", "is_password"])
+
+
+class _Node(object):
+    """A trie node. The children are kept sorted by label, with the labels
+    and nodes in two parallel lists."""
+
+    __slots__ = ("labels", "nodes", "is_password")
+
+    def __init__(self):
+        self.labels = []
+        self.nodes = []
+        self.is_password = False
+
+    def child(self, label):
+        i = bisect.bisect_left(self.labels, label)
+        if i < len(self.labels) and self.labels[i] == label:
+            return self.nodes[i]
+        return None
+
+
+class NameTrie(object):
+    """Password names, arranged by group.
+
+    A name such as 'mail__gmail' is stored as a 'gmail' node under a 'mail'
+    node. Children are kept in sorted order as they are inserted, so walking
+    the trie never needs a sort. Groups are addressed by their name prefix
+    without a trailing separator, e.g. 'mail'."""
+
+    def __init__(self, names=(), sep="__"):
+        self.sep = sep
+        self.root = _Node()
+        self.count = 0
+        for name in names:
+            self.insert(name)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        node = self.lookup(name)
+        return node is not None and node.is_password
+
+    def _path(self, name):
+        if not name:
+            return []
+        return name.split(self.sep)
+
+    def lookup(self, group):
+        """Return the node for a group (or password) name, or None. The
+        empty name (or None) gives the root."""
+
+        node = self.root
+        for label in self._path(group):
+            node = node.child(label)
+            if node is None:
+                return None
+        return node
+
+    def insert(self, name):
+        """Add a password name. Returns False if it was already there."""
+
+        node = self.root
+        for label in self._path(name):
+            i = bisect.bisect_left(node.labels, label)
+            if i < len(node.labels) and node.labels[i] == label:
+                node = node.nodes[i]
+            else:
+                new = _Node()
+                node.labels.insert(i, label)
+                node.nodes.insert(i, new)
+                node = new
+
+        if node.is_password:
+            return False
+        node.is_password = True
+        self.count += 1
+        return True
+
+    def remove(self, name):
+        """Remove a password name, pruning groups left empty. Returns False
+        if it wasn't there."""
+
+        trail = []
+        node = self.root
+        for label in self._path(name):
+            child = node.child(label)
+            if child is None:
+                return False
+            trail.append((node, label))
+            node = child
+
+        if not node.is_password:
+            return False
+        node.is_password = False
+        self.count -= 1
+
+        while trail and not node.is_password and not node.labels:
+            node, label = trail.pop()
+            i = bisect.bisect_left(node.labels, label)
+            del node.labels[i]
+            del node.nodes[i]
+        return True
+
+    def level(self, group=None):
+        """Lazily iterate, in order, over the entries directly within a
+        group, yielding a TrieEntry for each."""
+
+        node = self.lookup(group)
+        if node is None:
+            return
+
+        prefix = group + self.sep if group else ""
+        for label, child in zip(node.labels, node.nodes):
+            yield TrieEntry(label, prefix + label, bool(child.labels),
+                            child.is_password)
+
+    def names(self, group=None):
+        """Lazily iterate, in order, over all password names within a
+        group (or the whole trie)."""
+
+        node = self.lookup(group)
+        if node is None:
+            return
+
+        # Explicit stack rather than recursion, so deep groups are OK
+        stack = [(group or "", node)]
+        while stack:
+            name, node = stack.pop()
+            if node.is_password and name:
+                yield name
+            prefix = name + self.sep if name else ""
+            for i in range(len(node.labels) - 1, -1, -1):
+                stack.append((prefix + node.labels[i], node.nodes[i]))
+
+    def to_dict(self, group=None, ordered=True):
+        """Convert to nested dicts of the form: Name -> SubItems, as
+        returned by passout.get_password_names_grouped()."""
+
+        mk_dict = collections.OrderedDict if ordered else dict
+        top = mk_dict()
+        node = self.lookup(group)
+        if node is None:
+            return top
+
+        stack = [(node, top)]
+        while stack:
+            node, dct = stack.pop()
+            for label, child in zip(node.labels, node.nodes):
+                sub = dct[label] = mk_dict()
+                stack.append((child, sub))
+        return top
@@ -1,3 +1,4 @@
+import atexit
 import os
 import shutil
 import uuid
@@ -56,9 +57,19 @@ def _remove_passout_dir():
 
 def _remove_gpg_dir():
     if os.path.exists(GPG_DIR):
+        # Stop the agent first, or it may remove its sockets as we go
+        try:
+            subprocess.call(["gpgconf", "--kill", "gpg-agent"])
+        except OSError:
+            pass  # GnuPG 1, no agent
         shutil.rmtree(GPG_DIR)
 
 
+# Generating a key is by far the slowest part of setting up a test, so one
+# key is shared by the whole test run.
+atexit.register(_remove_gpg_dir)
+
+
 def _make_fresh_passout_dir(gpg):
     _remove_passout_dir()
 
@@ -95,18 +106,14 @@ class PassOutBaseTest(object):
         """Fixture implicitely run once for each test.
 
         Creates a fresh passout setup ready for testing. This includes
-        making a gpg key if one does not exist in the test dir."""
+        making a gpg key if one does not exist in the test dir yet."""
         gpg = _find_gpg()
         if not os.path.exists(GPG_DIR):
             _make_key(gpg)
 
         _make_fresh_passout_dir(gpg)
 
-        def finalise():
-            _remove_passout_dir()
-            _remove_gpg_dir()
-
-        request.addfinalizer(finalise)
+        request.addfinalizer(_remove_passout_dir)
 
     @pytest.fixture
     def _uuid_hex(self):
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import stat
+import sys
+
+import pytest
+
+import support
+import passout
+from passout import PassOutError, trace
+
+if sys.version_info < (3, 7):
+    pytest.skip("Needs asyncio.run()", allow_module_level=True)
+if True:
+    from passout import aio  # work around PEP8, sigh
+
+
+class TestAio(support.PassOutLibTest):
+
+    def test_add_and_get(self, cfg, rand_pwname, rand_pw):
+        store = aio.AsyncPassOut(cfg)
+        asyncio.run(store.add_password(rand_pwname, rand_pw))
+        assert passout.get_password(cfg, rand_pwname, testing=True) == \
+            rand_pw
+        assert asyncio.run(store.get_password(rand_pwname)) == rand_pw
+
+        with pytest.raises(PassOutError):
+            asyncio.run(store.add_password(rand_pwname, rand_pw))
+        asyncio.run(store.remove_password(rand_pwname))
+        with pytest.raises(PassOutError):
+            asyncio.run(store.get_password(rand_pwname))
+
+    def test_add_is_a_transaction(self, cfg, rand_pwname, rand_pw):
+        passout.add_password(cfg, "other", rand_pw, meta={"username": "me"})
+        store = aio.AsyncPassOut(cfg)
+        asyncio.run(store.add_password(rand_pwname, rand_pw))
+
+        # Metadata is recorded and no temporary file is left behind
+        assert store.store.get_metadata(rand_pwname)["created"] is not None
+        assert [x for x in os.listdir(passout.CRYPTO_DIR)
+                if x.endswith(".tmp")] == []
+        pw_file = store.store._find_pass_file(rand_pwname)
+        assert stat.S_IMODE(os.stat(pw_file).st_mode) == 0o600
+
+    def test_packed(self, cfg, rand_pwname, rand_pw):
+        cfg["layout"] = "packed"
+        store = aio.AsyncPassOut(cfg)
+        asyncio.run(store.add_password(rand_pwname, rand_pw))
+        assert asyncio.run(store.get_password(rand_pwname)) == rand_pw
+
+    def test_get_passwords(self, cfg, rand_pw):
+        names = ["pw%d" % i for i in range(8)]
+        for name in names:
+            passout.add_password(cfg, name, rand_pw + name)
+
+        spans = []
+        trace.add_hook(spans.append)
+        try:
+            store = aio.AsyncPassOut(cfg, max_procs=2)
+            got, errs = asyncio.run(store.get_passwords(names + ["nope"]))
+        finally:
+            trace.remove_hook(spans.append)
+
+        assert got == dict((x, rand_pw + x) for x in names)
+        assert list(errs) == ["nope"]
+
+        # No more than two gpgs were running at any one time
+        events = sorted([(x["start"], 1) for x in spans] +
+                        [(x["start"] + x["ms"] / 1000, -1) for x in spans])
+        running = [sum(x[1] for x in events[:i + 1])
+                   for i in range(len(events))]
+        assert max(running) <= 2
+
+    def test_cancel_kills_gpg(self, cfg, tmpdir, rand_pwname, rand_pw):
+        passout.add_password(cfg, rand_pwname, rand_pw)
+
+        pid_file = tmpdir.join("pid")
+        slow_gpg = tmpdir.join("slow_gpg")
+        slow_gpg.write("#!/bin/sh\necho $$ > %s\nexec sleep 60\n" % pid_file)
+        os.chmod(str(slow_gpg), stat.S_IRWXU)
+        cfg["gpg"] = str(slow_gpg)
+
+        store = aio.AsyncPassOut(cfg)
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(store.get_password(rand_pwname), 1))
+
+        with pytest.raises(OSError):
+            os.kill(int(pid_file.read()), 0)
@@ -0,0 +1,273 @@
+import os
+
+import pytest
+
+import support
+import passout
+from passout import bulk, PassOutError
+
+
+class TestRunPool(object):
+
+    def test_os_errors(self):
+        def func(name):
+            if name == "b":
+                raise OSError(13, "Permission denied")
+            return name
+
+        result = bulk._run_pool(func, ["a", "b", "c"], 2, bulk.BulkResult())
+        assert sorted(result.done) == ["a", "c"]
+        assert list(result.failed) == ["b"]
+        assert isinstance(result.failed["b"], PassOutError)
+
+
+class TestImport(support.PassOutLibTest):
+
+    def test_import_csv(self, cfg, tmpdir, rand_pw):
+        passout.add_password(cfg, "exists", rand_pw)
+        src = tmpdir.join("in.csv")
+        src.write("a,%s\ng__b,%s\nexists,x\nbad\n" % (rand_pw, rand_pw + "2"))
+
+        entries = bulk.read_entries(str(src), "csv")
+        result = bulk.import_passwords(cfg, entries, jobs=2, testing=True)
+
+        assert sorted(result.done) == ["a", "g__b"]
+        assert sorted(result.failed) == ["exists", "line 4"]
+        assert passout.get_password(cfg, "g__b", testing=True) == \
+            rand_pw + "2"
+
+    def test_import_streamed(self, cfg, monkeypatch, rand_pw):
+        store = passout.default_store()
+        commits = []
+        commit = store._commit
+
+        def count_commits(txn, *args, **kwargs):
+            commits.append(len(txn.adds))
+            return commit(txn, *args, **kwargs)
+
+        monkeypatch.setattr(store, "_commit", count_commits)
+
+        def entries():
+            for i in range(5):
+                # Each chunk is in the store before the next is read
+                assert len(store.get_password_names()) == i - i % 2
+                yield bulk.ImportEntry("pw%d" % i, rand_pw, None, None)
+            yield bulk.ImportEntry("pw0", rand_pw, None, None)
+
+        result = bulk.import_passwords(cfg, entries(), testing=True,
+                                       chunk_size=2)
+        assert sorted(result.done) == ["pw%d" % i for i in range(5)]
+        assert list(result.failed) == ["pw0"]
+        assert commits == [2, 2, 1]
+
+    def test_import_csv_header(self, cfg, tmpdir, rand_pw):
+        src = tmpdir.join("in.csv")
+        src.write("name,password\na,%s\n" % rand_pw)
+
+        entries = bulk.read_entries(str(src), "csv", header=True)
+        result = bulk.import_passwords(cfg, entries, testing=True)
+        assert result.done == ["a"]
+        assert not result.failed
+
+    def test_import_pass_store(self, cfg, tmpdir, rand_pw):
+        src = tmpdir.mkdir("mail").join("gmail.gpg")
+        passout._encrypt_to_file(cfg, str(src), rand_pw + "\nuser: me\n")
+
+        entries = bulk.read_entries(str(tmpdir), "pass")
+        result = bulk.import_passwords(cfg, entries, testing=True)
+
+        assert result.done == ["mail__gmail"]
+        got = passout.get_password(cfg, "mail__gmail", testing=True)
+        assert got == rand_pw + "\nuser: me\n"
+
+    def test_import_no_temp_files(self, cfg, rand_pw):
+        cfg["id"] = "BOGUS@WiBbLe.CoM"
+        entries = [bulk.ImportEntry("a", rand_pw, None, None)]
+        result = bulk.import_passwords(cfg, entries, testing=True)
+
+        assert list(result.failed) == ["a"]
+        assert os.listdir(passout.CRYPTO_DIR) == []
+
+
+class TestRekey(support.PassOutLibTest):
+
+    def test_rekey(self, cfg, rand_pw):
+        passout.add_password(cfg, "a", rand_pw)
+        passout.add_password(cfg, "b", rand_pw + "2")
+
+        result = bulk.rekey_store(cfg, support.GPG_ID, testing=True)
+        assert sorted(result.done) == ["a", "b"]
+        assert not os.path.exists(passout.default_store().rekey_journal_file)
+        assert passout.get_password(cfg, "b", testing=True) == rand_pw + "2"
+
+    @pytest.mark.parametrize("layout", ["flat", "packed"])
+    def test_rekey_remove_race(self, cfg, monkeypatch, layout, rand_pw):
+        cfg["layout"] = layout
+        passout.add_password(cfg, "a", rand_pw)
+        passout.add_password(cfg, "victim", rand_pw + "v")
+
+        # Removed once it has been decrypted, but before it is replaced
+        decrypt_file, decrypt_data = passout._decrypt_file, \
+            passout._decrypt_data
+
+        def remove_victim(decrypt):
+            def wrapper(*args):
+                passwd = decrypt(*args)
+                if passwd == rand_pw + "v" and \
+                        "victim" in passout.get_password_names():
+                    passout.remove_password("victim")
+                return passwd
+            return wrapper
+
+        monkeypatch.setattr(passout, "_decrypt_file",
+                            remove_victim(decrypt_file))
+        monkeypatch.setattr(passout, "_decrypt_data",
+                            remove_victim(decrypt_data))
+        result = bulk.rekey_store(cfg, support.GPG_ID, jobs=1, testing=True)
+        assert not result.failed
+        assert passout.get_password_names() == ["a"]
+
+    def test_rekey_resume(self, cfg, rand_pw):
+        passout.add_password(cfg, "a", rand_pw)
+        passout.add_password(cfg, "b", rand_pw)
+
+        # Pretend an earlier run did 'b' and then died. Were 'b' to be
+        # re-keyed again, decrypting this would fail.
+        with open(passout.default_store()._get_pass_file("b"), "w") as fh:
+            fh.write("not gpg")
+        with open(passout.default_store().rekey_journal_file, "w") as fh:
+            fh.write("%s %s\nb\n" % (bulk.REKEY_JOURNAL_MAGIC, support.GPG_ID))
+
+        result = bulk.rekey_store(cfg, support.GPG_ID, testing=True)
+        assert result.done == ["a"]
+        assert not result.failed
+
+    def test_rekey_other_journal(self, cfg, rand_pw):
+        with open(passout.default_store().rekey_journal_file, "w") as fh:
+            fh.write("%s other@key\n" % bulk.REKEY_JOURNAL_MAGIC)
+
+        with pytest.raises(PassOutError):
+            bulk.rekey_store(cfg, support.GPG_ID, testing=True)
+
+
+class TestMigrateLayout(support.PassOutLibTest):
+
+    def test_sharded_store(self, cfg, rand_pw):
+        cfg["layout"] = "sharded"
+        passout.add_password(cfg, "a", rand_pw)
+        passout.add_password(cfg, "g__b", rand_pw + "2")
+
+        assert not [x for x in os.listdir(passout.CRYPTO_DIR)
+                    if x.endswith(".gpg")]
+        assert sorted(passout.get_password_names()) == ["a", "g__b"]
+        assert passout.get_password(cfg, "g__b", testing=True) == \
+            rand_pw + "2"
+
+        # The index notices changes in the shards
+        passout.remove_password("a")
+        assert passout.get_password_names() == ["g__b"]
+
+    def test_migrate(self, cfg, rand_pw):
+        passout.add_password(cfg, "a", rand_pw)
+        passout.add_password(cfg, "b", rand_pw + "2")
+        assert sorted(passout.get_password_names()) == ["a", "b"]
+
+        result = bulk.migrate_layout(cfg, "sharded")
+        assert sorted(result.done) == ["a", "b"]
+        store = passout.default_store()
+        assert os.path.exists(store._get_pass_file("a", "sharded"))
+        assert not os.path.exists(store._get_pass_file("a", "flat"))
+        assert passout.get_config()["layout"] == "sharded"
+        assert sorted(passout.get_password_names()) == ["a", "b"]
+
+        bulk.migrate_layout(cfg, "flat")
+        assert sorted(os.listdir(passout.CRYPTO_DIR)) == ["a.gpg", "b.gpg"]
+        assert passout.get_password(cfg, "b", testing=True) == rand_pw + "2"
+
+    def test_migrate_remove_race(self, cfg, monkeypatch, rand_pw):
+        import threading
+        import time
+
+        passout.add_password(cfg, "a", rand_pw)
+        removing = []
+
+        # Try to remove it between the link and the unlink
+        link = os.link
+
+        def link_then_remove(src, dst):
+            link(src, dst)
+            thr = threading.Thread(target=passout.remove_password,
+                                   args=("a", ))
+            thr.start()
+            removing.append(thr)
+            time.sleep(0.2)
+
+        monkeypatch.setattr(os, "link", link_then_remove)
+        result = bulk.migrate_layout(cfg, "sharded")
+        removing[0].join()
+        assert result.done == ["a"] and not result.failed
+        assert passout.get_password_names() == []
+
+    def test_migrate_interrupted(self, cfg, rand_pw):
+        passout.add_password(cfg, "a", rand_pw)
+
+        # Pretend an earlier run linked 'a' into place and then died
+        store = passout.default_store()
+        sharded = store._get_pass_file("a", "sharded")
+        os.makedirs(os.path.dirname(sharded))
+        os.link(store._get_pass_file("a", "flat"), sharded)
+        assert passout.get_password_names() == ["a"]
+
+        result = bulk.migrate_layout(cfg, "sharded")
+        assert result.done == ["a"]
+        assert not os.path.exists(store._get_pass_file("a", "flat"))
+        assert passout.get_password(cfg, "a", testing=True) == rand_pw
+
+    def test_packed_store(self, cfg, rand_pw):
+        cfg["layout"] = "packed"
+        passout.add_password(cfg, "a", rand_pw)
+        passout.add_password(cfg, "g__b", rand_pw + "2")
+
+        assert os.listdir(passout.CRYPTO_DIR) == ["store.pack"]
+        assert sorted(passout.get_password_names()) == ["a", "g__b"]
+        assert passout.get_password(cfg, "g__b", testing=True) == \
+            rand_pw + "2"
+        with pytest.raises(PassOutError):
+            passout.add_password(cfg, "a", rand_pw)
+
+        passout.remove_password("a")
+        assert passout.get_password_names() == ["g__b"]
+
+    def test_migrate_packed_synced(self, cfg, monkeypatch, rand_pw):
+        from passout import pack
+
+        passout.add_password(cfg, "a", rand_pw)
+        put = pack.PackStore.put
+        syncs = []
+
+        def record_put(self, name, data, replace=False, sync=False):
+            syncs.append(sync)
+            return put(self, name, data, replace, sync)
+
+        monkeypatch.setattr(pack.PackStore, "put", record_put)
+        bulk.migrate_layout(cfg, "packed")
+        assert syncs == [True]
+
+        synced = []
+        monkeypatch.setattr(passout, "_fsync_dir", synced.append)
+        bulk.migrate_layout(cfg, "flat")
+        assert synced == [passout.CRYPTO_DIR]
+
+    def test_migrate_packed(self, cfg, rand_pw):
+        passout.add_password(cfg, "a", rand_pw)
+        cfg["layout"] = "sharded"
+        passout.add_password(cfg, "b", rand_pw + "2")
+
+        result = bulk.migrate_layout(cfg, "packed")
+        assert sorted(result.done) == ["a", "b"]
+        assert os.listdir(passout.CRYPTO_DIR) == ["store.pack"]
+        assert passout.get_password(cfg, "b", testing=True) == rand_pw + "2"
+
+        result = bulk.migrate_layout(cfg, "flat")
+        assert sorted(os.listdir(passout.CRYPTO_DIR)) == ["a.gpg", "b.gpg"]
+        assert passout.get_password(cfg, "a", testing=True) == rand_pw
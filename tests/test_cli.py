@@ -1,10 +1,19 @@
 import os
+import subprocess
+import sys
 import pexpect
 import pytest
 import support
 from passout import VERSION
 from distutils.spawn import find_executable
 
+# Modules which commands like 'version' and 'ls' should not need to import
+STARTUP_UNWANTED_MODULES = ["subprocess", "json", "socket", "getpass",
+                            "multiprocessing"]
+# How long importing the passout package may take, relative to the imports
+# done by a bare Python starting up
+STARTUP_IMPORT_RATIO = 2
+
 
 class TestCLI(support.PassOutCliTest):
     """ These test loosely check the command line interface.
@@ -22,8 +31,14 @@ class TestCLI(support.PassOutCliTest):
 
     def test_config(self):
         child1 = self.run_passout("config")
-        child1.expect('{"clip_clear_time": 5, "gpg": ".*?", "id": ".*?", '
-                      '"notify_cmd": ""}')
+        child1.expect('{"clip_clear_time": 5, '
+                      '"crypto_backend": "subprocess", '
+                      '"daemon_cache_size": 100, '
+                      '"daemon_ttl": 300, "gpg": ".*?", '
+                      '"id": ".*?", '
+                      '"keyring_ttl": 0, "layout": "flat", '
+                      '"notify_cmd": "", '
+                      '"trace": ""}')
         child1.expect(pexpect.EOF)
 
     def test_ls(self, rand_pwname, rand_pw):
@@ -43,6 +58,11 @@ class TestCLI(support.PassOutCliTest):
         child3.expect(rand_pwname2)
         child3.expect(pexpect.EOF)
 
+        child4 = self.run_passout("ls", "--null", "--unsorted")
+        child4.expect(pexpect.EOF)
+        assert sorted(child4.before.decode().split("\0")) == \
+            ["", rand_pwname, rand_pwname2]
+
     def test_add_same_pw_twice(self, rand_pwname, rand_pw):
         child1 = self.run_passout("add", rand_pwname)
         child1.expect_exact("Password: ")
@@ -95,7 +115,47 @@ class TestCLI(support.PassOutCliTest):
             "No password named '%s'" % rand_pwname)
         child1.expect_exact(pexpect.EOF)
 
+    def test_grep_bad_pattern(self):
+        child1 = self.run_passout("grep", "(")
+        child1.expect_exact("Invalid pattern '('")
+        child1.expect_exact(pexpect.EOF)
+
     def test_version(self):
         child1 = self.run_passout("version")
         child1.expect_exact("Passout-%s" % VERSION)
         child1.expect_exact(pexpect.EOF)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7),
+                        reason="Needs python -X importtime")
+    def test_startup_imports(self):
+        # Lines look like: "import time: <self us> | <cumulative us> | <mod>"
+        # with the modules imported by others indented.
+        def import_times(*args):
+            pipe = subprocess.Popen(
+                (sys.executable, "-X", "importtime") + args,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+            (out, err) = pipe.communicate()
+            assert pipe.returncode == 0
+
+            cumulative, top_level = {}, 0
+            for line in err.splitlines():
+                fields = line.split("|")
+                if line.startswith("import time:") and \
+                        fields[1].strip().isdigit():
+                    cumulative[fields[2].strip()] = int(fields[1])
+                    if not fields[2].startswith("  "):
+                        top_level += int(fields[1])
+            return cumulative, top_level
+
+        cumulative = import_times(support.PASSOUT, "version")[0]
+        for mod in STARTUP_UNWANTED_MODULES:
+            assert mod not in cumulative
+
+        # Compared against the interpreter's own start up on this machine,
+        # as the absolute times vary too much. The best of a few runs
+        # smooths out a busy machine.
+        passout_us = min(import_times(support.PASSOUT, "version")[0]
+                         ["passout"] for i in range(3))
+        python_us = min(import_times("-c", "pass")[1] for i in range(3))
+        assert passout_us < python_us * STARTUP_IMPORT_RATIO
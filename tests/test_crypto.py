@@ -0,0 +1,78 @@
+import sys
+
+import pytest
+
+import support
+import passout
+from passout import crypto, PassOutError
+
+
+class FakeKey(object):
+    """Enough of a GPGME key for crypto._find_key()"""
+
+    def __init__(self, fpr, uid, **flags):
+        self.fpr = fpr
+        self.subkeys = [FakeAttrs(fpr=fpr, keyid=fpr[-16:])]
+        self.uids = [FakeAttrs(uid=uid, email=uid.split("<")[1].strip(">"),
+                               revoked=False, invalid=False)]
+        self.can_encrypt = True
+        self.expired = self.revoked = self.disabled = self.invalid = False
+        self.__dict__.update(flags)
+
+
+class FakeAttrs(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class TestFindKey(object):
+
+    bob = FakeKey("A" * 40, "Bob <bob@x.org>")
+    jimbob = FakeKey("B" * 40, "Jim Bob <jimbob@x.org>")
+
+    def test_exact_match(self):
+        keys = [self.jimbob, self.bob]
+        for recipient in ["bob@x.org", "<BOB@x.org>", "Bob <bob@x.org>",
+                          "A" * 40, "0x" + "a" * 16, "A" * 8]:
+            assert crypto._find_key(keys, recipient) is self.bob
+
+    def test_unusable(self):
+        for flags in [{"expired": True}, {"revoked": True},
+                      {"disabled": True}, {"can_encrypt": False}]:
+            key = FakeKey("A" * 40, "Bob <bob@x.org>", **flags)
+            with pytest.raises(PassOutError):
+                crypto._find_key([key], "bob@x.org")
+
+    def test_ambiguous(self):
+        other = FakeKey("C" * 40, "Bob <bob@x.org>")
+        with pytest.raises(PassOutError):
+            crypto._find_key([self.bob, other], "bob@x.org")
+        assert crypto._find_key([self.bob, other], "C" * 40) is other
+
+
+class TestCrypto(support.PassOutLibTest):
+
+    def test_unknown_backend(self, cfg, rand_pwname, rand_pw):
+        cfg["crypto_backend"] = "nope"
+        with pytest.raises(PassOutError):
+            passout.add_password(cfg, rand_pwname, rand_pw)
+
+    def test_gpgme_missing(self, cfg, monkeypatch):
+        monkeypatch.setitem(sys.modules, "gpg", None)
+        monkeypatch.setattr(crypto, "_backends", {})
+        cfg["crypto_backend"] = "gpgme"
+        with pytest.raises(PassOutError):
+            crypto.get_backend(cfg)
+
+    @pytest.mark.parametrize("layout", ["flat", "packed"])
+    def test_gpgme(self, cfg, layout, rand_pwname, rand_pw):
+        pytest.importorskip("gpg")
+        cfg["layout"] = layout
+        cfg["crypto_backend"] = "gpgme"
+        passout.add_password(cfg, rand_pwname, rand_pw)
+        assert passout.get_password(cfg, rand_pwname) == rand_pw
+
+        # Either backend can read what the other wrote
+        cfg["crypto_backend"] = "subprocess"
+        assert passout.get_password(cfg, rand_pwname, testing=True) == \
+            rand_pw
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+
+import pytest
+
+import support
+import passout
+from passout import daemon, PassOutError
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPasswordCache(object):
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = daemon.PasswordCache(10, 5, clock)
+        cache.put("a", "pw")
+        assert cache.get("a") == "pw"
+
+        clock.now = 11
+        assert cache.get("a") is None
+
+    def test_expire(self):
+        clock = FakeClock()
+        cache = daemon.PasswordCache(10, 5, clock)
+        cache.put("a", "pw")
+        clock.now = 5
+        cache.put("b", "pw")
+        clock.now = 11
+        cache.expire()
+        assert list(cache.entries) == ["b"]
+
+    def test_size_cap(self):
+        cache = daemon.PasswordCache(10, 2)
+        cache.put("a", "pw")
+        cache.put("b", "pw")
+        cache.get("a")
+        cache.put("c", "pw")
+        assert sorted(cache.entries) == ["a", "c"]
+
+    def test_evict(self):
+        cache = daemon.PasswordCache(10, 2)
+        cache.put("a", "pw")
+        assert cache.evict("a")
+        assert not cache.evict("a")
+        assert cache.get("a") is None
+
+
+class TestDaemon(support.PassOutLibTest):
+
+    @pytest.fixture
+    def running_daemon(self, request, cfg):
+        d = daemon.PassOutDaemon(cfg, testing=True)
+        thr = threading.Thread(target=d.serve_forever)
+        thr.start()
+
+        def stop():
+            d.shutdown()
+            thr.join()
+        request.addfinalizer(stop)
+
+        for i in range(100):
+            if daemon.ping():
+                break
+            time.sleep(0.05)
+        return d
+
+    def test_daemon_not_answering(self, cfg, monkeypatch, rand_pwname,
+                                  rand_pw):
+        import socket
+
+        # Connections are queued, but never read
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(daemon.SOCKET_FILE)
+        sock.listen(4)
+        monkeypatch.setattr(daemon, "REQUEST_TIMEOUT", 0.2)
+        monkeypatch.setattr(daemon, "GET_TIMEOUT", 0.2)
+        try:
+            assert not daemon.ping()
+            passout.add_password(cfg, rand_pwname, rand_pw)
+            got = daemon.get_password(cfg, rand_pwname, testing=True)
+            assert got == rand_pw
+        finally:
+            sock.close()
+            os.unlink(daemon.SOCKET_FILE)
+
+    def test_no_daemon(self, cfg, rand_pwname, rand_pw):
+        assert not daemon.ping()
+        passout.add_password(cfg, rand_pwname, rand_pw)
+        got = daemon.get_password(cfg, rand_pwname, testing=True)
+        assert got == rand_pw
+
+    def test_get_and_evict(self, cfg, running_daemon, rand_pwname, rand_pw):
+        passout.add_password(cfg, rand_pwname, rand_pw)
+        assert daemon.get_password(cfg, rand_pwname) == rand_pw
+        assert len(running_daemon.cache) == 1
+
+        passout.remove_password(rand_pwname)
+        assert len(running_daemon.cache) == 0
+        with pytest.raises(PassOutError) as exc_info:
+            daemon.get_password(cfg, rand_pwname)
+        err_str = "No password called '%s'" % rand_pwname
+        assert exc_info.value.args[0] == err_str
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+import support
+import passout
+from passout import journal, PassOutError
+
+
+@pytest.fixture
+def jrnl(tmpdir):
+    return journal.Journal(str(tmpdir.join("change_journal")))
+
+
+class TestJournal(object):
+
+    def test_record_read(self, jrnl):
+        assert jrnl.read() == (None, [])
+        jrnl.record([(journal.ADDED, "a"), (journal.ADDED, "b c")])
+        jrnl.record([(journal.REMOVED, "a")])
+
+        journal_id, changes = jrnl.read()
+        assert [x[:3] for x in changes] == \
+            [(1, "+", "a"), (2, "+", "b c"), (3, "-", "a")]
+
+        # Reading from a change on gives just those after it
+        assert jrnl.read(changes[1][3]) == (journal_id, changes[2:])
+
+    def test_partial_line(self, jrnl):
+        jrnl.record([(journal.ADDED, "a")])
+        with open(jrnl.path, "ab") as fh:
+            fh.write(b'2 + "b')
+        assert [x[:3] for x in jrnl.read()[1]] == [(1, "+", "a")]
+
+        jrnl.record([(journal.ADDED, "c")])
+        assert [x[:3] for x in jrnl.read()[1]] == \
+            [(1, "+", "a"), (2, "+", "c")]
+
+    def test_corrupt(self, jrnl):
+        with open(jrnl.path, "w") as fh:
+            fh.write("rubbish\n")
+        with pytest.raises(PassOutError):
+            jrnl.read()
+
+
+class TestSync(support.PassOutLibTest):
+
+    @pytest.mark.parametrize("layout", ["flat", "packed"])
+    def test_sync(self, cfg, tmpdir, layout, rand_pw):
+        cfg["layout"] = layout
+        dest = str(tmpdir.join("mirror"))
+        for name in ["a", "b", "c"]:
+            passout.add_password(cfg, name, rand_pw + name)
+
+        result = passout.sync_to(cfg, dest)
+        assert result.full and sorted(result.copied) == ["a", "b", "c"]
+        mirror = passout.Store(dest)
+        assert mirror.get_password("b", testing=True) == rand_pw + "b"
+        assert mirror.cfg["layout"] == "flat"
+
+        # Only the changes since are looked at
+        passout.remove_password("a")
+        passout.add_password(cfg, "d", rand_pw)
+        result = passout.sync_to(cfg, dest)
+        assert not result.full
+        # Each change is journalled both before and after it is made
+        assert (result.copied, result.removed, result.seq) == \
+            (["d"], ["a"], 10)
+        assert sorted(mirror.get_password_names()) == ["b", "c", "d"]
+        assert passout.sync_to(cfg, dest).copied == []
+
+        # A new journal means comparing everything
+        os.unlink(passout.default_store().journal_file)
+        passout.remove_password("c")
+        result = passout.sync_to(cfg, dest)
+        assert result.full and result.removed == ["c"]
+
+    def test_sync_rekey(self, cfg, tmpdir, rand_pw):
+        from passout import bulk
+
+        dest = str(tmpdir.join("mirror"))
+        passout.add_password(cfg, "a", rand_pw)
+        passout.sync_to(cfg, dest)
+        bulk.rekey_store(cfg, support.GPG_ID, testing=True)
+        assert passout.sync_to(cfg, dest).copied == ["a"]
+
+    def test_import_journalled_once(self, cfg, rand_pw):
+        from passout import bulk
+
+        entries = [bulk.ImportEntry(x, rand_pw, None, None)
+                   for x in ["a", "b", "c"]]
+        bulk.import_passwords(cfg, entries, jobs=1, testing=True)
+        jrnl = journal.Journal(passout.default_store().journal_file)
+        names = [x[2] for x in jrnl.read()[1]]
+        assert names == ["a", "b", "c", "a", "b", "c"]
+
+    def test_sync_to_self(self, cfg):
+        with pytest.raises(PassOutError):
+            passout.sync_to(cfg, passout.PASSOUT_HOME)
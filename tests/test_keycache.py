@@ -0,0 +1,124 @@
+import pytest
+
+import support
+import passout
+from passout import PassOutError
+
+
+@pytest.fixture
+def cache(tmpdir, request):
+    from passout import keycache
+
+    try:
+        cache = keycache.KeyringCache(str(tmpdir), 60)
+        cache.put("probe", "x")
+    except PassOutError as e:
+        pytest.skip("No kernel keyring: %s" % e)
+    if cache.get("probe") is None:
+        pytest.skip("Can't add keys to the kernel keyring")
+    request.addfinalizer(cache.flush)
+    return cache
+
+
+class TestKeyringCache(object):
+
+    def test_put_get(self, cache):
+        assert cache.get("a") is None
+        cache.put("a", u"sécret")
+        assert cache.get("a") == u"sécret"
+        cache.put("a", "other")
+        assert cache.get("a") == "other"
+
+    def test_evict_flush(self, cache):
+        cache.put("a", "1")
+        cache.put("b", "2")
+        cache.evict("a")
+        assert cache.get("a") is None
+        assert cache.get("b") == "2"
+        cache.flush()
+        assert cache.get("b") is None
+
+
+class FakeLib(object):
+    """Enough of libkeyutils to make keys fail to be cached"""
+
+    def __init__(self, add_key=-1, set_timeout=-1):
+        self.results = {"add_key": add_key, "set_timeout": set_timeout}
+        self.invalidated = []
+
+    def keyctl_get_keyring_ID(self, ring, create):
+        return 1
+
+    def keyctl_search(self, ring, key_type, desc, dest):
+        return 2
+
+    def add_key(self, key_type, desc, payload, size, ring):
+        return self.results["add_key"]
+
+    def keyctl_set_timeout(self, key, ttl):
+        return self.results["set_timeout"]
+
+    def keyctl_invalidate(self, key):
+        self.invalidated.append(key)
+        return 0
+
+
+class TestKeyringCachePut(object):
+
+    def test_put_is_best_effort(self, tmpdir, monkeypatch):
+        from passout import keycache
+
+        lib = FakeLib()
+        monkeypatch.setattr(keycache, "_lib", lambda: lib)
+        keycache.KeyringCache(str(tmpdir), 60).put("a", "1")
+        assert lib.invalidated == []
+
+    def test_put_no_timeout(self, tmpdir, monkeypatch):
+        from passout import keycache
+
+        lib = FakeLib(add_key=3)
+        monkeypatch.setattr(keycache, "_lib", lambda: lib)
+        keycache.KeyringCache(str(tmpdir), 60).put("a", "1")
+        assert lib.invalidated == [3]
+
+
+class TestKeyringCacheLib(support.PassOutLibTest):
+
+    def test_get_password(self, cfg, cache, rand_pwname, rand_pw):
+        cfg["keyring_ttl"] = 60
+        try:
+            passout.add_password(cfg, rand_pwname, rand_pw)
+            assert passout.get_password(cfg, rand_pwname, testing=True) == \
+                rand_pw
+
+            # Now no gpg is needed
+            gpg = cfg["gpg"]
+            cfg["gpg"] = "/nonexistent/gpg"
+            assert passout.get_password(cfg, rand_pwname, testing=True) == \
+                rand_pw
+
+            # Changes invalidate the cache
+            cfg["gpg"] = gpg
+            passout.remove_password(rand_pwname)
+            passout.add_password(cfg, rand_pwname, rand_pw + "2")
+            assert passout.get_password(cfg, rand_pwname, testing=True) == \
+                rand_pw + "2"
+
+            passout.flush_cache()
+            cfg["gpg"] = "/nonexistent/gpg"
+            with pytest.raises(PassOutError):
+                passout.get_password(cfg, rand_pwname, testing=True)
+        finally:
+            passout.flush_cache()
+
+    def test_flush_without_libkeyutils(self, cfg, monkeypatch):
+        from passout import daemon, keycache
+
+        def no_lib():
+            raise PassOutError("The keyring cache needs libkeyutils")
+
+        flushed = []
+        monkeypatch.setattr(keycache, "_lib", no_lib)
+        monkeypatch.setattr(daemon, "flush", flushed.append)
+        passout.flush_cache()
+        assert flushed == [passout.default_store().sock_file]
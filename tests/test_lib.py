@@ -1,4 +1,5 @@
 import os
+import re
 
 import pytest
 import json
@@ -9,7 +10,7 @@ from passout import PassOutError
 from distutils.spawn import find_executable
 
 
-def dummy_check_dirs():
+def dummy_check_dirs(*args, **kwargs):
     pass
 
 
@@ -28,6 +29,20 @@ class TestLib(support.PassOutLibTest):
         got = passout.get_password(cfg, rand_pwname, testing=True)
         assert got == rand_pw
 
+    def test_get_passwords(self, cfg, rand_pwname, rand_pw):
+        rand_pwname2 = rand_pwname + "2"
+        missing = rand_pwname + "3"
+
+        passout.add_password(cfg, rand_pwname, rand_pw)
+        passout.add_password(cfg, rand_pwname2, rand_pw + "2")
+        got, errs = passout.get_passwords(
+            cfg, [rand_pwname, rand_pwname2, missing], testing=True)
+
+        assert got == {rand_pwname: rand_pw, rand_pwname2: rand_pw + "2"}
+        assert list(errs) == [missing]
+        err_str = "No password called '%s'" % missing
+        assert errs[missing].args[0] == err_str
+
     def test_ls(self, cfg, rand_pwname, rand_pw):
         rand_pwname2 = rand_pwname + "2"
 
@@ -38,6 +53,29 @@ class TestLib(support.PassOutLibTest):
 
         assert got == [rand_pwname, rand_pwname2]
 
+    def test_grep_passwords(self, cfg, rand_pw):
+        names = ["pw%d" % i for i in range(8)]
+        for name in names:
+            passout.add_password(cfg, name, rand_pw + name)
+        with open(passout.default_store()._get_pass_file("pw7"), "w") as fh:
+            fh.write("not gpg")
+
+        regex = re.compile("pw[36]$")
+        got = list(passout.grep_passwords(cfg, regex, testing=True))
+        assert sorted(x[0] for x in got if x[1] is None) == ["pw3", "pw6"]
+        assert [x[0] for x in got if x[1] is not None] == ["pw7"]
+
+        # Stop decrypting once a match is found
+        spans = []
+        passout.trace.add_hook(spans.append)
+        try:
+            got = list(passout.grep_passwords(
+                cfg, re.compile("pw0"), first=True, jobs=1, testing=True))
+        finally:
+            passout.trace.remove_hook(spans.append)
+        assert got == [("pw0", None)]
+        assert len([x for x in spans if x["kind"] == "gpg"]) < len(names)
+
     def test_add_same_pw_twice(self, cfg, rand_pwname, rand_pw):
         passout.add_password(cfg, rand_pwname, rand_pw)
         with pytest.raises(PassOutError) as exc_info:
@@ -46,6 +84,105 @@ class TestLib(support.PassOutLibTest):
         err_str = "A password called '%s' already exists" % rand_pwname
         assert exc_info.value.args[0] == err_str
 
+    def test_name_index(self, cfg, rand_pwname, rand_pw):
+        passout.add_password(cfg, rand_pwname, rand_pw)
+        assert passout.get_password_names() == [rand_pwname]
+        assert os.path.exists(passout.NAME_INDEX_FILE)
+
+        # Changes made behind passout's back invalidate the index
+        other = os.path.join(passout.CRYPTO_DIR, "other.gpg")
+        open(other, "w").close()
+        assert sorted(passout.get_password_names()) == \
+            sorted([rand_pwname, "other"])
+
+        passout.remove_password("other")
+        assert passout.default_store()._read_name_index() == [rand_pwname]
+
+    def test_default_store_cfg(self, cfg, rand_pwname, rand_pw):
+        store = passout.default_store()
+        assert store.cfg is cfg
+
+        # Another config is used for that call only
+        other = dict(cfg, layout="sharded")
+        passout.add_password(other, rand_pwname, rand_pw)
+        assert store.cfg is cfg
+        assert passout.default_store(other) is not store
+        assert os.path.exists(store._get_pass_file(rand_pwname, "sharded"))
+
+    def test_name_index_threads(self, cfg, rand_pw):
+        import threading
+
+        passout.add_password(cfg, "a", rand_pw)
+        store = passout.default_store()
+        errors = []
+
+        def rebuild():
+            try:
+                for i in range(50):
+                    store._write_name_index(["a"])
+                    store.get_search_index()
+            except (IOError, OSError) as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=rebuild) for i in range(4)]
+        for thr in threads:
+            thr.start()
+        for thr in threads:
+            thr.join()
+        assert errors == []
+        assert store._read_name_index() == ["a"]
+        assert [x for x in os.listdir(passout.PASSOUT_HOME)
+                if x.endswith(".tmp")] == []
+
+    def test_store(self, cfg, tmpdir, rand_pwname, rand_pw):
+        store = passout.Store(cfg=cfg)
+        store.add_password(rand_pwname, rand_pw)
+        assert store.get_password_names() == [rand_pwname]
+        assert store.get_password(rand_pwname, testing=True) == rand_pw
+
+        # The listing is kept until the store changes
+        os.unlink(passout.NAME_INDEX_FILE)
+        assert store.get_password_names() == [rand_pwname]
+        assert not os.path.exists(passout.NAME_INDEX_FILE)
+        open(os.path.join(store.crypto_dir, "other.gpg"), "w").close()
+        assert sorted(store.get_password_names()) == \
+            sorted([rand_pwname, "other"])
+
+        # A second store in another home is separate from the first
+        other = passout.Store(str(tmpdir.join("home")), cfg)
+        assert other.get_password_names() == []
+        other.add_password("x", rand_pw)
+        assert other.get_password("x", testing=True) == rand_pw
+        assert "x" not in store.get_password_names()
+
+    def test_iter_password_names(self, cfg, rand_pw):
+        for name in ["mail__work", "bank", "mail__gmail", "mailer"]:
+            passout.add_password(cfg, name, rand_pw)
+        assert list(passout.iter_password_names()) == \
+            ["bank", "mail__gmail", "mail__work", "mailer"]
+        assert list(passout.iter_password_names("mail")) == \
+            ["mail__gmail", "mail__work"]
+
+        # With no index, an unsorted listing scans and then writes one
+        store = passout.Store(cfg=cfg)
+        os.unlink(passout.NAME_INDEX_FILE)
+        names = store.iter_password_names(sort=False)
+        assert sorted(names) == ["bank", "mail__gmail", "mail__work", "mailer"]
+        assert store._read_name_index() == \
+            ["bank", "mail__gmail", "mail__work", "mailer"]
+
+    def test_find_password_names(self, cfg, rand_pw):
+        passout.add_password(cfg, "mail__gmail", rand_pw)
+        passout.add_password(cfg, "gmail", rand_pw)
+        passout.add_password(cfg, "bank", rand_pw)
+
+        assert passout.find_password_names("gmail") == \
+            ["gmail", "mail__gmail"]
+
+        # The saved index is rebuilt when the store changes
+        passout.remove_password("gmail")
+        assert passout.find_password_names("gmail") == ["mail__gmail"]
+
     def test_rm(self, cfg, rand_pwname, rand_pw):
         passout.add_password(cfg, rand_pwname, rand_pw)
         passout.remove_password(rand_pwname)
@@ -68,6 +205,52 @@ class TestLib(support.PassOutLibTest):
             data = support.get_clipboard_text(clip)
             assert data == ""
 
+    @pytest.mark.skipif("DISPLAY" not in os.environ, reason="No X11")
+    @pytest.mark.skipif(find_executable("xclip") is None, reason="No xclip")
+    def test_clear_clipboard_changed(self, cfg, rand_pwname, rand_pw):
+        passout.add_password(cfg, rand_pwname, rand_pw)
+        passout.load_clipboard(cfg, rand_pwname, testing=True)
+        passout._load_clipboard("primary", "something else")
+
+        # Only clipboards still holding the password are cleared
+        passout.clear_clipboard(cfg, rand_pw)
+        assert support.get_clipboard_text("primary") == "something else"
+        assert support.get_clipboard_text("clipboard") == ""
+
+    def test_clip_in_background(self, cfg, tmpdir, monkeypatch, rand_pwname,
+                                rand_pw):
+        import stat
+        import time
+        from passout import clipboard
+
+        # Like xclip, leave a process behind holding the selection. It
+        # must not keep the pipe to the parent open.
+        clips = tmpdir.mkdir("clips")
+        xclip = tmpdir.join("xclip")
+        xclip.write("#!/bin/sh\n"
+                    "if [ $1 = -o ]; then cat %s/$3; exit; fi\n"
+                    "cat > %s/$3\n"
+                    "sleep 10 </dev/null >/dev/null 2>&1 &\n" % (clips, clips))
+        os.chmod(str(xclip), stat.S_IRWXU)
+        monkeypatch.setenv("PATH", "%s:%s" % (tmpdir, os.environ["PATH"]))
+        monkeypatch.delenv("DISPLAY", raising=False)
+        cfg["clip_clear_time"] = 1
+
+        start = time.time()
+        clipboard.clip_in_background(cfg, rand_pwname, rand_pw)
+        assert time.time() - start < 5
+        assert clips.join("primary").read() == rand_pw
+
+        def cleared():
+            return all(clips.join(x).read() == ""
+                       for x in passout.XCLIP_CLIPBOARDS)
+
+        for i in range(100):
+            if cleared():
+                break
+            time.sleep(0.1)
+        assert cleared()
+
     def test_rm_nonexisting_pw(self, rand_pwname):
         with pytest.raises(PassOutError) as exc_info:
             passout.remove_password(rand_pwname)
@@ -83,6 +266,80 @@ class TestLib(support.PassOutLibTest):
         err_str = "gpg returned non-zero"
         assert exc_info.value.args[0] == err_str
 
+        # No partial file is left behind to be listed
+        assert passout.get_password_names() == []
+        assert os.listdir(passout.CRYPTO_DIR) == []
+
+    @pytest.mark.parametrize("layout", ["flat", "sharded", "packed"])
+    def test_transaction(self, cfg, layout, rand_pw):
+        cfg["layout"] = layout
+        store = passout.default_store()
+        passout.add_password(cfg, "old", rand_pw)
+
+        with store.transaction() as txn:
+            for i in range(5):
+                txn.add("pw%d" % i, rand_pw + str(i))
+            txn.remove("old")
+        assert sorted(store.get_password_names()) == \
+            ["pw%d" % i for i in range(5)]
+        assert store.get_password("pw3", testing=True) == rand_pw + "3"
+
+        # A bad batch changes nothing
+        with pytest.raises(PassOutError):
+            with store.transaction() as txn:
+                txn.add("new", rand_pw)
+                txn.remove("pw0")
+                txn.remove("nope")
+        with pytest.raises(PassOutError):
+            with store.transaction() as txn:
+                txn.add("new", rand_pw)
+                txn.add("pw1", rand_pw)
+        with pytest.raises(ValueError):
+            with store.transaction() as txn:
+                txn.add("new", rand_pw)
+                raise ValueError()
+        assert sorted(store.get_password_names()) == \
+            ["pw%d" % i for i in range(5)]
+        assert [x for x in os.listdir(passout.CRYPTO_DIR)
+                if x.endswith(".tmp")] == []
+
+    def test_transaction_encrypt_fails(self, cfg, rand_pw, monkeypatch):
+        store = passout.default_store()
+        encrypt_to_temp = passout._encrypt_to_temp
+
+        def fail_one(cfg, out_dir, passwd, *args):
+            if passwd.endswith("3"):
+                raise PassOutError("encrypt failed")
+            return encrypt_to_temp(cfg, out_dir, passwd, *args)
+
+        monkeypatch.setattr(passout, "_encrypt_to_temp", fail_one)
+        with pytest.raises(PassOutError):
+            with store.transaction(jobs=4) as txn:
+                for i in range(8):
+                    txn.add("pw%d" % i, rand_pw + str(i))
+        assert store.get_password_names() == []
+        assert [x for x in os.listdir(passout.CRYPTO_DIR)
+                if x.endswith(".tmp")] == []
+
+    def test_add_race(self, cfg, rand_pwname, rand_pw):
+        import threading
+
+        errors = []
+
+        def add(i):
+            try:
+                passout.Store(cfg=cfg).add_password(rand_pwname, str(i))
+            except PassOutError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=add, args=(i, )) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(errors) == 3
+        assert passout.get_password_names() == [rand_pwname]
+
     def test_get_password_names_empty(self, cfg, rand_pw):
         assert passout.get_password_names() == []
 
@@ -142,13 +399,20 @@ class TestLib(support.PassOutLibTest):
         simply containing those options"""
 
         config = {u"clip_clear_time": 5, u"id": u"jim@bob.com",
-                  u"gpg": u"gpg2", "notify_cmd": "doit"}
+                  u"gpg": u"gpg2", "notify_cmd": "doit",
+                  "daemon_ttl": 10, "daemon_cache_size": 5,
+                  "trace": "summary", "layout": "sharded",
+                  "crypto_backend": "gpgme", "keyring_ttl": 60}
+        enabled = []
 
         monkeypatch.setattr(json, "loads", mk_dummy_json_load(config))
-        monkeypatch.setattr(passout, "_check_dirs", dummy_check_dirs)
+        monkeypatch.setattr(passout.Store, "_check_dirs", dummy_check_dirs)
+        monkeypatch.setattr(passout.trace, "enable", enabled.append)
+        monkeypatch.delenv(passout.trace.TRACE_ENV, raising=False)
 
         config2 = passout.get_config()
         assert config == config2
+        assert enabled == ["summary"]
 
     def test_get_config0002(self, monkeypatch):
         """a config with only the mandatory id field gives default values for
@@ -156,10 +420,13 @@ class TestLib(support.PassOutLibTest):
 
         config = {u"id": u"jim@bob.com"}
         expect = {u"clip_clear_time": 5, u"id": u"jim@bob.com",
-                  u"gpg": u"gpg2", "notify_cmd": ""}
+                  u"gpg": u"gpg2", "notify_cmd": "",
+                  "daemon_ttl": 300, "daemon_cache_size": 100, "trace": "",
+                  "layout": "flat", "crypto_backend": "subprocess",
+                  "keyring_ttl": 0}
 
         monkeypatch.setattr(json, "loads", mk_dummy_json_load(config))
-        monkeypatch.setattr(passout, "_check_dirs", dummy_check_dirs)
+        monkeypatch.setattr(passout.Store, "_check_dirs", dummy_check_dirs)
 
         config = passout.get_config()
         assert config == expect
@@ -170,7 +437,7 @@ class TestLib(support.PassOutLibTest):
         config = {u"gpg": u"gpg2"}
 
         monkeypatch.setattr(json, "loads", mk_dummy_json_load(config))
-        monkeypatch.setattr(passout, "_check_dirs", dummy_check_dirs)
+        monkeypatch.setattr(passout.Store, "_check_dirs", dummy_check_dirs)
 
         with pytest.raises(passout.PassOutError):
             config = passout.get_config()
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import support
+import passout
+from passout import meta, PassOutError
+
+
+@pytest.fixture
+def index(tmpdir):
+    return meta.MetaIndex(str(tmpdir.join("metadata.sqlite")))
+
+
+class TestMetaIndex(object):
+
+    def test_set_get(self, index):
+        assert index.get("a") is None
+        index.set("a", username="me", tags=["x", "w"])
+        got = index.get("a")
+        assert (got["username"], got["url"], got["tags"], got["rotated"]) == \
+            ("me", None, ["w", "x"], None)
+        assert got["created"] > 0
+
+        # Fields not given are left alone
+        index.set("a", url="https://example.com", rotated=5)
+        got = index.get("a")
+        assert (got["username"], got["url"], got["rotated"]) == \
+            ("me", "https://example.com", 5)
+
+        with pytest.raises(PassOutError):
+            index.set("a", passwd="oops")
+
+    def test_query(self, index):
+        index.set("mail__gmail", username="Bob", url="https://gmail.com",
+                  tags=["mail"])
+        index.set("mail__work", username="bob@work", tags=["mail", "work"])
+        index.set("bank", username="robert", tags=["money"])
+
+        assert index.query() == ["bank", "mail__gmail", "mail__work"]
+        assert index.query(username="bob*") == ["mail__gmail", "mail__work"]
+        assert index.query(url="*GMAIL*") == ["mail__gmail"]
+        assert index.query(tags=["mail", "work"]) == ["mail__work"]
+        assert index.query(group="mail", username="*work") == ["mail__work"]
+
+    def test_remove(self, index):
+        index.set("a", tags=["x"])
+        index.remove("a")
+        assert index.get("a") is None
+        assert index.query(tags=["x"]) == []
+
+    def test_sqlite_errors(self, index):
+        index.set("a", tags=["x"])
+        index.db.execute("DROP TABLE tags")
+        with pytest.raises(PassOutError):
+            index.get("a")
+        with pytest.raises(PassOutError):
+            index.set("a", tags=["y"])
+        with pytest.raises(PassOutError):
+            index.query(tags=["x"])
+        index.db.execute("DROP TABLE meta")
+        with pytest.raises(PassOutError):
+            index.remove("a")
+
+
+class TestMetaLib(support.PassOutLibTest):
+
+    def test_add_and_query(self, cfg, rand_pw):
+        store = passout.default_store()
+        passout.add_password(cfg, "plain", rand_pw)
+        assert not os.path.exists(store.meta_file)
+
+        passout.add_password(cfg, "mail__gmail", rand_pw,
+                             meta={"username": "me", "tags": ["mail"]})
+        passout.add_password(cfg, "bank", rand_pw)
+        assert passout.query_passwords(tags=["mail"]) == ["mail__gmail"]
+        assert passout.get_metadata("plain")["created"] is None
+        assert passout.get_metadata("bank")["created"] is not None
+
+        passout.set_metadata("bank", username="me")
+        assert passout.query_passwords(username="me") == \
+            ["bank", "mail__gmail"]
+        with pytest.raises(PassOutError):
+            passout.set_metadata("nope", username="me")
+
+        # Removed passwords go, whether or not passout removed them
+        passout.remove_password("bank")
+        os.unlink(store._get_pass_file("mail__gmail"))
+        assert passout.query_passwords(username="me") == []
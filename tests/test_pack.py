@@ -0,0 +1,142 @@
+import os
+
+import pytest
+
+import passout
+from passout import pack, PassOutError
+
+
+@pytest.fixture
+def paths(tmpdir):
+    return (str(tmpdir.join("store.pack")), str(tmpdir.join("pack_index")),
+            str(tmpdir.join("pack.lock")))
+
+
+class TestPack(object):
+
+    def test_put_get(self, paths):
+        store = pack.PackStore(*paths)
+        assert store.get("a") is None
+        assert store.names() == []
+
+        store.put("a", b"secret a")
+        store.put("g__b", b"secret b")
+        assert store.get("a") == b"secret a"
+        assert sorted(store.names()) == ["a", "g__b"]
+        assert "g__b" in store and "c" not in store
+        assert len(store) == 2
+
+    def test_put_existing(self, paths):
+        store = pack.PackStore(*paths)
+        store.put("a", b"1")
+        with pytest.raises(PassOutError):
+            store.put("a", b"2")
+        store.put("a", b"2", replace=True)
+        assert store.get("a") == b"2"
+        assert len(store) == 1
+
+    def test_delete(self, paths):
+        store = pack.PackStore(*paths)
+        store.put("a", b"1")
+        assert store.delete("a")
+        assert not store.delete("a")
+        assert store.get("a") is None
+        assert store.names() == []
+
+    def test_other_writer(self, paths):
+        """Changes made by another process are seen"""
+
+        store, other = pack.PackStore(*paths), pack.PackStore(*paths)
+        store.put("a", b"1")
+        assert other.get("a") == b"1"
+        other.delete("a")
+        other.put("b", b"2")
+        assert store.names() == ["b"]
+
+    def test_write_batch(self, paths):
+        store = pack.PackStore(*paths)
+        store.put("a", b"1")
+        store.write_batch([("b", b"2"), ("a", b"3")], ["a", "c"])
+        assert sorted(store.names()) == ["a", "b"]
+        assert store.get("a") == b"3"
+        with pytest.raises(PassOutError):
+            store.write_batch([("b", b"4")], [])
+        assert store.get("b") == b"2"
+
+    def test_index(self, paths, monkeypatch):
+        monkeypatch.setattr(pack, "INDEX_TAIL_MIN", 10)
+        store = pack.PackStore(*paths)
+        for i in range(25):
+            store.put("pw%02d" % i, b"x" * i)
+        store.delete("pw03")
+        assert os.path.exists(paths[1])
+
+        # A fresh reader uses the index plus the records after it
+        fresh = pack.PackStore(*paths)
+        assert fresh.view is None
+        assert fresh.get("pw07") == b"x" * 7
+        assert fresh.get("pw24") == b"x" * 24
+        assert fresh.get("pw03") is None
+        assert len(fresh.view.tail) < 25
+        assert len(fresh.names()) == 24
+
+    def test_partial_record(self, paths):
+        """A writer dying part way through a record loses only that record"""
+
+        store = pack.PackStore(*paths)
+        store.put("a", b"1")
+        with open(paths[0], "ab") as fh:
+            fh.write(b"+\x05\x00")
+        assert pack.PackStore(*paths).names() == ["a"]
+
+        store.put("b", b"2")
+        assert sorted(pack.PackStore(*paths).names()) == ["a", "b"]
+
+    def test_compact(self, paths, monkeypatch):
+        monkeypatch.setattr(pack, "COMPACT_MIN_DEAD", 100)
+        store = pack.PackStore(*paths)
+        for i in range(10):
+            store.put("pw%d" % i, b"x" * 50)
+        for i in range(8):
+            store.delete("pw%d" % i)
+        assert store.needs_compaction()
+
+        size = os.path.getsize(paths[0])
+        synced = []
+        monkeypatch.setattr(passout, "_fsync_dir", synced.append)
+        store.compact()
+        assert os.path.getsize(paths[0]) < size
+        assert synced == [os.path.dirname(paths[0])]
+        assert not store.needs_compaction()
+        assert sorted(store.names()) == ["pw8", "pw9"]
+        assert pack.PackStore(*paths).get("pw9") == b"x" * 50
+
+        # Compacting an empty pack removes it
+        store.delete("pw8")
+        store.delete("pw9")
+        store.compact()
+        assert not os.path.exists(paths[0])
+        assert store.names() == []
+
+    def test_compact_in_background(self, paths):
+        import time
+
+        store = pack.PackStore(*paths)
+        for i in range(10):
+            store.put("pw%d" % i, b"x" * 50)
+        for i in range(8):
+            store.delete("pw%d" % i)
+
+        size = os.path.getsize(paths[0])
+        store.compact_in_background()
+        for i in range(100):
+            if os.path.getsize(paths[0]) < size:
+                break
+            time.sleep(0.1)
+        assert os.path.getsize(paths[0]) < size
+        assert sorted(pack.PackStore(*paths).names()) == ["pw8", "pw9"]
+
+    def test_bad_name(self, paths):
+        store = pack.PackStore(*paths)
+        with pytest.raises(PassOutError):
+            store.put("a\nb", b"1")
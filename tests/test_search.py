@@ -0,0 +1,47 @@
+import os
+
+import support
+from passout.search import NameSearchIndex, score_name
+
+NAMES = ["mail__gmail", "mail__work", "gmail", "work__GMailish",
+         "bank__login"]
+
+
+class TestSearch(object):
+
+    def test_score_name(self):
+        assert score_name("gmail", ["gmail"]) > \
+            score_name("mail__gmail", ["gmail"]) > \
+            score_name("work__gmailish", ["gmail"]) > \
+            score_name("gmail__x", ["mail"])
+        assert score_name("mail__gmail", ["mail", "gmail"]) > \
+            score_name("mail__gmail", ["gmail"])
+        assert score_name("a__b", ["a__b"]) > 0
+        assert score_name("a__b", ["nope"]) == 0
+
+    def test_search(self):
+        index = NameSearchIndex(NAMES)
+        got = [name for score, name in index.search("gmail")]
+        assert got == ["gmail", "mail__gmail", "work__GMailish"]
+
+    def test_search_all_terms(self):
+        index = NameSearchIndex(NAMES)
+        got = [name for score, name in index.search("Mail work")]
+        assert got == ["mail__work", "work__GMailish"]
+
+    def test_search_limit(self):
+        index = NameSearchIndex(NAMES)
+        assert len(index.search("mail", limit=2)) == 2
+        assert index.search("nothing") == []
+        assert index.search("") == []
+
+    def test_save_load(self):
+        path = os.path.join(support.TEST_DIR, "search_index_test")
+        index = NameSearchIndex(NAMES)
+        try:
+            index.save(path, "sig")
+            assert NameSearchIndex.load(path, "other") is None
+            loaded = NameSearchIndex.load(path, "sig")
+            assert loaded.search("gmail") == index.search("gmail")
+        finally:
+            os.unlink(path)
@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+
+import support
+import passout
+from passout import trace
+
+
+@pytest.fixture
+def records(request):
+    got = []
+    trace.add_hook(got.append)
+    request.addfinalizer(lambda: trace.remove_hook(got.append))
+    return got
+
+
+class TestTrace(object):
+
+    def test_no_hooks(self):
+        with trace.span("gpg") as sp:
+            sp.set(rc=0)
+        assert sp is trace._NULL_SPAN
+
+    def test_span(self, records):
+        with trace.span("gpg", op="decrypt") as sp:
+            sp.set(rc=2)
+        assert len(records) == 1
+        rec = records[0]
+        assert (rec["kind"], rec["op"], rec["rc"], rec["ok"]) == \
+            ("gpg", "decrypt", 2, True)
+        assert rec["ms"] >= 0
+
+    def test_span_raises(self, records):
+        with pytest.raises(ValueError):
+            with trace.span("scan"):
+                raise ValueError()
+        assert records[0]["ok"] is False
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert trace.percentile(values, 50) == 50
+        assert trace.percentile(values, 99) == 99
+        assert trace.percentile([7], 90) == 7
+
+    def test_summary(self):
+        hook = trace.SummaryHook()
+        for ms in [4, 1, 3, 2]:
+            hook({"kind": "xclip", "ms": ms})
+        summ = hook.summary()["xclip"]
+        assert summ["count"] == 4
+        assert (summ["p50_ms"], summ["max_ms"], summ["total_ms"]) == \
+            (2, 4, 10)
+        assert hook.report().split("\n")[1].startswith("xclip")
+
+    def test_json_lines(self):
+        path = os.path.join(support.TEST_DIR, "trace_test.jsonl")
+        hook = trace.JsonLinesHook(path)
+        hook({"kind": "notify", "ms": 1.5})
+        hook.fh.close()
+        with open(path) as fh:
+            assert json.loads(fh.readline()) == {"kind": "notify", "ms": 1.5}
+        os.unlink(path)
+
+
+class TestTraceLib(support.PassOutLibTest):
+
+    def test_gpg_and_scan_spans(self, cfg, records, rand_pwname, rand_pw):
+        passout.add_password(cfg, rand_pwname, rand_pw)
+        passout.get_password(cfg, rand_pwname, testing=True)
+        passout.get_password_names()  # no index yet, so scans
+
+        gpg_ops = [r["op"] for r in records if r["kind"] == "gpg"]
+        assert gpg_ops == ["encrypt", "decrypt"]
+        assert all(r["rc"] == 0 for r in records if r["kind"] == "gpg")
+        scans = [r for r in records if r["kind"] == "scan"]
+        assert scans[-1]["entries"] == 1
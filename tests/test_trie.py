@@ -0,0 +1,71 @@
+import sys
+
+import support  # noqa
+from passout.trie import NameTrie, TrieEntry
+
+
+class TestTrie(object):
+
+    def test_insert_sorted(self):
+        trie = NameTrie(["b", "a__y", "a__x", "c"])
+        assert list(trie.names()) == ["a__x", "a__y", "b", "c"]
+        assert len(trie) == 4
+
+    def test_insert_twice(self):
+        trie = NameTrie(["a__b"])
+        assert not trie.insert("a__b")
+        assert len(trie) == 1
+
+    def test_contains(self):
+        trie = NameTrie(["a__b"])
+        assert "a__b" in trie
+        assert "a" not in trie
+        assert "a__c" not in trie
+
+    def test_level(self):
+        trie = NameTrie(["x", "g__b", "g__a", "g__h__1"])
+        assert list(trie.level()) == [
+            TrieEntry("g", "g", True, False),
+            TrieEntry("x", "x", False, True),
+        ]
+        assert list(trie.level("g")) == [
+            TrieEntry("a", "g__a", False, True),
+            TrieEntry("b", "g__b", False, True),
+            TrieEntry("h", "g__h", True, False),
+        ]
+        assert list(trie.level("nope")) == []
+
+    def test_names_in_group(self):
+        trie = NameTrie(["x", "g__b", "g__a", "g__h__1", "gg"])
+        assert list(trie.names("g")) == ["g__a", "g__b", "g__h__1"]
+
+    def test_remove_prunes(self):
+        trie = NameTrie(["g__h__1", "x"])
+        assert trie.remove("g__h__1")
+        assert trie.lookup("g") is None
+        assert list(trie.names()) == ["x"]
+        assert not trie.remove("g__h__1")
+        assert len(trie) == 1
+
+    def test_remove_keeps_group(self):
+        trie = NameTrie(["g", "g__a"])
+        trie.remove("g")
+        assert list(trie.names()) == ["g__a"]
+
+    def test_to_dict(self):
+        trie = NameTrie(["b", "a__y", "a__x"])
+        dct = trie.to_dict()
+        assert dct == {"a": {"x": {}, "y": {}}, "b": {}}
+        assert list(dct) == ["a", "b"]
+        assert list(dct["a"]) == ["x", "y"]
+        assert trie.to_dict("a") == {"x": {}, "y": {}}
+
+    def test_deep(self):
+        depth = sys.getrecursionlimit() + 10
+        name = "__".join(["g"] * depth)
+        trie = NameTrie([name])
+        assert list(trie.names()) == [name]
+        dct = trie.to_dict()
+        for i in range(depth):
+            dct = dct["g"]
+        assert dct == {}